@@ -1,10 +1,11 @@
-import json
+import asyncio
 import os
 
-import boto3
-from botocore.config import Config
 from dotenv import load_dotenv
 
+from gateway import cacheable_content, gateway
+from tracing import traced
+
 load_dotenv()
 
 # Get the directory where the current script is located
@@ -17,18 +18,19 @@ prompt_guide_path = os.path.join(current_script_path, "PromptGuide.md")
 with open(prompt_guide_path, "r") as f:
     PromptGuide = f.read()
 
-region_name = os.getenv("REGION_NAME")
+# The guide and the rewrite rules, the same for every rewrite and generate_more request so they can be cached
+rewrite_prefix = """
+You are a instruction engineer. Your task is to rewrite the initial instruction in <instruction> xml tag based on the suggestions in the instruction guide in <guide> xml tag.
 
-session = boto3.Session()
-retry_config = Config(
-    region_name=region_name,
-    retries={
-        "max_attempts": 5,
-        "mode": "standard",
-    },
-)
-service_name = "bedrock-runtime"
-bedrock_client = session.client(service_name=service_name, config=retry_config)
+Instruction guide:
+<guide>
+{guide}
+</guide>
+
+You are a instruction engineer. Your task is to rewrite the initial instruction in <instruction> xml tag based on the suggestions in the instruction guide in <guide> xml tag.
+which is included using double pointed brackets is customizable text that will be replaced at runtime. This needs to be kept as is.
+Please same language as the initial instruction for rewriting.
+""".strip().format(guide=PromptGuide)
 
 from rater import Rater
 
@@ -37,6 +39,7 @@ class APE:
     def __init__(self):
         self.rater = Rater()
 
+    @traced("ape.generate")
     def __call__(self, initial_prompt, epoch, demo_data):
         candidates = []
         for _ in range(2):
@@ -62,19 +65,37 @@ class APE:
             best_candidate = self.rater(initial_prompt, candidates, demo_data)
         return candidates[best_candidate]
 
-    def rewrite(self, initial_prompt):
-        prompt = """
-You are a instruction engineer. Your task is to rewrite the initial instruction in <instruction> xml tag based on the suggestions in the instruction guide in <guide> xml tag.
+    @traced("ape.generate")
+    async def acall(self, initial_prompt, epoch, demo_data):
+        candidates = await asyncio.gather(*[self.arewrite(initial_prompt) for _ in range(2)])
+        customizable_variable_list = list(demo_data.keys())
+        candidates = [
+            {"prompt": candidate}
+            for candidate in candidates
+            if all(
+                [
+                    customizable_variable in candidate
+                    for customizable_variable in customizable_variable_list
+                ]
+            )
+        ]
+        best_candidate = await self.rater.acall(initial_prompt, candidates, demo_data)
+        for _ in range(epoch):
+            more_candidate = await self.agenerate_more(
+                initial_prompt, candidates[best_candidate]["prompt"]
+            )
+            candidates = [candidates[best_candidate]] + [{"prompt": more_candidate}]
+            best_candidate = await self.rater.acall(initial_prompt, candidates, demo_data)
+        return candidates[best_candidate]
 
-Instruction guide:
-<guide>
-{guide}
-</guide>
+    def rewrite(self, initial_prompt):
+        return self._rewrite_result(gateway.invoke(*self._rewrite_request(initial_prompt), coalesce=False, stage="ape.rewrite"))
 
-You are a instruction engineer. Your task is to rewrite the initial instruction in <instruction> xml tag based on the suggestions in the instruction guide in <guide> xml tag.
-which is included using double pointed brackets is customizable text that will be replaced at runtime. This needs to be kept as is.
-Please same language as the initial instruction for rewriting.
+    async def arewrite(self, initial_prompt):
+        return self._rewrite_result(await gateway.ainvoke(*self._rewrite_request(initial_prompt), coalesce=False, stage="ape.rewrite"))
 
+    def _rewrite_request(self, initial_prompt):
+        prompt = """
 <instruction>
 {initial}
 </instruction>
@@ -82,34 +103,28 @@ Please same language as the initial instruction for rewriting.
 
 Please only output the rewrite result.
 """.strip()
+        modelId = "anthropic.claude-3-sonnet-20240229-v1:0"  # anthropic.claude-3-sonnet-20240229-v1:0 "anthropic.claude-3-haiku-20240307-v1:0"
         messages = [
             {
                 "role": "user",
-                "content": prompt.format(guide=PromptGuide, initial=initial_prompt),
+                "content": cacheable_content(modelId, rewrite_prefix, prompt.format(initial=initial_prompt)),
             }  # ,{
             #   "role": "assistant",
             #   "content": "{"
             # }
         ]
-        body = json.dumps(
-            {
-                "messages": messages,
-                "max_tokens": 1000,
-                "temperature": 0.8,
-                "top_k": 50,
-                "top_p": 1,
-                "stop_sequences": ["\n\nHuman:"],
-                "anthropic_version": "bedrock-2023-05-31",
-            }
-        )
-        modelId = "anthropic.claude-3-sonnet-20240229-v1:0"  # anthropic.claude-3-sonnet-20240229-v1:0 "anthropic.claude-3-haiku-20240307-v1:0"
-        accept = "application/json"
-        contentType = "application/json"
-
-        response = bedrock_client.invoke_model(
-            body=body, modelId=modelId, accept=accept, contentType=contentType
-        )
-        response_body = json.loads(response.get("body").read())
+        body = {
+            "messages": messages,
+            "max_tokens": 1000,
+            "temperature": 0.8,
+            "top_k": 50,
+            "top_p": 1,
+            "stop_sequences": ["\n\nHuman:"],
+            "anthropic_version": "bedrock-2023-05-31",
+        }
+        return modelId, body
+
+    def _rewrite_result(self, response_body):
         result = response_body["content"][0]["text"].replace("</rewrite>", "").strip()
         if result.startswith("<instruction>"):
             result = result[13:]
@@ -119,18 +134,13 @@ Please only output the rewrite result.
         return result
 
     def generate_more(self, initial_prompt, example):
-        prompt = """
-You are a instruction engineer. Your task is to rewrite the initial instruction in <instruction> xml tag based on the suggestions in the instruction guide in <guide> xml tag.
+        return self._generate_more_result(gateway.invoke(*self._generate_more_request(initial_prompt, example), coalesce=False, stage="ape.generate_more"))
 
-Instruction guide:
-<guide>
-{guide}
-</guide>
-
-You are a instruction engineer. Your task is to rewrite the initial instruction in <instruction> xml tag based on the suggestions in the instruction guide in <guide> xml tag.
-which is included using double pointed brackets is customizable text that will be replaced at runtime. This needs to be kept as is.
-Please same language as the initial instruction for rewriting.
+    async def agenerate_more(self, initial_prompt, example):
+        return self._generate_more_result(await gateway.ainvoke(*self._generate_more_request(initial_prompt, example), coalesce=False, stage="ape.generate_more"))
 
+    def _generate_more_request(self, initial_prompt, example):
+        prompt = """
 <instruction>
 {initial}
 </instruction>
@@ -141,36 +151,30 @@ Please same language as the initial instruction for rewriting.
 
 Please only output the rewrite result.
 """.strip()
+        modelId = "anthropic.claude-3-sonnet-20240229-v1:0"  # anthropic.claude-3-sonnet-20240229-v1:0 "anthropic.claude-3-haiku-20240307-v1:0"
         messages = [
             {
                 "role": "user",
-                "content": prompt.format(
-                    guide=PromptGuide, initial=initial_prompt, demo=example
+                "content": cacheable_content(
+                    modelId, rewrite_prefix, prompt.format(initial=initial_prompt, demo=example)
                 ),
             }  # ,{
             #   "role": "assistant",
             #   "content": "{"
             # }
         ]
-        body = json.dumps(
-            {
-                "messages": messages,
-                "max_tokens": 1000,
-                "temperature": 0.8,
-                "top_k": 50,
-                "top_p": 1,
-                "stop_sequences": ["\n\nHuman:"],
-                "anthropic_version": "bedrock-2023-05-31",
-            }
-        )
-        modelId = "anthropic.claude-3-sonnet-20240229-v1:0"  # anthropic.claude-3-sonnet-20240229-v1:0 "anthropic.claude-3-haiku-20240307-v1:0"
-        accept = "application/json"
-        contentType = "application/json"
-
-        response = bedrock_client.invoke_model(
-            body=body, modelId=modelId, accept=accept, contentType=contentType
-        )
-        response_body = json.loads(response.get("body").read())
+        body = {
+            "messages": messages,
+            "max_tokens": 1000,
+            "temperature": 0.8,
+            "top_k": 50,
+            "top_p": 1,
+            "stop_sequences": ["\n\nHuman:"],
+            "anthropic_version": "bedrock-2023-05-31",
+        }
+        return modelId, body
+
+    def _generate_more_result(self, response_body):
         result = response_body["content"][0]["text"].replace("</rewrite>", "").strip()
         if result.startswith("<instruction>"):
             result = result[13:]
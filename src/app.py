@@ -1,3 +1,4 @@
+import asyncio
 import json
 import os
 import re
@@ -8,7 +9,9 @@ from dotenv import load_dotenv
 from ape import APE
 from calibration import CalibrationPrompt
 from metaprompt import MetaPrompt
+from metrics import start_metrics_server
 from optimize import Alignment
+from tracing import traced
 from translate import GuideBased
 from application.soe_prompt import SOEPrompt
 
@@ -24,6 +27,8 @@ calibration = CalibrationPrompt()
 # Load environment variables
 load_dotenv()
 language = os.getenv("LANGUAGE", "en")
+# Candidates of a Multiple-time Generation, rewritten concurrently
+rewrite_candidates = max(1, int(os.getenv("REWRITE_CANDIDATES", 3)))
 
 # Load translations from JSON file
 with open('translations.json', 'r', encoding='utf-8') as f:
@@ -31,41 +36,68 @@ with open('translations.json', 'r', encoding='utf-8') as f:
 
 
     
-def generate_prompt(original_prompt, level):
+@traced("app.generate_prompt")
+async def generate_candidates(original_prompt, num, on_candidate, judge=True):
+    """
+    Rewrite the prompt `num` times concurrently and judge the candidates once the last one arrives
+    :param on_candidate: Called with the index and the text of each candidate as soon as it is ready
+    :return: The candidates and the index of the best one, None if not judged
+    """
+    async def candidate(i):
+        result = await rewrite.acall(original_prompt)
+        on_candidate(i, result)
+        return result
+
+    tasks = [asyncio.ensure_future(candidate(i)) for i in range(num)]
+    try:
+        candidates = await asyncio.gather(*tasks)
+    finally:
+        # When one rewrite fails, the others are no longer needed
+        for task in tasks:
+            task.cancel()
+    best = await rewrite.ajudge(candidates) if judge else None
+    return candidates, best
+
+
+def candidate_textbox(i, value="", best=None, numbered=True):
+    label = lang_store[language]["Prompt Template Generated"]
+    if best is not None:
+        label = f"{label} #{i+1} {'Y' if best == i else 'N'}"
+    elif numbered:
+        label = f"{label} #{i+1}"
+    return gr.Textbox(label=label, value=value, lines=3, show_copy_button=True, visible=True, interactive=False)
+
+
+async def generate_prompt(original_prompt, level):
+    # A generator, so that Gradio shows every candidate as soon as it is ready
     if level == "One-time Generation":
-        result = rewrite(original_prompt)
-        return [
-            gr.Textbox(
-                label=lang_store[language]["Prompt Template Generated"],
-                value=result,
-                lines=3,
-                show_copy_button=True,
-                interactive=False,
-            )
-        ] + [gr.Textbox(visible=False)] * 2
+        candidates, _ = await generate_candidates(original_prompt, 1, lambda i, result: None, judge=False)
+        yield [candidate_textbox(0, candidates[0], numbered=False)] + [gr.Textbox(visible=False)] * (rewrite_candidates - 1)
     elif level == "Multiple-time Generation":
-        candidates = []
-        for i in range(3):
-            result = rewrite(original_prompt)
-            candidates.append(result)
-        judge_result = rewrite.judge(candidates)
-        textboxes = []
-        for i in range(3):
-            is_best = "Y" if judge_result == i else "N"
-            textboxes.append(
-                gr.Textbox(
-                    label=f"{lang_store[language]['Prompt Template Generated']} #{i+1} {is_best}",
-                    value=candidates[i],
-                    lines=3,
-                    show_copy_button=True,
-                    visible=True,
-                    interactive=False,
-                )
-            )
-        return textboxes
+        ready = asyncio.Queue()
+        task = asyncio.create_task(
+            generate_candidates(original_prompt, rewrite_candidates, lambda i, result: ready.put_nowait((i, result)))
+        )
+        values = [""] * rewrite_candidates
+        try:
+            yield [candidate_textbox(i) for i in range(rewrite_candidates)]
+            for _ in range(rewrite_candidates):
+                getter = asyncio.ensure_future(ready.get())
+                await asyncio.wait([getter, task], return_when=asyncio.FIRST_COMPLETED)
+                if not getter.done():
+                    # A rewrite failed, raise its error
+                    getter.cancel()
+                    task.result()
+                i, values[i] = getter.result()
+                yield [candidate_textbox(i, values[i]) for i in range(rewrite_candidates)]
+            candidates, best = await task
+            yield [candidate_textbox(i, candidates[i], best) for i in range(rewrite_candidates)]
+        finally:
+            task.cancel()
 
-def ape_prompt(original_prompt, user_data):
-    result = ape(original_prompt, 1, json.loads(user_data))
+@traced("app.ape_prompt")
+async def ape_prompt(original_prompt, user_data):
+    result = await ape.acall(original_prompt, 1, json.loads(user_data))
     return [
         gr.Textbox(
             label="Prompt Generated",
@@ -74,7 +106,7 @@ def ape_prompt(original_prompt, user_data):
             show_copy_button=True,
             interactive=False,
         )
-    ] + [gr.Textbox(visible=False)] * 2
+    ] + [gr.Textbox(visible=False)] * (rewrite_candidates - 1)
 
 with gr.Blocks(title=lang_store[language]["Automatic Prompt Engineering"], theme="soft") as demo:
     gr.Markdown(f"# {lang_store[language]['Automatic Prompt Engineering']}")
@@ -106,7 +138,7 @@ with gr.Blocks(title=lang_store[language]["Automatic Prompt Engineering"], theme
             interactive=False,
         )
         metaprompt_button.click(
-            metaprompt,
+            metaprompt.acall,
             inputs=[original_task, variables],
             outputs=[prompt_result, variables_result],
         )
@@ -127,7 +159,7 @@ with gr.Blocks(title=lang_store[language]["Automatic Prompt Engineering"], theme
                 )
                 b1 = gr.Button(lang_store[language]["Generate Prompt"])
                 textboxes = []
-                for i in range(3):
+                for i in range(rewrite_candidates):
                     t = gr.Textbox(
                         label=lang_store[language]["Prompt Template Generated"],
                         elem_id="textbox_id",
@@ -224,7 +256,7 @@ with gr.Blocks(title=lang_store[language]["Automatic Prompt Engineering"], theme
             )
 
             invoke_button.click(
-                alignment.invoke_prompt,
+                alignment.ainvoke_prompt,
                 inputs=[
                     user_prompt_original_replaced,
                     user_prompt_eval_replaced,
@@ -253,7 +285,7 @@ with gr.Blocks(title=lang_store[language]["Automatic Prompt Engineering"], theme
             )
             evaluate_button = gr.Button(lang_store[language]["Auto-evaluate the Prompt Effect"])
             evaluate_button.click(
-                alignment.evaluate_response,
+                alignment.aevaluate_response,
                 inputs=[openai_output, aws_output, eval_model_dropdown],
                 outputs=[feedback_input],
             )
@@ -263,7 +295,7 @@ with gr.Blocks(title=lang_store[language]["Automatic Prompt Engineering"], theme
                 label=lang_store[language]["Revised Prompt"], lines=3, interactive=False, show_copy_button=True
             )
             revise_button.click(
-                alignment.generate_revised_prompt,
+                alignment.agenerate_revised_prompt,
                 inputs=[
                     feedback_input,
                     user_prompt_eval,
@@ -306,17 +338,23 @@ def postprocess(llm_output):
                 calibration_prompt_original = gr.Textbox(label=lang_store[language]["Please input your original prompt"], lines=5, placeholder=lang_store[language]["Summarize the text delimited by triple quotes.\n\n\"\"\"{{insert text here}}\"\"\""])
             with gr.Column(scale=2):
                 postprocess_code = gr.Textbox(label=lang_store[language]["Please input your postprocess code"], lines=3, value=default_code)
-                dataset_file = gr.File(file_types=['csv'], type='binary')
+                dataset_file = gr.File(file_types=['csv'], type='filepath')
         with gr.Row():
             with gr.Column(scale=2):
                 calibration_task = gr.Radio(["classification"], value="classification", label=lang_store[language]["Task type"])
             with gr.Column(scale=2):
                 steps_num = gr.Slider(1, 5, value=1, step=1, label=lang_store[language]["Epoch"])
+                candidates_num = gr.Slider(1, 8, value=1, step=1, label=lang_store[language]["Candidates per epoch"])
+                calibration_run_id = gr.Textbox(label=lang_store[language]["Run ID to resume (optional)"], lines=1)
             calibration_optimization = gr.Button(lang_store[language]["Optimization based on prediction"])
             calibration_prompt = gr.Textbox(label=lang_store[language]["Revised Prompt"], lines=3, show_copy_button=True, interactive=False)
+            calibration_stop_reason = gr.Textbox(label=lang_store[language]["Stop reason"], lines=1, interactive=False)
+            calibration_download = gr.DownloadButton(label=lang_store[language]["Download predict result"], visible=False)
             calibration_optimization.click(
-                calibration.optimize, inputs=[calibration_task, calibration_prompt_original, dataset_file, postprocess_code, steps_num],
-                outputs=calibration_prompt
+                calibration.optimize, inputs=[calibration_task, calibration_prompt_original, dataset_file, postprocess_code, steps_num, candidates_num, calibration_run_id],
+                outputs=[calibration_prompt, calibration_stop_reason, calibration_download]
             )
 
-demo.launch()
\ No newline at end of file
+if __name__ == "__main__":
+    start_metrics_server()
+    demo.launch()
@@ -1,15 +1,13 @@
-import os
 import base64
-import json
-import boto3
-
 from dotenv import load_dotenv
 
+from gateway import gateway
+from tracing import traced
+
 load_dotenv()
 
 class SOEPrompt:
     def __init__(self, model_id="anthropic.claude-3-sonnet-20240229-v1:0", system='You are an AI assistant that generates SEO-optimized product descriptions.'):
-        self.bedrock_runtime = boto3.client(service_name='bedrock-runtime', region_name=os.getenv("REGION_NAME"))
         self.model_id = model_id
         self.system = system
 
@@ -18,31 +16,26 @@ class SOEPrompt:
             return base64.b64encode(image_file.read()).decode('utf-8')
 
     def run_multi_modal_prompt(self, messages, max_tokens=4000):
-        body = json.dumps({
+        body = {
             "anthropic_version": "bedrock-2023-05-31",
             "max_tokens": max_tokens,
             "messages": messages
-        })
-
-        response = self.bedrock_runtime.invoke_model(
-            body=body, modelId=self.model_id)
-        response_body = json.loads(response.get('body').read())
+        }
 
-        return response_body
+        return gateway.invoke(self.model_id, body, stage="soe.describe_image")
 
     def generate_bedrock_response(self, prompt):
         messages = [{
             "role": "user",
             "content": [{"type": "text", "text": prompt}]
         }]
-        body = json.dumps({
+        body = {
             "anthropic_version": "bedrock-2023-05-31",
             "max_tokens": 4000,
             "messages": messages,
             "system": self.system,
-        })
-        response = self.bedrock_runtime.invoke_model(body=body, modelId=self.model_id)
-        response_body = json.loads(response.get('body').read())
+        }
+        response_body = gateway.invoke(self.model_id, body, stage="soe.generate_description")
         return response_body['content'][0]['text']
 
     def generate_product_description(self, product_category, brand_name, usage_description, target_customer, image_path=None, media_type="image/jpeg"):
@@ -97,6 +90,7 @@ class SOEPrompt:
         product_description = self.generate_bedrock_response(prompt_template)
         return product_description
 
+    @traced("soe.generate_description")
     def generate_description(self, product_category, brand_name, usage_description, target_customer, image_files):
         media_type = None
         if image_files:
@@ -0,0 +1,138 @@
+import logging
+import os
+import queue
+import threading
+import time
+import uuid
+import zipfile
+
+import pandas as pd
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+    pq = None
+
+logger = logging.getLogger("calibration.artifacts")
+
+PREDICTION_COLUMNS = ["predict", "error", "score"]
+# Labels and predictions may be numbers in one chunk and text in the next, so they are always stored as strings
+STRING_COLUMNS = ["label", "predict", "error"]
+
+
+class ArtifactWriter:
+    """
+    Writes prediction artifacts on a background thread, so the request thread never waits on serialization.
+
+    Artifacts live in a run-scoped directory. The input columns are written once to `inputs`.
+    Every full pass adds its own artifact holding only the prediction columns,
+    row-aligned with `inputs`, instead of rewriting the whole table.
+    Files are Parquet (zstd) when pyarrow is installed, gzip-compressed CSV otherwise.
+    """
+
+    def __init__(self, directory=None):
+        if directory is None:
+            directory = os.path.join("temp", "predict", time.strftime("%Y%m%d-%H%M%S") + "-" + uuid.uuid4().hex[:8])
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self.extension = ".parquet" if pq is not None else ".csv.gz"
+        self.errors = []
+        self._inputs_owner = None
+        self._writers = {}
+        self._queue = queue.Queue(maxsize=16)
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def path(self, name):
+        return os.path.join(self.directory, name + self.extension)
+
+    def write(self, name, chunk):
+        """
+        Queue a chunk of rows to be appended to the artifact `name`
+        """
+        if self._thread is None:
+            raise RuntimeError("The artifact writer is already finished")
+        self._queue.put((name, chunk))
+
+    def write_predictions(self, name, chunk):
+        """
+        Queue the prediction columns of a scored chunk. The first artifact written also records the input columns.
+        """
+        if self._inputs_owner in (None, name):
+            self._inputs_owner = name
+            self.write("inputs", chunk.drop(columns=PREDICTION_COLUMNS, errors="ignore"))
+        self.write(name, chunk[[column for column in PREDICTION_COLUMNS if column in chunk]])
+
+    def _append(self, name, chunk):
+        if name in self._writers and self._writers[name] is None:
+            # This artifact already failed, skip its remaining chunks
+            return
+        if pq is None:
+            chunk.to_csv(self.path(name), mode="a" if name in self._writers else "w",
+                         header=name not in self._writers, index=None, compression="gzip")
+            self._writers[name] = True
+            return
+        # String and object columns are stored as strings from the first chunk on, so every chunk has the same schema
+        chunk = chunk.astype({column: "string" for column in chunk.columns
+                              if column in STRING_COLUMNS or chunk[column].dtype == object})
+        table = pa.Table.from_pandas(chunk, preserve_index=False)
+        writer = self._writers.get(name)
+        if writer is None:
+            writer = pq.ParquetWriter(self.path(name), table.schema, compression="zstd")
+            self._writers[name] = writer
+        else:
+            table = table.cast(writer.schema)
+        writer.write_table(table)
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            name, chunk = item
+            try:
+                self._append(name, chunk)
+            except Exception as e:
+                self.errors.append(f"{name}: {type(e).__name__}: {e}")
+                writer = self._writers.get(name)
+                if writer not in (None, True):
+                    writer.close()
+                self._writers[name] = None
+        for writer in self._writers.values():
+            if writer not in (None, True):
+                writer.close()
+
+    def finish(self):
+        """
+        Wait for the queued chunks to be written and bundle the artifacts
+        :return: The path of a zip file holding every artifact of the run
+        """
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+        if self.errors:
+            logger.warning("Failed to write prediction artifacts: %s", "; ".join(self.errors))
+        zip_path = self.directory.rstrip(os.sep) + ".zip"
+        # Parquet and gzip are already compressed, store them as they are
+        with zipfile.ZipFile(zip_path, "w", compression=zipfile.ZIP_STORED) as archive:
+            for file_name in sorted(os.listdir(self.directory)):
+                archive.write(os.path.join(self.directory, file_name), arcname=file_name)
+        return zip_path
+
+
+def read_artifact(directory, name):
+    """
+    Read an artifact written by ArtifactWriter back as a DataFrame, joined with its input columns
+    """
+    def read(artifact):
+        parquet_path = os.path.join(directory, artifact + ".parquet")
+        if os.path.exists(parquet_path):
+            return pd.read_parquet(parquet_path)
+        return pd.read_csv(os.path.join(directory, artifact + ".csv.gz"))
+
+    if name == "inputs":
+        return read(name)
+    return pd.concat([read("inputs"), read(name)], axis=1)
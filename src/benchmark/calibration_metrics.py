@@ -0,0 +1,69 @@
+"""
+Benchmark the calibration bookkeeping that runs between LLM calls:
+scoring, confusion counts, per-label error sampling and the failure-case text.
+
+Run from the src folder:
+    python -m benchmark.calibration_metrics --rows 100000 1000000
+"""
+import argparse
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+from calibration import CalibrationPrompt, EvaluationMetrics
+
+
+def make_dataset(num_rows, num_labels=4, accuracy=0.8, seed=0):
+    rng = np.random.default_rng(seed)
+    labels = np.array([f"label_{i}" for i in range(num_labels)])
+    gt = labels[rng.integers(0, num_labels, num_rows)]
+    predict = np.where(rng.random(num_rows) < accuracy, gt, labels[rng.integers(0, num_labels, num_rows)])
+    return pd.DataFrame({
+        "text": "sample text " + pd.Series(np.arange(num_rows)).astype(str),
+        "label": gt,
+        "predict": predict,
+    })
+
+
+def run(num_rows, chunksize, num_errors=5):
+    # Only the pure-pandas helpers are exercised, so no Bedrock client is created
+    calibration = CalibrationPrompt.__new__(CalibrationPrompt)
+    dataset = make_dataset(num_rows)
+    timings = {}
+
+    start = time.perf_counter()
+    dataset = calibration.get_eval_function()(dataset)
+    timings["score"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    metrics = EvaluationMetrics(num_errors)
+    for offset in range(0, num_rows, chunksize):
+        metrics.update(dataset.iloc[offset:offset + chunksize])
+    summary = metrics.summary()
+    timings["metrics"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    calibration.large_error_to_str(summary["errors"], num_errors)
+    timings["failure_cases"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    calibration.large_error_to_str(calibration.extract_errors(dataset), num_errors)
+    timings["failure_cases_full"] = time.perf_counter() - start
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, nargs="+", default=[100_000, 1_000_000])
+    parser.add_argument("--chunksize", type=int, default=1000)
+    args = parser.parse_args()
+    for num_rows in args.rows:
+        timings = run(num_rows, args.chunksize)
+        report = ", ".join(f"{name}={seconds * 1000:.1f}ms" for name, seconds in timings.items())
+        sys.stdout.write(f"rows={num_rows}: {report}\n")
+
+
+if __name__ == "__main__":
+    main()
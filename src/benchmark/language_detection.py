@@ -0,0 +1,109 @@
+"""
+Benchmark the local language detector against the model's answers on a fixture corpus of prompts.
+
+Reports the agreement with the reference answers, both on the exact language code and on the
+rewrite rule it selects in GuideBased (English, Chinese or "same language as the prompt"),
+the share of prompts that would still go to the model, and the time per detection.
+
+The reference answers are the model's, stored in the corpus as `llm_lang` by --write-references.
+Until they are, the hand-written `lang` labels are used and the report says so.
+
+Run from the src folder:
+    python -m benchmark.language_detection
+    # Ask the model with the real detect_lang prompt, record its responses and store its answers in the corpus
+    LLM_BACKEND=record python -m benchmark.language_detection --llm --write-references
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+from language import detect_language
+
+CORPUS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures", "language_corpus.json")
+
+
+def rewrite_rule(lang):
+    # The same tests as GuideBased._rewrite_request
+    if lang == "ch":
+        return "ch"
+    if lang == "en":
+        return "en"
+    return "same"
+
+
+def time_detection(texts, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for text in texts:
+            detect_language(text)
+    return (time.perf_counter() - start) / (repeat * len(texts))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--corpus", default=CORPUS, help="JSON list of {\"text\", \"lang\"}")
+    parser.add_argument("--threshold", type=float, default=float(os.getenv("LANG_DETECT_THRESHOLD", 0.8)))
+    parser.add_argument("--repeat", type=int, default=200, help="Passes over the corpus for the timing")
+    parser.add_argument("--llm", action="store_true", help="Ask the model for the reference answers, uses LLM_BACKEND")
+    parser.add_argument("--write-references", action="store_true", help="With --llm, store the model's answers in the corpus as `llm_lang`")
+    args = parser.parse_args()
+
+    with open(args.corpus, encoding="utf-8") as f:
+        corpus = json.load(f)
+
+    llm_seconds = None
+    if args.llm:
+        from translate import GuideBased
+
+        rewrite = GuideBased()
+        start = time.perf_counter()
+        references = [rewrite.llm_detect_lang(sample["text"]) for sample in corpus]
+        llm_seconds = (time.perf_counter() - start) / len(corpus)
+        reference = f"llm ({os.getenv('LLM_BACKEND', 'live')})"
+        if args.write_references:
+            for sample, lang in zip(corpus, references):
+                sample["llm_lang"] = lang
+            with open(args.corpus, "w", encoding="utf-8") as f:
+                json.dump(corpus, f, ensure_ascii=False, indent=2)
+    elif all("llm_lang" in sample for sample in corpus):
+        references = [sample["llm_lang"] for sample in corpus]
+        reference = "llm (stored)"
+    else:
+        # The hand labels were written alongside the detector, agreement with them is optimistic
+        references = [sample["lang"] for sample in corpus]
+        reference = "hand labels"
+        sys.stderr.write("No model references stored in the corpus, comparing with the hand labels. "
+                         "Regenerate them with LLM_BACKEND=record and --llm --write-references.\n")
+
+    exact = same_rule = confident = confident_same_rule = 0
+    for sample, expected in zip(corpus, references):
+        lang, confidence = detect_language(sample["text"])
+        exact += lang == expected
+        same_rule += rewrite_rule(lang) == rewrite_rule(expected)
+        if confidence >= args.threshold:
+            confident += 1
+            confident_same_rule += rewrite_rule(lang) == rewrite_rule(expected)
+        if rewrite_rule(lang) != rewrite_rule(expected):
+            sys.stderr.write(f"mismatch: local={lang!r} ({confidence:.2f}) reference={expected!r} text={sample['text'][:60]!r}\n")
+
+    num = len(corpus)
+    report = {
+        "samples": num,
+        "reference": reference,
+        "exact_agreement": round(exact / num, 4),
+        "rewrite_rule_agreement": round(same_rule / num, 4),
+        "threshold": args.threshold,
+        "llm_fallback_rate": round(1 - confident / num, 4),
+        # What GuideBased.detect_lang ends up with: the local answer when confident, the model's otherwise
+        "rewrite_rule_agreement_with_fallback": round((confident_same_rule + num - confident) / num, 4),
+        "local_microseconds": round(time_detection([sample["text"] for sample in corpus], args.repeat) * 1e6, 2),
+    }
+    if llm_seconds is not None:
+        report["llm_milliseconds"] = round(llm_seconds * 1000, 1)
+    sys.stdout.write(json.dumps(report, indent=2) + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,225 @@
+"""
+Benchmark every pipeline end to end against the offline LLM stand-in (LLM_BACKEND=replay).
+
+Each pipeline runs twice: with the simulated model latency, which gives the wall time,
+and with zero latency, which leaves the project's own overhead. The report holds the LLM calls,
+throttled calls, tokens sent/received and prompt cache tokens of each run, as JSON so results can be compared across commits.
+
+Run from the src folder:
+    python -m benchmark.pipelines --output bench.json
+    python -m benchmark.pipelines --only metaprompt ape --compare bench.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures", "pipeline_responses.json")
+
+TASK = "Draft an email responding to a customer complaint"
+VARIABLES = "CUSTOMER_COMPLAINT\nCOMPANY_NAME"
+ORIGINAL_PROMPT = 'Summarize the text delimited by triple quotes.\n\n"""{{document}}"""'
+DEMO_DATA = {"{{document}}": "The quarterly report shows revenue grew 12% while costs stayed flat."}
+POSTPROCESS_CODE = "def postprocess(llm_output):\n    return llm_output.strip()\n"
+
+
+def configure(args, workdir):
+    """
+    Point every client at the stand-in. Has to run before the project modules are imported.
+    """
+    os.environ.update({
+        "LLM_BACKEND": "replay",
+        "LLM_SIM_FIXTURES": args.fixtures,
+        "LLM_RECORDINGS": args.recordings or os.path.join(workdir, "recordings.jsonl"),
+        "LLM_SIM_LATENCY_MS": str(args.latency_ms),
+        "LLM_SIM_MS_PER_TOKEN": str(args.ms_per_token),
+        "LLM_SIM_THROTTLE_RATE": str(args.throttle_rate),
+        "LLM_SIM_JITTER": "0",
+        "LLM_RESPONSE_CACHE": "1" if args.cache else "0",
+        "LLM_RESPONSE_CACHE_PATH": os.path.join(workdir, "response_cache.sqlite"),
+        "LLM_RATE_LIMIT": "1" if args.rate_limit or args.throttle_rate else "0",
+        "CALIBRATION_CACHE": "1" if args.cache else "0",
+        "CALIBRATION_CACHE_PATH": os.path.join(workdir, "prediction_cache.sqlite"),
+        "CALIBRATION_CHECKPOINT_DIR": os.path.join(workdir, "runs"),
+    })
+
+
+def make_calibration_dataset(path, num_rows):
+    import pandas as pd
+
+    reviews = [
+        ("The battery lasts all day and the screen is gorgeous.", "positive"),
+        ("It stopped working after a week and support never answered.", "negative"),
+        ("Great value, I would buy it again.", "positive"),
+        ("The strap broke on the first day.", "negative"),
+    ]
+    rows = [reviews[i % len(reviews)] for i in range(num_rows)]
+    pd.DataFrame({
+        "text": [f"{text} (review {i})" for i, (text, _) in enumerate(rows)],
+        "label": [label for _, label in rows],
+    }).to_csv(path, index=False)
+
+
+def pipelines(args, workdir):
+    """
+    :return: A dict of pipeline name to a zero-argument function running it
+    """
+    from ape import APE
+    from application.soe_prompt import SOEPrompt
+    from metaprompt import MetaPrompt
+    from optimize import Alignment
+    from translate import GuideBased
+
+    metaprompt = MetaPrompt()
+    rewrite = GuideBased()
+    ape = APE()
+    alignment = Alignment()
+    soeprompt = SOEPrompt()
+
+    async def multiple_time_generation():
+        # The same calls as app.generate_candidates in "Multiple-time Generation" mode
+        num = max(1, int(os.getenv("REWRITE_CANDIDATES", 3)))
+        candidates = await asyncio.gather(*[rewrite.acall(ORIGINAL_PROMPT) for _ in range(num)])
+        return await rewrite.ajudge(candidates)
+
+    runs = {
+        "metaprompt": lambda: metaprompt(TASK, VARIABLES),
+        "guide_based_one_time": lambda: rewrite(ORIGINAL_PROMPT),
+        "guide_based_multiple_time": lambda: asyncio.run(multiple_time_generation()),
+        "ape": lambda: ape(ORIGINAL_PROMPT, 1, dict(DEMO_DATA)),
+        "alignment_invoke_prompt": lambda: alignment.invoke_prompt(
+            "", "", ORIGINAL_PROMPT, ORIGINAL_PROMPT, "gpt-4o", "anthropic.claude-3-haiku-20240307-v1:0"
+        ),
+        "alignment_evaluate_response": lambda: alignment.evaluate_response(
+            "OpenAI output", "Claude output", "anthropic.claude-3-5-sonnet-20240620-v1:0"
+        ),
+        "alignment_generate_revised_prompt": lambda: alignment.generate_revised_prompt(
+            "<recommendation>Add a summary</recommendation>", ORIGINAL_PROMPT, "OpenAI output", "Claude output",
+            "anthropic.claude-3-5-sonnet-20240620-v1:0",
+        ),
+        "soe_generate_description": lambda: soeprompt.generate_description(
+            "Rain jacket", "Trailhead", "Hiking in wet weather", "Outdoor enthusiasts", None
+        ),
+    }
+    if args.calibration_rows:
+        from calibration import CalibrationPrompt
+
+        calibration = CalibrationPrompt()
+        for num_rows in args.calibration_rows:
+            path = os.path.join(workdir, f"calibration_{num_rows}.csv")
+            make_calibration_dataset(path, num_rows)
+            runs[f"calibration_optimize_{num_rows}"] = lambda path=path: calibration.optimize(
+                "Classify the sentiment of product reviews",
+                "Classify the sentiment of: {text}",
+                path,
+                POSTPROCESS_CODE,
+                step_num=args.calibration_steps,
+            )
+    return runs
+
+
+def measure(fn, simulator, latency, ms_per_token):
+    simulator.latency = latency
+    simulator.token_latency = ms_per_token / 1000
+    simulator.reset()
+    start = time.perf_counter()
+    fn()
+    seconds = time.perf_counter() - start
+    return seconds, simulator.stats()
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline_path):
+    with open(baseline_path, encoding="utf-8") as f:
+        baseline = {result["pipeline"]: result for result in json.load(f)["results"]}
+    for result in results:
+        before = baseline.get(result["pipeline"])
+        if before is None:
+            continue
+        changes = []
+        for metric in ("wall_seconds", "overhead_seconds", "llm_calls", "input_tokens"):
+            if before[metric]:
+                changes.append(f"{metric} {result[metric] / before[metric] - 1:+.1%}")
+        sys.stderr.write(f"{result['pipeline']}: {', '.join(changes)}\n")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--only", nargs="+", help="Names of the pipelines to run")
+    parser.add_argument("--repeat", type=int, default=1, help="Runs per pipeline, the fastest is reported")
+    parser.add_argument("--calibration-rows", type=int, nargs="*", default=[100, 1000])
+    parser.add_argument("--calibration-steps", type=int, default=1)
+    parser.add_argument("--latency-ms", type=float, default=200)
+    parser.add_argument("--ms-per-token", type=float, default=2)
+    parser.add_argument("--throttle-rate", type=float, default=0)
+    parser.add_argument("--rate-limit", action="store_true", help="Keep the shared rate limiter on, implied by --throttle-rate")
+    parser.add_argument("--cache", action="store_true", help="Keep the response and prediction caches on")
+    parser.add_argument("--fixtures", default=FIXTURES)
+    parser.add_argument("--recordings", help="Recorded responses to replay before the fixtures")
+    parser.add_argument("--output", help="Write the JSON report here instead of stdout")
+    parser.add_argument("--compare", help="A previous JSON report to compare against")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as workdir:
+        configure(args, workdir)
+        from simulator import get_simulator
+
+        simulator = get_simulator()
+        runs = pipelines(args, workdir)
+        results = []
+        for name, fn in runs.items():
+            if args.only and name not in args.only:
+                continue
+            wall, stats = min((measure(fn, simulator, args.latency_ms / 1000, args.ms_per_token)
+                               for _ in range(args.repeat)), key=lambda run: run[0])
+            overhead, _ = min((measure(fn, simulator, 0, 0) for _ in range(args.repeat)), key=lambda run: run[0])
+            results.append({
+                "pipeline": name,
+                "wall_seconds": round(wall, 4),
+                "overhead_seconds": round(overhead, 4),
+                "llm_calls": stats["calls"],
+                "throttled_calls": stats["throttled"],
+                "input_tokens": stats["input_tokens"],
+                "output_tokens": stats["output_tokens"],
+                "prompt_cache_read_tokens": stats["cache_read_tokens"],
+                "prompt_cache_write_tokens": stats["cache_write_tokens"],
+            })
+            sys.stderr.write(f"{name}: wall={wall:.3f}s overhead={overhead:.3f}s calls={stats['calls']} "
+                             f"input_tokens={stats['input_tokens']}\n")
+
+    report = {
+        "commit": git_commit(),
+        "created_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "settings": {
+            "latency_ms": args.latency_ms,
+            "ms_per_token": args.ms_per_token,
+            "throttle_rate": args.throttle_rate,
+            "rate_limit": args.rate_limit,
+            "cache": args.cache,
+            "repeat": args.repeat,
+        },
+        "results": results,
+    }
+    if args.compare:
+        compare(results, args.compare)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+    else:
+        sys.stdout.write(json.dumps(report, indent=2) + "\n")
+
+
+if __name__ == "__main__":
+    main()
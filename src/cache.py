@@ -0,0 +1,222 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+
+class PredictionCache:
+    """
+    Disk-backed cache of model outputs, stored in a single SQLite file.
+
+    Entries are keyed by a hash of (model id, rendered prompt, inference params).
+    When the stored values exceed `max_bytes`, the least recently used entries are evicted.
+    Entries older than `ttl` seconds are treated as missing, a falsy `ttl` keeps them forever.
+    """
+
+    def __init__(self, path=None, max_bytes=None, ttl=None):
+        if path is None:
+            path = os.getenv("CALIBRATION_CACHE_PATH", "temp/prediction_cache.sqlite")
+        if max_bytes is None:
+            max_bytes = int(float(os.getenv("CALIBRATION_CACHE_MAX_MB", 256)) * 1024 * 1024)
+        self.path = path
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self._lock = threading.Lock()
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS cache ("
+            "key TEXT PRIMARY KEY, value TEXT NOT NULL, size INTEGER NOT NULL, "
+            "created_at REAL NOT NULL, accessed_at REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS cache_accessed_at ON cache (accessed_at)")
+        self._conn.commit()
+        self._size = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM cache").fetchone()[0]
+
+    @staticmethod
+    def make_key(model_id, prompt, params):
+        payload = json.dumps([model_id, prompt, params], sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute("SELECT value, size, created_at FROM cache WHERE key = ?", (key,)).fetchone()
+            if row is not None and self.ttl and row[2] + self.ttl < now:
+                self._conn.execute("DELETE FROM cache WHERE key = ?", (key,))
+                self._conn.commit()
+                self._size -= row[1]
+                self.expirations += 1
+                row = None
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._conn.execute("UPDATE cache SET accessed_at = ? WHERE key = ?", (now, key))
+            self._conn.commit()
+            return row[0]
+
+    def set(self, key, value):
+        size = len(value.encode("utf-8"))
+        if size > self.max_bytes:
+            return
+        now = time.time()
+        with self._lock:
+            old = self._conn.execute("SELECT size FROM cache WHERE key = ?", (key,)).fetchone()
+            if old is not None:
+                self._size -= old[0]
+            self._conn.execute(
+                "INSERT OR REPLACE INTO cache (key, value, size, created_at, accessed_at) VALUES (?, ?, ?, ?, ?)",
+                (key, value, size, now, now),
+            )
+            self._size += size
+            self._evict()
+            self._conn.commit()
+
+    def _evict(self):
+        while self._size > self.max_bytes:
+            rows = self._conn.execute(
+                "SELECT key, size FROM cache ORDER BY accessed_at ASC LIMIT 64"
+            ).fetchall()
+            if not rows:
+                break
+            for key, size in rows:
+                if self._size <= self.max_bytes:
+                    break
+                self._conn.execute("DELETE FROM cache WHERE key = ?", (key,))
+                self._size -= size
+                self.evictions += 1
+
+    def stats(self):
+        with self._lock:
+            entries = self._conn.execute("SELECT COUNT(*) FROM cache").fetchone()[0]
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+                "entries": entries,
+                "bytes": self._size,
+            }
+
+    def clear(self):
+        with self._lock:
+            self._conn.execute("DELETE FROM cache")
+            self._conn.commit()
+            self._size = 0
+
+
+class MemoryCache:
+    """
+    In-process LRU cache of strings, bounded by their total size in bytes
+    """
+
+    def __init__(self, max_bytes, ttl=None):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self._size = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and self.ttl and entry[1] + self.ttl < time.time():
+                self._remove(key)
+                self.expirations += 1
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return entry[0]
+
+    def set(self, key, value, created_at=None):
+        size = len(value.encode("utf-8"))
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (value, created_at or time.time(), size)
+            self._size += size
+            while self._size > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def _remove(self, key):
+        self._size -= self._entries.pop(key)[2]
+
+    def stats(self):
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+                "entries": len(self._entries),
+                "bytes": self._size,
+            }
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+
+
+class ResponseCache:
+    """
+    Two-tier cache of model responses: an in-memory LRU in front of a PredictionCache on disk.
+    Disk hits are promoted to memory. Both tiers share the same TTL.
+    """
+
+    def __init__(self, path=None, memory_bytes=None, disk_bytes=None, ttl=None):
+        if path is None:
+            path = os.getenv("LLM_RESPONSE_CACHE_PATH", "temp/response_cache.sqlite")
+        if memory_bytes is None:
+            memory_bytes = int(float(os.getenv("LLM_RESPONSE_CACHE_MEMORY_MB", 32)) * 1024 * 1024)
+        if disk_bytes is None:
+            disk_bytes = int(float(os.getenv("LLM_RESPONSE_CACHE_DISK_MB", 256)) * 1024 * 1024)
+        if ttl is None:
+            ttl = float(os.getenv("LLM_RESPONSE_CACHE_TTL", 7 * 24 * 3600))
+        self.memory = MemoryCache(memory_bytes, ttl=ttl)
+        self.disk = PredictionCache(path, max_bytes=disk_bytes, ttl=ttl)
+
+    @staticmethod
+    def make_key(*parts):
+        payload = json.dumps(parts, sort_keys=True, ensure_ascii=False, default=str)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        value = self.memory.get(key)
+        if value is None:
+            value = self.disk.get(key)
+            if value is not None:
+                self.memory.set(key, value)
+        return value
+
+    def set(self, key, value):
+        self.memory.set(key, value)
+        self.disk.set(key, value)
+
+    def stats(self):
+        return {"memory": self.memory.stats(), "disk": self.disk.stats()}
+
+    def clear(self):
+        self.memory.clear()
+        self.disk.clear()
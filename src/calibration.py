@@ -1,14 +1,21 @@
-import boto3
-from botocore.config import Config
 import json
 import re
 import os
+import numpy as np
 import pandas as pd
 import io
 import time
+import math
 import pathlib
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from collections import deque
 import gradio as gr
-from sklearn.metrics import confusion_matrix
+from cache import PredictionCache
+from gateway import gateway, response_text
+from tracing import propagate, traced
+from checkpoint import RunCheckpoint
+from postprocess import Postprocessor
+from artifacts import ArtifactWriter
 
 with open('prompt/error_analysis_classification.prompt') as f:
     error_analysis_prompt = f.read()
@@ -16,24 +23,196 @@ with open('prompt/step_prompt_classification.prompt') as f:
     step_prompt = f.read()
 with open('prompt/prompt_guide_short.prompt') as f:
     prompt_guide_short = f.read()
+with open('prompt/batch_classification.prompt') as f:
+    batch_prompt = f.read()
+
+class EvaluationMetrics:
+    """
+    Running metrics over scored chunks, computed with column-wise pandas/NumPy operations:
+    the mean score, the confusion counts and a uniform sample of errors per label.
+    """
+
+    def __init__(self, num_errors_per_label, seed=42):
+        self.num_errors_per_label = num_errors_per_label
+        self.rng = np.random.default_rng(seed)
+        self.num_rows = 0
+        self.num_correct = 0
+        self.labels = {}
+        # Every label or prediction seen so far maps to a row/column of `counts`, missing values to the code of None
+        self.codes = {}
+        self.counts = np.zeros((0, 0), dtype=np.int64)
+        # Per label code, the largest sample key kept once the label's sample is full, 1.0 until then
+        self.thresholds = np.ones(0)
+        self.errors = None
+
+    def encode(self, values):
+        """
+        :return: A tuple of (the codes of the values in `counts`, the distinct values that are not missing).
+                 Values seen for the first time get the next free codes.
+        """
+        codes, uniques = pd.factorize(values)
+        lookup = [self.codes.setdefault(value, len(self.codes)) for value in uniques]
+        if (codes < 0).any():
+            lookup.append(self.codes.setdefault(None, len(self.codes)))
+        return np.asarray(lookup, dtype=np.int64)[codes], uniques
+
+    def update(self, chunk):
+        """
+        :param chunk: A DataFrame with `label`, `predict` and boolean `score` columns
+        """
+        score = chunk['score'].to_numpy(dtype=bool)
+        self.num_rows += len(chunk)
+        self.num_correct += int(score.sum())
+        label_codes, labels = self.encode(chunk['label'])
+        predict_codes, _ = self.encode(chunk['predict'])
+        self.labels.update(dict.fromkeys(labels))
+        num_codes = len(self.codes)
+        if num_codes > len(self.counts):
+            self.counts = np.pad(self.counts, (0, num_codes - len(self.counts)))
+        self.counts += np.bincount(label_codes * num_codes + predict_codes, minlength=num_codes ** 2).reshape(num_codes, num_codes)
+        error_positions = np.flatnonzero(~score)
+        if len(error_positions) == 0 or self.num_errors_per_label <= 0:
+            return
+        # Keeping the errors with the smallest random keys gives a uniform sample per label.
+        # An error whose key is above its label's threshold can't enter the sample, so most chunks stop here.
+        keys = self.rng.random(len(error_positions))
+        error_codes = label_codes[error_positions]
+        if num_codes > len(self.thresholds):
+            self.thresholds = np.pad(self.thresholds, (0, num_codes - len(self.thresholds)), constant_values=1.0)
+        keep = keys < self.thresholds[error_codes]
+        if not keep.any():
+            return
+        chunk_errors = chunk.iloc[error_positions[keep]].assign(_sample_key=keys[keep], _label_code=error_codes[keep])
+        errors = chunk_errors if self.errors is None else pd.concat([self.errors, chunk_errors])
+        self.errors = errors.sort_values('_sample_key').groupby('_label_code', sort=False).head(self.num_errors_per_label)
+        kept = self.errors.groupby('_label_code')['_sample_key'].agg(['max', 'size'])
+        kept = kept[kept['size'] >= self.num_errors_per_label]
+        self.thresholds[kept.index.to_numpy()] = kept['max'].to_numpy()
+
+    def confusion_matrix(self):
+        labels = list(self.labels)
+        # Predictions outside the label set are left out, missing labels get an empty row
+        index = np.array([self.codes.get(label, -1) for label in labels], dtype=np.int64)
+        known = index >= 0
+        matrix = np.zeros((len(labels), len(labels)), dtype=int)
+        matrix[np.ix_(known, known)] = self.counts[np.ix_(index[known], index[known])]
+        return matrix
+
+    def summary(self):
+        return {
+            'score': self.num_correct / self.num_rows if self.num_rows else 0.0,
+            'errors': self.errors.drop(columns=['_sample_key', '_label_code']) if self.errors is not None else pd.DataFrame(),
+            'confusion_matrix': self.confusion_matrix(),
+            'labels': list(self.labels),
+            'num_rows': self.num_rows,
+        }
+
+
+class CalibrationHistory:
+    """
+    Per-epoch history of a calibration run in a compact form.
+
+    The input columns of every error row referenced by an entry are kept once in a shared
+    `base` frame, and each entry only stores the indices of its error rows. The predictions
+    of each entry are one column of `predictions`. Confusion matrices are int arrays.
+    Iterating or indexing returns the entries as dicts, with their errors rebuilt from the base frame.
+    """
 
-class CalibrationPrompt:
     def __init__(self):
+        self.base = pd.DataFrame()
+        self.predictions = pd.DataFrame()
+        self.entries = []
+
+    def append(self, prompt, evaluation, analysis):
+        errors = evaluation['errors']
+        step = f'step_{len(self.entries)}'
+        if not errors.empty:
+            inputs = errors.drop(columns=['predict', 'score', 'error'], errors='ignore')
+            new_rows = inputs[~inputs.index.isin(self.base.index)]
+            if not new_rows.empty:
+                self.base = new_rows if self.base.empty else pd.concat([self.base, new_rows])
+            predictions = errors['predict'].rename(step)
+            self.predictions = predictions.to_frame() if self.predictions.empty else self.predictions.join(predictions, how='outer')
+        self.entries.append({
+            'prompt': prompt,
+            'score': float(evaluation['score']),
+            'analysis': analysis,
+            'labels': list(evaluation['labels']),
+            'confusion_matrix': np.asarray(evaluation['confusion_matrix'], dtype=np.int32),
+            'error_index': errors.index.to_numpy(),
+        })
+
+    def errors(self, idx):
+        entry = self.entries[idx]
+        if len(entry['error_index']) == 0:
+            return pd.DataFrame()
+        errors = self.base.loc[entry['error_index']].copy()
+        errors['predict'] = self.predictions.loc[entry['error_index'], f'step_{idx % len(self.entries)}']
+        errors['score'] = False
+        return errors
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __getitem__(self, idx):
+        entry = self.entries[idx]
+        return {**entry, 'errors': self.errors(idx)}
+
+    def __iter__(self):
+        return (self[idx] for idx in range(len(self.entries)))
+
+    def save(self, path):
+        pd.to_pickle({'base': self.base, 'predictions': self.predictions, 'entries': self.entries}, path)
+
+    @classmethod
+    def load(cls, path):
+        data = pd.read_pickle(path)
+        history = cls()
+        history.base, history.predictions, history.entries = data['base'], data['predictions'], data['entries']
+        return history
+
+
+class CalibrationPrompt:
+    def __init__(self, max_workers=None, cache=None, chunksize=None):
         with open('metaprompt.txt') as f:
             self.metaprompt = f.read()
-
-        region_name = os.getenv("REGION_NAME")
-        session = boto3.Session()
-        retry_config = Config(
-            region_name=region_name,
-            retries={
-                "max_attempts": 5,
-                "mode": "standard",
-            },
-        )
-        service_name = "bedrock-runtime"
-        self.bedrock_client = session.client(service_name=service_name, config=retry_config)
-    def invoke_model(self, prompt, model='haiku'):
+        # Number of rows evaluated concurrently by get_output
+        if max_workers is None:
+            max_workers = int(os.getenv("CALIBRATION_CONCURRENCY", 8))
+        self.max_workers = max(1, max_workers)
+        # Row predictions are cached on disk, so repeated epochs and re-runs skip Bedrock
+        if cache is None and os.getenv("CALIBRATION_CACHE", "1") != "0":
+            cache = PredictionCache()
+        self.cache = cache
+        # Datasets are read and predicted chunk by chunk so memory stays flat for large files
+        if chunksize is None:
+            chunksize = int(os.getenv("CALIBRATION_CHUNKSIZE", 1000))
+        self.chunksize = max(1, chunksize)
+        self.num_errors = 5
+        # Rows packed into one request; batch replies that can't be parsed fall back to single-row calls
+        self.batch_size = max(1, int(os.getenv("CALIBRATION_BATCH_SIZE", 1)))
+        # Label-constrained inference: tight max_tokens and stop sequences derived from the label set,
+        # an optional assistant prefill, and retries for outputs that map to no label
+        self.label_constrained = os.getenv("CALIBRATION_LABEL_CONSTRAINED", "0") == "1"
+        self.label_prefill = os.getenv("CALIBRATION_LABEL_PREFILL", "")
+        self.label_retries = int(os.getenv("CALIBRATION_LABEL_RETRIES", 1))
+        # Successive-halving search: the share of rows the first round is scored on,
+        # and the factor by which the candidates shrink and the slices grow each round
+        self.search_min_fraction = float(os.getenv("CALIBRATION_SEARCH_MIN_FRACTION", 0.1))
+        self.search_eta = max(2, int(os.getenv("CALIBRATION_SEARCH_ETA", 2)))
+        # Sequential testing: screen candidates on growing random slices and reject
+        # them as soon as the confidence interval is clearly below the incumbent's score
+        self.sequential_test = os.getenv("CALIBRATION_SEQUENTIAL_TEST", "0") == "1"
+        self.sequential_z = float(os.getenv("CALIBRATION_SEQUENTIAL_Z", 2.576))
+        # Slices double from this share, it must be positive or the first slice would never grow
+        self.sequential_min_fraction = min(1.0, max(0.001, float(os.getenv("CALIBRATION_SEQUENTIAL_MIN_FRACTION", 0.02))))
+        # Early stopping of optimize: plateau patience (epochs, 0 disables), minimum improvement,
+        # target score and wall-clock budget in seconds (0 disables)
+        self.patience = int(os.getenv("CALIBRATION_PATIENCE", 2))
+        self.min_delta = float(os.getenv("CALIBRATION_MIN_DELTA", 0.0))
+        self.target_score = float(os.getenv("CALIBRATION_TARGET_SCORE", 1.0))
+        self.time_budget = float(os.getenv("CALIBRATION_TIME_BUDGET", 0))
+    def invoke_model(self, prompt, model='haiku', use_cache=False, max_tokens=4096, stop_sequences=None, prefill=None, stage='calibration.predict'):
         if 'haiku' in model:
             model = "anthropic.claude-3-haiku-20240307-v1:0"
         else:
@@ -44,67 +223,468 @@ class CalibrationPrompt:
                 "content":  prompt
             }
         ]
-        body = json.dumps(
-            {
-                "messages": messages,
-                "max_tokens": 4096,
-                "anthropic_version": "bedrock-2023-05-31",
-            }
-        )
+        if prefill:
+            messages.append({"role": "assistant", "content": prefill})
+        params = {
+            "max_tokens": max_tokens,
+            "anthropic_version": "bedrock-2023-05-31",
+        }
+        if stop_sequences:
+            params["stop_sequences"] = stop_sequences
+        body = {"messages": messages, **params}
         modelId = "anthropic.claude-3-haiku-20240307-v1:0"  # anthropic.claude-3-sonnet-20240229-v1:0 "anthropic.claude-3-haiku-20240307-v1:0"
-        accept = "application/json"
-        contentType = "application/json"
-
-        response = self.bedrock_client.invoke_model(
-            body=body, modelId=modelId, accept=accept, contentType=contentType
-        )
-        response_body = json.loads(response.get("body").read())
-        message = response_body["content"][0]["text"]
+
+        use_cache = use_cache and self.cache is not None
+        if use_cache:
+            cache_key = self.cache.make_key(modelId, prompt, {**params, "prefill": prefill})
+            message = self.cache.get(cache_key)
+            if message is not None:
+                return message
+        # Only calls that may be answered from the cache may share an in-flight call, the others want their own sample
+        response_body = gateway.invoke(modelId, body, coalesce=use_cache, stage=stage)
+        message = response_text(response_body)
+        if use_cache:
+            self.cache.set(cache_key, message)
         return message
-    def get_output(self, prompt, dataset, postprocess_code, return_df=False):
-        if isinstance(dataset, bytes):
-            data_io = io.BytesIO(dataset)
-            dataset = pd.read_csv(data_io)
-        exec(postprocess_code, globals())
+    def row_variables(self, row):
+        return {key: value for key, value in row.items() if key != 'label'}
+
+    def render_row(self, prompt, row):
+        return prompt.format(**self.row_variables(row))
+
+    def label_constraints(self, dataset):
+        """
+        Derive classification inference settings from the dataset's label set
+        :return: None if label-constrained inference is off or the dataset has no `label` column, otherwise a dict
+                 with `labels` (label text to label value) and the `settings` passed to invoke_model
+        """
+        if not self.label_constrained:
+            return None
+        if isinstance(dataset, pd.DataFrame):
+            if 'label' not in dataset:
+                return None
+            values = dataset['label'].unique()
+        else:
+            if isinstance(dataset, bytes):
+                dataset = io.BytesIO(dataset)
+            values = {}
+            try:
+                reader = pd.read_csv(dataset, usecols=['label'], chunksize=self.chunksize)
+            except ValueError:
+                return None
+            with reader:
+                for chunk in reader:
+                    values.update(dict.fromkeys(chunk['label'].unique()))
+        labels = {str(value).strip(): value for value in values}
+        if not labels:
+            return None
+        # A label is at most one token per byte, plus some room for whitespace and punctuation
+        settings = {'max_tokens': max(len(name.encode('utf-8')) for name in labels) + 10}
+        # Only a delimiter ends generation early: a label used as a stop sequence would also match inside
+        # other words ("no" in "not"). Outputs that are not exactly a label are retried unconstrained.
+        closing_tag = re.fullmatch(r'.*<(\w+)>\s*', self.label_prefill, re.DOTALL)
+        if self.label_prefill:
+            settings['prefill'] = self.label_prefill
+            if closing_tag:
+                settings['stop_sequences'] = [f'</{closing_tag.group(1)}>']
+        return {'labels': labels, 'settings': settings}
+
+    def match_label(self, result, constraints):
+        return constraints['labels'].get(str(result).strip())
+
+    def invoke_row(self, rendered_prompt, settings=None):
+        """
+        Call the model for a single rendered row, without postprocessing
+        :return: A tuple of (raw output, error message), one of them is None
+        """
+        try:
+            return self.invoke_model(rendered_prompt, use_cache=True, **(settings or {})), None
+        except Exception as e:
+            return None, f'{type(e).__name__}: {e}'
+
+    def postprocess_as_completed(self, postprocessor, futures):
+        """
+        Postprocess the raw outputs of model calls as they finish, a group at a time in the background,
+        so the postprocess code runs while the other calls of the chunk are still in flight
+        :param futures: Futures of (raw output, error message) tuples, see `invoke_row`
+        :return: A list of (prediction, error message) tuples aligned with `futures`
+        """
+        positions = {future: idx for idx, future in enumerate(futures)}
+        results = [None] * len(futures)
+        submitted = []
+        group = []
+        for num_done, future in enumerate(as_completed(futures), 1):
+            output, error = future.result()
+            if error is None:
+                group.append((positions[future], output))
+            else:
+                results[positions[future]] = (None, error)
+            if group and (len(group) >= self.max_workers or num_done == len(futures)):
+                submitted.append(([idx for idx, _ in group], postprocessor.submit([output for _, output in group])))
+                group = []
+        for indices, batch in submitted:
+            for idx, output in zip(indices, batch.result()):
+                results[idx] = output
+        return results
+
+    def predict_row(self, rendered_prompt, postprocessor, constraints=None, first_attempt=0):
+        """
+        Run an already rendered prompt for a single dataset row
+        :param rendered_prompt: The prompt template formatted with the row's columns
+        :param postprocessor: The Postprocessor of the run
+        :param constraints: The result of `label_constraints`, if the outputs must map to a label
+        :param first_attempt: Skip the attempts that were already made, 1 skips the constrained call
+        :return: A tuple of (prediction, error message), one of them is None
+        """
+        try:
+            if constraints is None:
+                predict = self.invoke_model(rendered_prompt, use_cache=True)
+                return postprocessor(predict), None
+            # The constrained call comes first, retries run without the tight limits
+            result = None
+            for attempt in range(first_attempt, 1 + self.label_retries):
+                settings = constraints['settings'] if attempt == 0 else {}
+                result = postprocessor(self.invoke_model(rendered_prompt, use_cache=attempt <= 1, **settings))
+                label = self.match_label(result, constraints)
+                if label is not None:
+                    return label, None
+            return result, f'Output does not map to any label: {result!r}'
+        except Exception as e:
+            return None, f'{type(e).__name__}: {e}'
+
+    def predict_batch(self, prompt, items, postprocessor, constraints=None):
+        """
+        Run the prompt for several rows in a single request
+        :param prompt: The prompt template
+        :param items: A list of (rendered prompt, variables) tuples, one per row
+        :param postprocessor: The Postprocessor of the run
+        :param constraints: The result of `label_constraints`, if the outputs must map to a label
+        :return: A list of (prediction, error message) tuples aligned with the items
+        """
+        inputs = []
+        for idx, (_, variables) in enumerate(items, 1):
+            values = '\n'.join(f'<{key}>\n{value}\n</{key}>' for key, value in variables.items())
+            inputs.append(f'<input id="{idx}">\n{values}\n</input>')
+        prompt_input = {'instruction': prompt, 'num_items': len(items), 'inputs': '\n'.join(inputs)}
+        try:
+            reply = self.invoke_model(batch_prompt.format(**prompt_input), use_cache=True, stage='calibration.predict_batch')
+            answers = dict(re.findall(r'<output id="(\d+)">(.*?)</output>', reply, re.DOTALL))
+        except Exception:
+            answers = {}
+        answered = [idx for idx in range(len(items)) if str(idx + 1) in answers]
+        processed = dict(zip(answered, postprocessor.batch([answers[str(idx + 1)].strip() for idx in answered])))
         results = []
-        for row_idx, row in dataset.iterrows():
-            label = row['label']
-            variables = {}
-            for key, value in dict(row).items():
-                if key == 'label':
+        for idx, (rendered_prompt, _) in enumerate(items):
+            result, error = processed.get(idx, (None, 'No answer in the batch reply'))
+            if error is None:
+                if constraints is None:
+                    results.append((result, None))
                     continue
-                variables[key] = value
-            predict = self.invoke_model(prompt.format(**variables))
-            result = postprocess(predict)
-            results.append(result)
-        
-        dataset['predict'] = results
-        if return_df:
-            return dataset
-        timestr = time.strftime("%Y%m%d-%H%M%S")
-        dataset.to_csv(f'temp/predict_{timestr}.csv', index=None)
-        return gr.DownloadButton(label=f'Download predict result (predict_{timestr}.csv)',value=pathlib.Path(f'temp/predict_{timestr}.csv'),visible=True)
-
-    def optimize(self, task_description, prompt, dataset, postprocess_code, step_num=3):
-        if isinstance(dataset, bytes):
-            data_io = io.BytesIO(dataset)
-            dataset = pd.read_csv(data_io)
-        cur_dataset = self.get_output(prompt, dataset, postprocess_code, return_df=True)
-        history = []
-        for _ in range(step_num):
-            step_result = self.step(task_description, prompt, dataset, postprocess_code, history)
-            prompt = step_result['cur_prompt']
-            dataset = step_result['dataset']
-            history = step_result['history']
-        return prompt.strip()
-
-    def step(self, task_description, prompt, dataset, postprocess_code, history):
-        num_errors = 5
-        mean_score = self.eval_score(dataset)
-        errors = self.extract_errors(dataset)
+                label = self.match_label(result, constraints)
+                if label is not None:
+                    results.append((label, None))
+                    continue
+            results.append(self.predict_row(rendered_prompt, postprocessor, constraints))
+        return results
+
+    def iter_dataset(self, dataset, fraction=1.0, start_fraction=0.0):
+        """
+        Yield the dataset in chunks of at most `self.chunksize` rows
+        :param dataset: A CSV file path, the raw CSV bytes or a DataFrame
+        :param fraction: If below 1.0, only yield a random subset of about this share of the rows.
+                         The subsets are nested: a row kept for a fraction is kept for every larger one.
+        :param start_fraction: Skip the rows already yielded for this smaller fraction
+        """
+        if isinstance(dataset, pd.DataFrame):
+            chunks = (dataset.iloc[start:start + self.chunksize].copy() for start in range(0, len(dataset), self.chunksize))
+        else:
+            if isinstance(dataset, bytes):
+                dataset = io.BytesIO(dataset)
+            chunks = pd.read_csv(dataset, chunksize=self.chunksize)
+        for chunk_idx, chunk in enumerate(chunks):
+            if fraction < 1.0 or start_fraction > 0.0:
+                keys = np.random.default_rng([42, chunk_idx]).random(len(chunk))
+                # A copy, the predictions are assigned to the chunk later
+                chunk = chunk[(keys >= start_fraction) & (keys < fraction)].copy()
+                if chunk.empty:
+                    continue
+            yield chunk
+
+    def predict_chunk(self, prompt, chunk, executor, postprocessor, constraints=None, checkpoint=None):
+        if checkpoint is not None:
+            chunk_key = checkpoint.make_key('predict', prompt, constraints, chunk.index.tolist())
+            saved = checkpoint.load_chunk(chunk_key)
+            if saved is not None:
+                chunk['predict'] = saved['predict'].to_numpy()
+                chunk['error'] = saved['error'].to_numpy()
+                return chunk
+        records = chunk.to_dict('records')
+        rendered = [self.render_row(prompt, row) for row in records]
+        # Duplicate rows render to the same prompt and are only sent once
+        unique_prompts = list(dict.fromkeys(rendered))
+        # executor.map yields in submission order, so predictions stay aligned with the prompts
+        if self.batch_size > 1:
+            variables = {}
+            for rendered_prompt, row in zip(rendered, records):
+                variables.setdefault(rendered_prompt, self.row_variables(row))
+            items = [(rendered_prompt, variables[rendered_prompt]) for rendered_prompt in unique_prompts]
+            batches = [items[start:start + self.batch_size] for start in range(0, len(items), self.batch_size)]
+            batch_outputs = executor.map(propagate(lambda batch: self.predict_batch(prompt, batch, postprocessor, constraints)), batches)
+            outputs = dict(zip(unique_prompts, (output for batch_output in batch_outputs for output in batch_output)))
+        else:
+            settings = constraints['settings'] if constraints is not None else None
+            invoke_row = propagate(self.invoke_row)
+            processed = self.postprocess_as_completed(
+                postprocessor, [executor.submit(invoke_row, rendered_prompt, settings) for rendered_prompt in unique_prompts])
+            if constraints is not None:
+                unmatched = []
+                for idx, (result, error) in enumerate(processed):
+                    if error is not None:
+                        continue
+                    label = self.match_label(result, constraints)
+                    if label is not None:
+                        processed[idx] = (label, None)
+                    elif self.label_retries:
+                        unmatched.append(idx)
+                    else:
+                        processed[idx] = (result, f'Output does not map to any label: {result!r}')
+                retried = executor.map(
+                    propagate(lambda idx: self.predict_row(unique_prompts[idx], postprocessor, constraints, first_attempt=1)), unmatched)
+                for idx, output in zip(unmatched, retried):
+                    processed[idx] = output
+            outputs = dict(zip(unique_prompts, processed))
+        chunk['predict'] = [outputs[rendered_prompt][0] for rendered_prompt in rendered]
+        chunk['error'] = [outputs[rendered_prompt][1] for rendered_prompt in rendered]
+        if checkpoint is not None:
+            checkpoint.save_chunk(chunk_key, chunk[['predict', 'error']])
+        return chunk
+
+    def predict_chunks(self, prompt, chunks, executor, postprocessor, constraints=None, checkpoint=None):
+        """
+        Predict the chunks in order, the model calls of the next chunk are sent while the current one
+        is being postprocessed and retried
+        :return: An iterator over the predicted chunks, see `predict_chunk`
+        """
+        predict_chunk = propagate(self.predict_chunk)
+        with ThreadPoolExecutor(max_workers=2) as pipeline:
+            pending = deque()
+            for chunk in chunks:
+                pending.append(pipeline.submit(predict_chunk, prompt, chunk, executor, postprocessor, constraints, checkpoint))
+                if len(pending) == 2:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+
+    @traced("calibration.get_output")
+    def get_output(self, prompt, dataset, postprocess_code, return_df=False):
+        # Labelled datasets are predicted with the same constraints as during evaluation
+        constraints = self.label_constraints(dataset)
+        postprocessor = Postprocessor(postprocess_code)
+        try:
+            with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+                chunks = self.predict_chunks(prompt, self.iter_dataset(dataset), executor, postprocessor, constraints)
+                if return_df:
+                    return pd.concat(list(chunks), ignore_index=True)
+                writer = ArtifactWriter()
+                for chunk in chunks:
+                    writer.write('predict', chunk)
+        finally:
+            postprocessor.close()
+        artifact_path = writer.finish()
+        return gr.DownloadButton(label=f'Download predict result ({os.path.basename(artifact_path)})',value=pathlib.Path(artifact_path),visible=True)
+
+    @traced("calibration.evaluate")
+    def evaluate(self, prompt, dataset, postprocessor, writer=None, artifact_name=None, fraction=1.0, checkpoint=None,
+                 constraints=None):
+        """
+        Stream the dataset through the prompt and keep only running statistics in memory
+        :param prompt: The prompt template to evaluate
+        :param dataset: A CSV file path, the raw CSV bytes or a DataFrame with a `label` column
+        :param postprocessor: The Postprocessor of the run
+        :param writer: If given, an ArtifactWriter the predictions are written to in the background, chunk by chunk
+        :param artifact_name: The name of the artifact holding this pass's predictions
+        :param fraction: Evaluate only a random subset of about this share of the rows
+        :param checkpoint: A RunCheckpoint that predictions are saved to, and replayed from, chunk by chunk
+        :param constraints: The result of `label_constraints`, computed once per run
+        :return: A dict with the mean score, a sample of at most `self.num_errors` errors per label,
+                 the confusion matrix and the labels seen in the dataset
+        """
+        score_func = self.get_eval_function()
+        metrics = EvaluationMetrics(self.num_errors)
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            chunks = self.iter_dataset(dataset, fraction)
+            for chunk in self.predict_chunks(prompt, chunks, executor, postprocessor, constraints, checkpoint):
+                chunk = score_func(chunk)
+                metrics.update(chunk)
+                if writer is not None:
+                    writer.write_predictions(artifact_name, chunk)
+        return {**metrics.summary(), 'artifact_name': artifact_name}
+
+    def score_interval(self, num_correct, num_rows):
+        """
+        Wilson score interval of the accuracy
+        :return: A tuple of (lower bound, upper bound)
+        """
+        if num_rows == 0:
+            return 0.0, 1.0
+        z = self.sequential_z
+        p = num_correct / num_rows
+        denominator = 1 + z ** 2 / num_rows
+        center = (p + z ** 2 / (2 * num_rows)) / denominator
+        margin = z * math.sqrt(p * (1 - p) / num_rows + z ** 2 / (4 * num_rows ** 2)) / denominator
+        return center - margin, center + margin
+
+    @traced("calibration.evaluate_sequential")
+    def evaluate_sequential(self, prompt, dataset, postprocessor, baseline_score, checkpoint=None, constraints=None):
+        """
+        Evaluate the prompt on growing random slices of the dataset and stop as soon as
+        the accuracy is clearly better or clearly worse than `baseline_score`.
+        Slices double in size, so there are only a few looks at the interval.
+        :return: The evaluation dict of `evaluate`, with a `decision` of 'better', 'worse' or 'undecided'
+        """
+        score_func = self.get_eval_function()
+        metrics = EvaluationMetrics(self.num_errors)
+        start_fraction, fraction = 0.0, self.sequential_min_fraction
+        decision = 'undecided'
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            while start_fraction < 1.0:
+                chunks = self.iter_dataset(dataset, fraction, start_fraction)
+                for chunk in self.predict_chunks(prompt, chunks, executor, postprocessor, constraints, checkpoint):
+                    metrics.update(score_func(chunk))
+                lower, upper = self.score_interval(metrics.num_correct, metrics.num_rows)
+                if lower > baseline_score:
+                    decision = 'better'
+                    break
+                if upper < baseline_score:
+                    decision = 'worse'
+                    break
+                start_fraction, fraction = fraction, min(1.0, fraction * 2)
+        return {**metrics.summary(), 'decision': decision}
+
+    @traced("calibration.successive_halving")
+    def successive_halving(self, candidates, dataset, postprocessor, writer=None, artifact_name=None, checkpoint=None,
+                           constraints=None):
+        """
+        Pick the best candidate prompt while spending few predictions on the bad ones.
+        All candidates are scored on a small random slice, only the top 1/eta of them move on
+        to a slice eta times larger, until the survivor is scored on the full dataset.
+        :param candidates: A list of candidate prompt templates
+        :return: A tuple of (best prompt, its evaluation on the full dataset)
+        """
+        fraction = self.search_min_fraction if len(candidates) > 1 else 1.0
+        while True:
+            fraction = min(1.0, fraction)
+            scored = [
+                (self.evaluate(candidate, dataset, postprocessor, writer=writer if fraction >= 1.0 else None,
+                               artifact_name=artifact_name if len(candidates) == 1 else f'{artifact_name}_candidate{idx}',
+                               fraction=fraction, checkpoint=checkpoint, constraints=constraints), candidate)
+                for idx, candidate in enumerate(candidates)
+            ]
+            scored.sort(key=lambda item: item[0]['score'], reverse=True)
+            if fraction >= 1.0:
+                return scored[0][1], scored[0][0]
+            num_keep = math.ceil(len(scored) / self.search_eta)
+            candidates = [candidate for _, candidate in scored[:num_keep]]
+            fraction = 1.0 if len(candidates) == 1 else fraction * self.search_eta
+
+    def stop_reason(self, history, score, started_at):
+        """
+        Decide whether optimize should stop before the next epoch
+        :param history: The history entries of the epochs run so far
+        :param score: The score of the current prompt, not yet in the history
+        :param started_at: The time.time() at which optimize started
+        :return: A human readable reason, or None to keep going
+        """
+        scores = [entry['score'] for entry in history.entries] + [score]
+        if score >= self.target_score:
+            return f'Reached the target score {self.target_score:.2f}'
+        if self.time_budget and time.time() - started_at >= self.time_budget:
+            return f'Exceeded the time budget of {self.time_budget:.0f}s'
+        if self.patience and len(scores) > self.patience:
+            best_before = max(scores[:-self.patience])
+            # An improvement has to beat the previous best by more than min_delta
+            if max(scores[-self.patience:]) <= best_before + self.min_delta:
+                return f'No improvement of more than {self.min_delta} in the last {self.patience} epochs'
+        return None
+
+    @traced("calibration.optimize")
+    def optimize(self, task_description, prompt, dataset, postprocess_code, step_num=3, num_candidates=1, run_id=None):
+        """
+        Iteratively improve the prompt on the labelled dataset.
+        The prompt and history are checkpointed after every epoch, and every completed chunk of predictions
+        and every analysis/suggestion call as they finish, so passing the `run_id` of an interrupted run
+        resumes it from its last epoch without repeating those calls.
+        :return: A tuple of (the final prompt, why the run stopped, a DownloadButton of the prediction artifacts)
+        """
+        started_at = time.time()
+        checkpoint = RunCheckpoint(run_id)
+        params = checkpoint.load_params()
+        if params is None:
+            if isinstance(dataset, (bytes, pd.DataFrame)):
+                # Keep a copy so the run can be resumed after the upload is gone
+                dataset_path = os.path.join(checkpoint.path, 'dataset.csv')
+                if isinstance(dataset, bytes):
+                    with open(dataset_path, 'wb') as f:
+                        f.write(dataset)
+                else:
+                    dataset.to_csv(dataset_path, index=None)
+                dataset = dataset_path
+            params = {'task_description': task_description, 'prompt': prompt, 'dataset': dataset,
+                      'postprocess_code': postprocess_code, 'step_num': step_num, 'num_candidates': num_candidates}
+            checkpoint.save_params(params)
+        task_description, prompt, dataset = params['task_description'], params['prompt'], params['dataset']
+        postprocess_code, step_num, num_candidates = params['postprocess_code'], int(params['step_num']), params['num_candidates']
+        # The label set is read once per run, not on every evaluation
+        constraints = self.label_constraints(dataset)
+        postprocessor = Postprocessor(postprocess_code)
+        writer = ArtifactWriter(os.path.join(checkpoint.path, 'predictions'))
+        history_path = os.path.join(checkpoint.path, 'history.pkl')
+        state = checkpoint.load_state()
+        history = CalibrationHistory()
+        first_epoch = 0
+        if state is not None and os.path.exists(history_path):
+            # Resume after the last completed epoch, its prompt is evaluated again from the saved chunks
+            history = CalibrationHistory.load(history_path)
+            prompt, first_epoch = state['prompt'], state['epoch']
+        try:
+            evaluation = self.evaluate(prompt, dataset, postprocessor, writer, f'predict_epoch{first_epoch}', checkpoint=checkpoint,
+                                       constraints=constraints)
+            reason = None
+            for epoch in range(first_epoch, step_num):
+                reason = self.stop_reason(history, evaluation['score'], started_at)
+                if reason:
+                    break
+                step_result = self.step(task_description, prompt, dataset, postprocessor, history, evaluation, num_candidates, checkpoint, writer,
+                                        constraints)
+                prompt = step_result['cur_prompt']
+                evaluation = step_result['evaluation']
+                history = step_result['history']
+                history.save(history_path)
+                checkpoint.save_state({
+                    'epoch': epoch + 1,
+                    'prompt': prompt,
+                    'score': evaluation['score'],
+                    'history': [{'prompt': entry['prompt'], 'score': entry['score'], 'analysis': entry['analysis'],
+                                 'confusion_matrix': entry['confusion_matrix'].tolist()} for entry in history.entries],
+                })
+            else:
+                reason = f'Finished all {step_num} epochs'
+        finally:
+            postprocessor.close()
+            artifact_path = writer.finish()
+        reason += f' (score {evaluation["score"]:.2f} after {len(history)} epochs, run ID {checkpoint.run_id})'
+        download = gr.DownloadButton(label=f'Download predict result ({os.path.basename(artifact_path)})',value=pathlib.Path(artifact_path),visible=True)
+        return prompt.strip(), reason, download
+
+    @traced("calibration.step")
+    def step(self, task_description, prompt, dataset, postprocessor, history, evaluation, num_candidates=1, checkpoint=None, writer=None,
+             constraints=None):
+        num_errors = self.num_errors
+        mean_score = evaluation['score']
+        errors = evaluation['errors']
         large_error_to_str = self.large_error_to_str(errors, num_errors)
-        history = self.add_history(dataset, task_description, history, mean_score, errors)
-        sorted_history = sorted(history, key=lambda x: x['score'],reverse=False)
+        history = self.add_history(prompt, evaluation, task_description, history, checkpoint)
+        sorted_history = sorted(history.entries, key=lambda x: x['score'],reverse=False)
         last_history = sorted_history[-3:]
         history_prompt = '\n'.join([self.sample_to_text(sample,
                                                         num_errors_per_label=num_errors,
@@ -114,30 +694,60 @@ class CalibrationPrompt:
         'error_analysis': history[-1]['analysis'],
         'failure_cases': large_error_to_str
         }
-        prompt_input["labels"] = json.dumps([str(label) for label in list(dataset['label'].unique())])
-        prompt_suggestion = self.invoke_model(step_prompt.format(**prompt_input), model='sonnet')
+        prompt_input["labels"] = json.dumps([str(label) for label in evaluation['labels']])
         pattern = r"<new_prompt>(.*?)</new_prompt>"
-        cur_prompt = re.findall(pattern, prompt_suggestion, re.DOTALL)[0]
-        cur_dataset = self.get_output(cur_prompt, dataset, postprocess_code, return_df=True)
-        score = self.eval_score(cur_dataset)
-        timestr = time.strftime("%Y%m%d-%H%M%S")
-        cur_dataset.to_csv(f'temp/predict_{timestr}.csv', index=None)
+        num_candidates = max(1, int(num_candidates))
+        suggestion_prompt = step_prompt.format(**prompt_input)
+
+        def suggest(idx):
+            if checkpoint is None:
+                return self.invoke_model(suggestion_prompt, model='sonnet', stage='calibration.suggest')
+            # The epoch is part of the key: an epoch that kept the incumbent builds the same prompt again
+            # and must sample new suggestions instead of replaying the rejected ones
+            return checkpoint.call(checkpoint.make_key('suggestion', len(history), suggestion_prompt, idx),
+                                   lambda: self.invoke_model(suggestion_prompt, model='sonnet', stage='calibration.suggest'))
+
+        with ThreadPoolExecutor(max_workers=num_candidates) as executor:
+            prompt_suggestions = list(executor.map(propagate(suggest), range(num_candidates)))
+        candidates = {}
+        for prompt_suggestion in prompt_suggestions:
+            matches = re.findall(pattern, prompt_suggestion, re.DOTALL)
+            if matches:
+                candidates.setdefault(matches[0], prompt_suggestion)
+        if not candidates:
+            raise ValueError('No <new_prompt> found in the prompt suggestions')
+        if self.sequential_test:
+            incumbent_score = history[-1]['score']
+            candidates = {candidate: suggestion for candidate, suggestion in candidates.items()
+                          if self.evaluate_sequential(candidate, dataset, postprocessor, incumbent_score, checkpoint,
+                                                      constraints)['decision'] != 'worse'}
+            if not candidates:
+                # Every candidate is clearly worse, keep the incumbent prompt for the next epoch
+                return {
+                    'cur_prompt': prompt,
+                    'score': mean_score,
+                    'explanation': '\n'.join(prompt_suggestions),
+                    'evaluation': evaluation,
+                    'history': history
+                }
+        # The surviving prompt is always confirmed on the full dataset
+        cur_prompt, cur_evaluation = self.successive_halving(list(candidates), dataset, postprocessor, writer=writer,
+                                                             artifact_name=f'predict_epoch{len(history)}', checkpoint=checkpoint,
+                                                             constraints=constraints)
         return {
             'cur_prompt': cur_prompt,
-            'score': score,
-            'explanation': prompt_suggestion,
-            'dataset': cur_dataset,
+            'score': cur_evaluation['score'],
+            'explanation': candidates[cur_prompt],
+            'evaluation': cur_evaluation,
             'history': history
         }
         
         
     def get_eval_function(self):
-        def set_function_from_iterrow(func):
-            def wrapper(dataset):
-                dataset['score'] = dataset.apply(func, axis=1)
-                return dataset
-            return wrapper
-        return set_function_from_iterrow(lambda record: record['label'] == record['predict'])
+        def wrapper(dataset):
+            dataset['score'] = (dataset['label'] == dataset['predict']).to_numpy()
+            return dataset
+        return wrapper
     def sample_to_text(self, sample: dict, num_errors_per_label: int = 0, is_score: bool = True) -> str:
         """
         Return a string that organize the information of from the step run for the meta-prompt
@@ -157,28 +767,17 @@ class CalibrationPrompt:
         :param num_large_errors_per_label: The (maximum) number of large errors per label
         :return: A string that contains the large errors that is used in the meta-prompt
         """
+        if error_df.empty:
+            return ''
         required_columns = error_df.columns.tolist()
-        label_schema = error_df['label'].unique()
-        gt_name = 'GT'
-        error_res_df_list = []
-        txt_res = ''
-        for label in label_schema:
-            cur_df = error_df[error_df['label'] == label]
-            cur_df = cur_df.sample(frac=1.0, random_state=42)[:num_large_errors_per_label]
-            error_res_df_list.append(cur_df[required_columns])
-        if len(error_res_df_list) > 0:
-            error_res_df = pd.concat(error_res_df_list, ignore_index=True)
-            error_res_df = error_res_df.sample(frac=1.0, random_state=42)
-            for i, row in error_res_df.iterrows():
-                label = row.label
-                prediction = row.predict
-                Sample = ''
-                for k,v in dict(row).items():
-                    if k in ('label', 'predict', 'score'):
-                        continue
-                    Sample += f'{k}: {v}\n'
-                Sample = Sample.strip()
-                txt_res += f"<Sample>\n{Sample}\n</Sample>\n<Prediction>\n{prediction}\n</Prediction>\n<GT>\n{label}\n</GT>\n"
+        error_res_df = error_df.sample(frac=1.0, random_state=42).groupby('label', sort=False).head(num_large_errors_per_label)
+        error_res_df = error_res_df.sample(frac=1.0, random_state=42)
+        sample_columns = [k for k in required_columns if k not in ('label', 'predict', 'score', 'error')]
+        sample = pd.Series('', index=error_res_df.index)
+        for k in sample_columns:
+            sample += f'{k}: ' + error_res_df[k].astype(str) + '\n'
+        txt_res = ('<Sample>\n' + sample.str.strip() + '\n</Sample>\n<Prediction>\n' + error_res_df['predict'].astype(str)
+                   + '\n</Prediction>\n<GT>\n' + error_res_df['label'].astype(str) + '\n</GT>\n').str.cat()
         return txt_res.strip()
 
     def eval_score(self, dataset) -> float:
@@ -191,12 +790,12 @@ class CalibrationPrompt:
         Extract the errors from the dataset
         :return: records that contains the errors
         """
-        df = dataset
-        err_df = df[df['score'] < 0.5]
-        err_df.sort_values(by=['score'])
-        return err_df
-    def add_history(self, dataset, task_description, history, mean_score, errors):
-        num_errors = 5
+        return dataset[~dataset['score'].astype(bool)]
+    @traced("calibration.add_history")
+    def add_history(self, prompt, evaluation, task_description, history, checkpoint=None):
+        num_errors = self.num_errors
+        mean_score = evaluation['score']
+        errors = evaluation['errors']
         large_error_to_str = self.large_error_to_str(errors, num_errors)
         prompt_input = {
             'task_description': task_description,
@@ -204,14 +803,19 @@ class CalibrationPrompt:
             'prompt': prompt,
             'failure_cases': large_error_to_str
             }
-        label_schema = dataset['label'].unique()
-        conf_matrix = confusion_matrix(dataset['label'], dataset['predict'], labels=label_schema)
+        label_schema = evaluation['labels']
+        conf_matrix = evaluation['confusion_matrix']
         conf_text = f"Confusion matrix columns:{label_schema} the matrix data:"
         for i, row in enumerate(conf_matrix):
             conf_text += f"\n{label_schema[i]}: {row}"
         prompt_input['confusion_matrix'] = conf_text
-        analysis = self.invoke_model(error_analysis_prompt.format(**prompt_input), model='haiku')
+        analysis_prompt = error_analysis_prompt.format(**prompt_input)
+        if checkpoint is None:
+            analysis = self.invoke_model(analysis_prompt, model='haiku', stage='calibration.analysis')
+        else:
+            analysis = checkpoint.call(checkpoint.make_key('analysis', len(history), analysis_prompt),
+                                       lambda: self.invoke_model(analysis_prompt, model='haiku', stage='calibration.analysis'))
         pattern = r"<analysis>(.*?)</analysis>"
         analysis = re.findall(pattern, analysis, re.DOTALL)[0].strip()
-        history.append({'prompt': prompt, 'score': mean_score,'errors': errors, 'confusion_matrix': conf_matrix, 'analysis': analysis})
+        history.append(prompt, evaluation, analysis)
         return history
\ No newline at end of file
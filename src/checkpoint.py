@@ -0,0 +1,101 @@
+import hashlib
+import json
+import os
+import threading
+import time
+import uuid
+
+import pandas as pd
+
+
+class RunCheckpoint:
+    """
+    On-disk state of one calibration run, stored under `<directory>/<run_id>`.
+
+    - params.json: the inputs of the run, so it can be resumed by ID
+    - state.json: a snapshot of the current prompt and history, rewritten after each epoch
+    - history.pkl: the compact CalibrationHistory the run continues from, rewritten after each epoch
+    - calls.jsonl: the text of every completed analysis/suggestion call, keyed by its epoch and input
+    - chunks/: the predictions of every completed chunk of rows
+
+    Resuming continues after the last completed epoch. Every call or chunk of the interrupted epoch
+    found here is returned instead of calling the model again.
+    """
+
+    def __init__(self, run_id=None, directory=None):
+        if directory is None:
+            directory = os.getenv("CALIBRATION_CHECKPOINT_DIR", "temp/runs")
+        # Run IDs come from the UI, never let them point outside the checkpoint directory
+        run_id = os.path.basename((run_id or "").strip())
+        if not run_id:
+            run_id = time.strftime("%Y%m%d-%H%M%S") + "-" + uuid.uuid4().hex[:8]
+        self.run_id = run_id
+        self.path = os.path.join(directory, run_id)
+        os.makedirs(os.path.join(self.path, "chunks"), exist_ok=True)
+        self._lock = threading.Lock()
+        self._calls = {}
+        calls_path = os.path.join(self.path, "calls.jsonl")
+        if os.path.exists(calls_path):
+            with open(calls_path, encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        # A partially written last line from an interrupted run
+                        continue
+                    self._calls[record["key"]] = record["value"]
+
+    @staticmethod
+    def make_key(*parts):
+        payload = json.dumps(parts, sort_keys=True, ensure_ascii=False, default=str)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def _write_json(self, name, data):
+        path = os.path.join(self.path, name)
+        with open(path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False, indent=2, default=str)
+        os.replace(path + ".tmp", path)
+
+    def _read_json(self, name):
+        path = os.path.join(self.path, name)
+        if not os.path.exists(path):
+            return None
+        with open(path, encoding="utf-8") as f:
+            return json.load(f)
+
+    def save_params(self, params):
+        self._write_json("params.json", params)
+
+    def load_params(self):
+        return self._read_json("params.json")
+
+    def save_state(self, state):
+        self._write_json("state.json", state)
+
+    def load_state(self):
+        return self._read_json("state.json")
+
+    def call(self, key, fn):
+        """
+        Return the recorded result for `key`, or run `fn` and record its result
+        """
+        with self._lock:
+            if key in self._calls:
+                return self._calls[key]
+        value = fn()
+        with self._lock:
+            self._calls[key] = value
+            with open(os.path.join(self.path, "calls.jsonl"), "a", encoding="utf-8") as f:
+                f.write(json.dumps({"key": key, "value": value}, ensure_ascii=False) + "\n")
+        return value
+
+    def load_chunk(self, key):
+        path = os.path.join(self.path, "chunks", f"{key}.pkl")
+        if not os.path.exists(path):
+            return None
+        return pd.read_pickle(path)
+
+    def save_chunk(self, key, predictions):
+        path = os.path.join(self.path, "chunks", f"{key}.pkl")
+        predictions.to_pickle(path + ".tmp")
+        os.replace(path + ".tmp", path)
@@ -0,0 +1,107 @@
+import os
+import threading
+
+import boto3
+from botocore.config import Config
+from dotenv import load_dotenv
+
+from ratelimit import rate_limit_enabled
+from simulator import (
+    RecordingBedrockClient,
+    RecordingOpenAI,
+    SimulatedBedrockClient,
+    SimulatedOpenAI,
+    llm_backend,
+)
+
+load_dotenv()
+
+_lock = threading.Lock()
+_bedrock_clients = {}
+_openai_client = None
+_openai_client_created = False
+
+
+def client_config(region_name=None):
+    """
+    The botocore config shared by every Bedrock client, read from the environment
+    """
+    return Config(
+        region_name=region_name or os.getenv("REGION_NAME"),
+        max_pool_connections=int(os.getenv("BEDROCK_MAX_POOL_CONNECTIONS", 50)),
+        connect_timeout=float(os.getenv("BEDROCK_CONNECT_TIMEOUT", 10)),
+        read_timeout=float(os.getenv("BEDROCK_READ_TIMEOUT", 300)),
+        retries={
+            # With the shared rate limiter on, it retries throttled calls instead of every client on its own
+            "max_attempts": int(os.getenv("BEDROCK_MAX_ATTEMPTS", 1 if rate_limit_enabled() else 5)),
+            "mode": os.getenv("BEDROCK_RETRY_MODE", "standard"),
+        },
+    )
+
+
+def get_bedrock_client(service_name="bedrock-runtime", region_name=None):
+    """
+    Return the process-wide Bedrock client for the service and region, creating it on first use.
+    boto3 clients are thread-safe, so every module and worker thread shares the same
+    connection pool instead of opening its own.
+    With LLM_BACKEND=replay this is the offline stand-in, with LLM_BACKEND=record a recording wrapper.
+    """
+    key = (service_name, region_name or os.getenv("REGION_NAME"))
+    client = _bedrock_clients.get(key)
+    if client is not None:
+        return client
+    with _lock:
+        if key not in _bedrock_clients:
+            if llm_backend() == "replay":
+                _bedrock_clients[key] = SimulatedBedrockClient()
+                return _bedrock_clients[key]
+            # Sessions are not thread-safe, so each client gets its own, created under the lock
+            session = boto3.Session()
+            client = session.client(service_name=service_name, config=client_config(key[1]))
+            if llm_backend() == "record":
+                client = RecordingBedrockClient(client)
+            _bedrock_clients[key] = client
+        return _bedrock_clients[key]
+
+
+def openai_client_kwargs():
+    """
+    The OpenAI client options shared by the sync and async clients, read from the environment
+    """
+    import httpx
+
+    return {
+        "base_url": os.getenv("OPENAI_BASE_URL") or None,
+        "api_key": os.getenv("OPENAI_API_KEY"),
+        "timeout": float(os.getenv("OPENAI_TIMEOUT", 300)),
+        "max_retries": int(os.getenv("OPENAI_MAX_RETRIES", 0 if rate_limit_enabled() else 2)),
+        "limits": httpx.Limits(max_connections=int(os.getenv("OPENAI_MAX_CONNECTIONS", 50))),
+    }
+
+
+def get_openai_client():
+    """
+    Return the process-wide OpenAI client, or None if it can't be created (e.g. no API key)
+    """
+    global _openai_client, _openai_client_created
+    if _openai_client_created:
+        return _openai_client
+    with _lock:
+        if not _openai_client_created:
+            if llm_backend() == "replay":
+                _openai_client = SimulatedOpenAI()
+                _openai_client_created = True
+                return _openai_client
+            import httpx
+            from openai import OpenAI
+
+            try:
+                kwargs = openai_client_kwargs()
+                kwargs["http_client"] = httpx.Client(limits=kwargs.pop("limits"))
+                _openai_client = OpenAI(**kwargs)
+                if llm_backend() == "record":
+                    _openai_client = RecordingOpenAI(_openai_client)
+            except Exception:
+                _openai_client = None
+            _openai_client_created = True
+        return _openai_client
@@ -0,0 +1,538 @@
+import asyncio
+import json
+import os
+import threading
+import weakref
+
+from cache import ResponseCache
+from clients import (
+    client_config,
+    get_bedrock_client,
+    get_openai_client,
+    openai_client_kwargs,
+)
+from metrics import track
+from ratelimit import estimate_tokens, get_rate_limiter
+from simulator import AsyncSimulatedBedrockClient, AsyncSimulatedOpenAI, llm_backend
+from singleflight import SingleFlight
+
+try:
+    from aiobotocore.session import get_session
+except ImportError:
+    get_session = None
+
+ANTHROPIC_VERSION = "bedrock-2023-05-31"
+# Model id substrings of the Anthropic models Bedrock prompt caching is available for
+PROMPT_CACHE_MODELS = ("claude-3-5-haiku", "claude-3-7-sonnet", "claude-sonnet-4", "claude-opus-4", "claude-haiku-4")
+# Shorter prefixes are not cached by Bedrock, the markers would only cost a cache write
+MIN_CACHEABLE_TOKENS = 1024
+
+
+def bedrock_body(messages, system=None, max_tokens=4096, **params):
+    """
+    Build an Anthropic messages request body for Bedrock
+    """
+    body = {
+        "anthropic_version": ANTHROPIC_VERSION,
+        "messages": messages,
+        "max_tokens": max_tokens,
+        **params,
+    }
+    if system:
+        body["system"] = system
+    return body
+
+
+def prompt_cache_enabled(model_id):
+    """
+    Whether requests to the model mark their static prefix for Bedrock prompt caching.
+    LLM_PROMPT_CACHE_MODELS overrides the supported models, as comma separated model id substrings.
+    """
+    if os.getenv("LLM_PROMPT_CACHE", "1") == "0":
+        return False
+    models = os.getenv("LLM_PROMPT_CACHE_MODELS")
+    patterns = PROMPT_CACHE_MODELS if models is None else [model.strip() for model in models.split(",") if model.strip()]
+    return any(pattern in model_id for pattern in patterns)
+
+
+def cacheable_content(model_id, prefix, suffix):
+    """
+    The content of a user message made of a static prefix, shared by every request of a kind
+    (e.g. the prompt guide), and the variable suffix of this request.
+    The prefix is marked as a prompt cache checkpoint if the model supports it, so Bedrock only
+    processes the suffix on later requests. Otherwise the content is the plain text.
+    """
+    if not prompt_cache_enabled(model_id) or estimate_tokens(prefix) < MIN_CACHEABLE_TOKENS:
+        return prefix + "\n\n" + suffix
+    return [
+        {"type": "text", "text": prefix, "cache_control": {"type": "ephemeral"}},
+        {"type": "text", "text": suffix},
+    ]
+
+
+def response_text(response_body):
+    """
+    The text of the first content block of a Bedrock response, '' if the model returned none
+    """
+    content = response_body.get("content") or []
+    return content[0]["text"] if content else ""
+
+
+def native_async(backend="bedrock"):
+    """
+    Whether async calls run natively on the event loop, otherwise the blocking client runs in a thread.
+    Recording wraps the blocking clients only.
+    """
+    if llm_backend() == "replay":
+        return True
+    if llm_backend() == "record":
+        return False
+    return backend == "openai" or get_session is not None
+
+
+def bedrock_tokens(body):
+    return estimate_tokens(body.get("messages"), body.get("system"))
+
+
+def bedrock_usage(response_body):
+    usage = response_body.get("usage")
+    if not usage:
+        return None
+    return usage.get("input_tokens", 0) + usage.get("output_tokens", 0)
+
+
+def openai_usage(completion):
+    usage = getattr(completion, "usage", None)
+    return usage.total_tokens if usage else None
+
+
+def bedrock_token_counts(response_body):
+    usage = response_body.get("usage") or {}
+    return usage.get("input_tokens"), usage.get("output_tokens")
+
+
+def bedrock_cache_counts(usage):
+    """
+    :return: (prompt tokens read from the prompt cache, prompt tokens written to it)
+    """
+    usage = usage or {}
+    return usage.get("cache_read_input_tokens"), usage.get("cache_creation_input_tokens")
+
+
+def openai_token_counts(completion):
+    usage = getattr(completion, "usage", None)
+    return (usage.prompt_tokens, usage.completion_tokens) if usage else (None, None)
+
+
+def retry_attempts(response):
+    """
+    The retries botocore made on its own before returning `response`
+    """
+    metadata = response.get("ResponseMetadata") if isinstance(response, dict) else None
+    return (metadata or {}).get("RetryAttempts", 0)
+
+
+def observe_stream_event(record, event):
+    """
+    Record the first token and the usage carried by an Anthropic stream event
+    """
+    if event.get("type") == "message_start":
+        usage = event.get("message", {}).get("usage", {})
+        record.input_tokens = usage.get("input_tokens")
+        record.prompt_cache(*bedrock_cache_counts(usage))
+    elif event.get("type") == "content_block_delta":
+        record.first_token()
+    elif event.get("type") == "message_delta":
+        record.output_tokens = event.get("usage", {}).get("output_tokens")
+
+
+def should_coalesce(coalesce, deterministic, temperature):
+    """
+    Whether a call may share the response of an identical call in flight. Sampled calls want their own
+    response, so by default only calls that would get the same answer anyway are coalesced.
+    """
+    if coalesce is not None:
+        return coalesce
+    return deterministic or temperature == 0
+
+
+class LLMGateway:
+    """
+    The single entry point for model calls, for Bedrock (Anthropic messages) and OpenAI-compatible backends.
+
+    `invoke`/`chat` are blocking, for code that already runs in worker threads.
+    `ainvoke`/`achat`/`complete`/`stream` are native coroutines: Bedrock goes through aiobotocore and
+    OpenAI through AsyncOpenAI, so one event loop can keep hundreds of requests in flight without a
+    thread per request. Async clients are bound to the event loop that created them, so one set is kept per loop.
+
+    Every call waits for its model's rate limiter (see ratelimit.py), which also retries throttled requests.
+    Identical deterministic or temperature 0 requests in flight at the same time, from any thread or event loop,
+    share one upstream call. Sampled calls get their own response unless they pass `coalesce=True`.
+    Calls marked `deterministic=True` are answered from a memory + disk response cache when possible.
+
+    Each call is measured (latency, time to first token, tokens, retries, see metrics.py)
+    under the `stage` its caller names, e.g. "guide_based.rewrite".
+    """
+
+    def __init__(self):
+        self.single_flight = SingleFlight()
+        self.coalesce = os.getenv("LLM_COALESCE", "1") != "0"
+        self.use_cache = os.getenv("LLM_RESPONSE_CACHE", "1") != "0"
+        self._cache = None
+        self._cache_lock = threading.Lock()
+        self._bedrock_clients = weakref.WeakKeyDictionary()
+        self._openai_clients = weakref.WeakKeyDictionary()
+
+    @property
+    def cache(self):
+        if self._cache is None:
+            with self._cache_lock:
+                if self._cache is None:
+                    self._cache = ResponseCache()
+        return self._cache
+
+    def _cached(self, deterministic, key, fn, record):
+        """
+        Return the cached response of a deterministic call, or run `fn` and cache what it returns
+        """
+        if not (deterministic and self.use_cache):
+            return fn()
+        cache_key = ResponseCache.make_key(*key)
+        value = self.cache.get(cache_key)
+        if value is not None:
+            record.source = "cache"
+            return json.loads(value)
+        result = fn()
+        self.cache.set(cache_key, json.dumps(result, ensure_ascii=False))
+        return result
+
+    async def _acached(self, deterministic, key, fn, record):
+        if not (deterministic and self.use_cache):
+            return await fn()
+        cache_key = ResponseCache.make_key(*key)
+        value = self.cache.get(cache_key)
+        if value is not None:
+            record.source = "cache"
+            return json.loads(value)
+        result = await fn()
+        self.cache.set(cache_key, json.dumps(result, ensure_ascii=False))
+        return result
+
+    def _coalesced(self, coalesce, key, fn):
+        if not (coalesce and self.coalesce):
+            return fn()
+        return self.single_flight.do(SingleFlight.make_key(*key), fn)
+
+    async def _acoalesced(self, coalesce, key, fn):
+        if not (coalesce and self.coalesce):
+            return await fn()
+        return await self.single_flight.ado(SingleFlight.make_key(*key), fn)
+
+    def _limited(self, model_id, estimated_tokens, fn, record, usage=None):
+        limiter = get_rate_limiter(model_id)
+        if limiter is None:
+            return fn()
+        return limiter.call(fn, estimated_tokens, usage, record.retry)
+
+    def _charge_output(self, model_id, record):
+        # Streamed output tokens are only known once the stream ends
+        limiter = get_rate_limiter(model_id)
+        if limiter is not None and record.output_tokens:
+            limiter.charge(record.output_tokens)
+
+    async def _alimited(self, model_id, estimated_tokens, fn, record, usage=None):
+        limiter = get_rate_limiter(model_id)
+        if limiter is None:
+            return await fn()
+        return await limiter.acall(fn, estimated_tokens, usage, record.retry)
+
+    def invoke(self, model_id, body, coalesce=None, deterministic=False, stage=None, **kwargs):
+        """
+        Call Bedrock invoke_model
+        :param body: The request body as a dict
+        :param coalesce: Share the call with identical requests in flight,
+                         by default only if it is deterministic or runs at temperature 0
+        :param deterministic: The same request may be answered with the same response, so it is cached
+        :param stage: The pipeline stage the call is measured under
+        :return: The parsed response body, shared with the coalesced callers so it must not be modified
+        """
+        with track("bedrock", model_id, "invoke", stage) as record:
+            def call():
+                response = get_bedrock_client().invoke_model(
+                    body=json.dumps(body),
+                    modelId=model_id,
+                    accept="application/json",
+                    contentType="application/json",
+                    **kwargs,
+                )
+                response_body = json.loads(response.get("body").read())
+                record.upstream(*bedrock_token_counts(response_body), retries=retry_attempts(response))
+                record.prompt_cache(*bedrock_cache_counts(response_body.get("usage")))
+                return response_body
+
+            key = ("bedrock", model_id, body, kwargs)
+            coalesce = should_coalesce(coalesce, deterministic, body.get("temperature"))
+            return self._cached(
+                deterministic,
+                key,
+                lambda: self._coalesced(
+                    coalesce, key, lambda: self._limited(model_id, bedrock_tokens(body), call, record, bedrock_usage)
+                ),
+                record,
+            )
+
+    def invoke_stream(self, model_id, body, stage=None):
+        """
+        Call Bedrock invoke_model_with_response_stream
+        :return: An iterator over the parsed stream events
+        """
+        with track("bedrock", model_id, "invoke_stream", stage) as record:
+            response = self._limited(
+                model_id,
+                bedrock_tokens(body),
+                lambda: get_bedrock_client().invoke_model_with_response_stream(modelId=model_id, body=json.dumps(body)),
+                record,
+            )
+            record.upstream(retries=retry_attempts(response))
+            for event in response.get("body") or []:
+                chunk = event.get("chunk")
+                if chunk:
+                    payload = json.loads(chunk.get("bytes").decode())
+                    observe_stream_event(record, payload)
+                    yield payload
+            self._charge_output(model_id, record)
+
+    def chat(self, model_id, messages, coalesce=None, deterministic=False, stage=None, **params):
+        """
+        Call an OpenAI-compatible chat completion endpoint
+        :return: The message content of the first choice
+        """
+        key = ("openai", model_id, messages, params)
+        coalesce = should_coalesce(coalesce, deterministic, params.get("temperature"))
+        with track("openai", model_id, "chat", stage) as record:
+            def call():
+                completion = self._limited(
+                    model_id,
+                    estimate_tokens(messages),
+                    lambda: get_openai_client().chat.completions.create(model=model_id, messages=messages, **params),
+                    record,
+                    openai_usage,
+                )
+                record.upstream(*openai_token_counts(completion))
+                return completion.choices[0].message.content
+
+            return self._cached(deterministic, key, lambda: self._coalesced(coalesce, key, call), record)
+
+    def chat_stream(self, model_id, messages, stage=None, **params):
+        """
+        Stream an OpenAI-compatible chat completion
+        :return: An iterator over the content deltas
+        """
+        with track("openai", model_id, "chat_stream", stage) as record:
+            stream = self._limited(
+                model_id,
+                estimate_tokens(messages),
+                lambda: get_openai_client().chat.completions.create(model=model_id, messages=messages, stream=True, **params),
+                record,
+            )
+            record.upstream()
+            for chunk in stream:
+                if chunk.choices and chunk.choices[0].delta.content is not None:
+                    record.first_token()
+                    yield chunk.choices[0].delta.content
+
+    async def _bedrock_client(self):
+        loop = asyncio.get_running_loop()
+        task = self._bedrock_clients.get(loop)
+        if task is None:
+            task = loop.create_task(self._create_bedrock_client())
+            self._bedrock_clients[loop] = task
+        return (await asyncio.shield(task))[1]
+
+    @staticmethod
+    async def _create_bedrock_client():
+        if llm_backend() == "replay":
+            return None, AsyncSimulatedBedrockClient()
+        context = get_session().create_client("bedrock-runtime", config=client_config())
+        return context, await context.__aenter__()
+
+    def _openai_client(self):
+        loop = asyncio.get_running_loop()
+        if loop not in self._openai_clients and llm_backend() == "replay":
+            self._openai_clients[loop] = AsyncSimulatedOpenAI()
+        if loop not in self._openai_clients:
+            import httpx
+            from openai import AsyncOpenAI
+
+            try:
+                kwargs = openai_client_kwargs()
+                kwargs["http_client"] = httpx.AsyncClient(limits=kwargs.pop("limits"))
+                client = AsyncOpenAI(**kwargs)
+            except Exception:
+                client = None
+            self._openai_clients[loop] = client
+        return self._openai_clients[loop]
+
+    async def ainvoke(self, model_id, body, coalesce=None, deterministic=False, stage=None, **kwargs):
+        """
+        Async version of `invoke`
+        """
+        if not native_async():
+            # Without aiobotocore the blocking client runs in the default thread pool
+            return await asyncio.to_thread(self.invoke, model_id, body, coalesce, deterministic, stage, **kwargs)
+
+        with track("bedrock", model_id, "invoke", stage) as record:
+            async def call():
+                client = await self._bedrock_client()
+                response = await client.invoke_model(
+                    body=json.dumps(body),
+                    modelId=model_id,
+                    accept="application/json",
+                    contentType="application/json",
+                    **kwargs,
+                )
+                async with response["body"] as stream:
+                    response_body = json.loads(await stream.read())
+                record.upstream(*bedrock_token_counts(response_body), retries=retry_attempts(response))
+                record.prompt_cache(*bedrock_cache_counts(response_body.get("usage")))
+                return response_body
+
+            key = ("bedrock", model_id, body, kwargs)
+            coalesce = should_coalesce(coalesce, deterministic, body.get("temperature"))
+            return await self._acached(
+                deterministic,
+                key,
+                lambda: self._acoalesced(
+                    coalesce, key, lambda: self._alimited(model_id, bedrock_tokens(body), call, record, bedrock_usage)
+                ),
+                record,
+            )
+
+    async def ainvoke_stream(self, model_id, body, stage=None):
+        """
+        Async version of `invoke_stream`
+        """
+        if not native_async():
+            for event in await asyncio.to_thread(lambda: list(self.invoke_stream(model_id, body, stage))):
+                yield event
+            return
+
+        async def call():
+            client = await self._bedrock_client()
+            return await client.invoke_model_with_response_stream(modelId=model_id, body=json.dumps(body))
+
+        with track("bedrock", model_id, "invoke_stream", stage) as record:
+            response = await self._alimited(model_id, bedrock_tokens(body), call, record)
+            record.upstream(retries=retry_attempts(response))
+            async for event in response["body"]:
+                chunk = event.get("chunk")
+                if chunk:
+                    payload = json.loads(chunk.get("bytes").decode())
+                    observe_stream_event(record, payload)
+                    yield payload
+            self._charge_output(model_id, record)
+
+    async def achat(self, model_id, messages, coalesce=None, deterministic=False, stage=None, **params):
+        """
+        Async version of `chat`
+        """
+        if not native_async("openai"):
+            return await asyncio.to_thread(self.chat, model_id, messages, coalesce, deterministic, stage, **params)
+        client = self._openai_client()
+        if client is None:
+            raise RuntimeError("The OpenAI client could not be created, check OPENAI_API_KEY")
+        key = ("openai", model_id, messages, params)
+        coalesce = should_coalesce(coalesce, deterministic, params.get("temperature"))
+
+        with track("openai", model_id, "chat", stage) as record:
+            async def call():
+                completion = await self._alimited(
+                    model_id,
+                    estimate_tokens(messages),
+                    lambda: client.chat.completions.create(model=model_id, messages=messages, **params),
+                    record,
+                    openai_usage,
+                )
+                record.upstream(*openai_token_counts(completion))
+                return completion.choices[0].message.content
+
+            return await self._acached(deterministic, key, lambda: self._acoalesced(coalesce, key, call), record)
+
+    async def achat_stream(self, model_id, messages, stage=None, **params):
+        """
+        Async version of `chat_stream`
+        """
+        if not native_async("openai"):
+            for text in await asyncio.to_thread(lambda: list(self.chat_stream(model_id, messages, stage, **params))):
+                yield text
+            return
+        client = self._openai_client()
+        if client is None:
+            raise RuntimeError("The OpenAI client could not be created, check OPENAI_API_KEY")
+        with track("openai", model_id, "chat_stream", stage) as record:
+            stream = await self._alimited(
+                model_id,
+                estimate_tokens(messages),
+                lambda: client.chat.completions.create(model=model_id, messages=messages, stream=True, **params),
+                record,
+            )
+            record.upstream()
+            async for chunk in stream:
+                if chunk.choices and chunk.choices[0].delta.content is not None:
+                    record.first_token()
+                    yield chunk.choices[0].delta.content
+
+    async def complete(self, model_id, messages, system=None, backend="bedrock", coalesce=None, deterministic=False, stage=None,
+                       **params):
+        """
+        Complete a conversation
+        :param messages: A list of {"role", "content"} messages
+        :param backend: "bedrock" for Anthropic models on Bedrock, "openai" for OpenAI-compatible endpoints
+        :return: The text of the reply
+        """
+        if backend == "openai":
+            if system:
+                messages = [{"role": "system", "content": system}] + messages
+            return await self.achat(model_id, messages, coalesce=coalesce, deterministic=deterministic, stage=stage, **params)
+        return response_text(
+            await self.ainvoke(
+                model_id,
+                bedrock_body(messages, system=system, **params),
+                coalesce=coalesce,
+                deterministic=deterministic,
+                stage=stage,
+            )
+        )
+
+    async def stream(self, model_id, messages, system=None, backend="bedrock", stage=None, **params):
+        """
+        Like `complete`, but yield the reply text as it is generated
+        """
+        if backend == "openai":
+            if system:
+                messages = [{"role": "system", "content": system}] + messages
+            async for text in self.achat_stream(model_id, messages, stage=stage, **params):
+                yield text
+            return
+        async for event in self.ainvoke_stream(model_id, bedrock_body(messages, system=system, **params), stage=stage):
+            if event.get("type") == "content_block_delta":
+                text = event.get("delta", {}).get("text")
+                if text:
+                    yield text
+
+    async def aclose(self):
+        """
+        Close the async clients of the running event loop
+        """
+        loop = asyncio.get_running_loop()
+        task = self._bedrock_clients.pop(loop, None)
+        if task is not None:
+            context, client = await task
+            if context is not None:
+                await context.__aexit__(None, None, None)
+        client = self._openai_clients.pop(loop, None)
+        if client is not None:
+            await client.close()
+
+
+gateway = LLMGateway()
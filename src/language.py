@@ -0,0 +1,155 @@
+import os
+import re
+import unicodedata
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Function words of the Latin-script languages told apart from English
+STOPWORDS = {
+    "en": set("""
+        the of and to a in is that for it as with be on are this by or from at an not you your will should
+        if can which when each what all any has have do does was were but into than then there these those
+        their they them its must only about also may use using given following below above please
+        """.split()),
+    "fr": set("""
+        le la les des du de un une et est que qui dans pour pas sur au aux avec ce cette ces sont vous votre
+        il elle nous ils être par plus ou mais où si leur leurs
+        """.split()),
+    "es": set("""
+        el la los las de del y que en un una es por con para no se su sus al lo como más pero sin sobre este
+        esta estos usted ser son hay o
+        """.split()),
+    "de": set("""
+        der die das und ist nicht ein eine zu den dem des mit sich auf für von im ich sie es wird werden oder
+        auch als wie bei aus nach einer einem dass sind
+        """.split()),
+    "pt": set("""
+        o a os as de do da dos das e que em um uma é para com não por se na no mais mas como ao seu sua ou
+        você são
+        """.split()),
+    "it": set("""
+        il lo la gli le di del della e che è un una per non con da in su sono come anche più ma ed questo
+        questa si
+        """.split()),
+    "nl": set("""
+        de het een en van is dat op te zijn met voor niet aan er ook als bij door of maar om uit wordt worden
+        """.split()),
+}
+
+# Only the words that belong to a single language are evidence
+DISTINCT_STOPWORDS = {
+    lang: {word for word in words if sum(word in other for other in STOPWORDS.values()) == 1}
+    for lang, words in STOPWORDS.items()
+}
+
+# Letters outside ASCII that English text does not use
+NON_ENGLISH_LATIN = re.compile(r"[à-öø-ÿœßñçãõáéíóúâêîôûäëïöüåæ]", re.IGNORECASE)
+IGNORED = re.compile(r"\{\{.*?\}\}|\{\$?[A-Za-z_][\w]*\}|<[^<>]{1,80}>|https?://\S+|`[^`]*`")
+WORD = re.compile(r"[^\W\d_]+", re.UNICODE)
+
+
+def script(char):
+    """
+    The writing system of a letter: han, kana, hangul, latin, cyrillic, arabic, ... or None
+    """
+    code = ord(char)
+    if 0x4E00 <= code <= 0x9FFF or 0x3400 <= code <= 0x4DBF or 0xF900 <= code <= 0xFAFF or 0x20000 <= code <= 0x2FA1F:
+        return "han"
+    if 0x3040 <= code <= 0x30FF or 0x31F0 <= code <= 0x31FF:
+        return "kana"
+    if 0xAC00 <= code <= 0xD7AF or 0x1100 <= code <= 0x11FF or 0x3130 <= code <= 0x318F:
+        return "hangul"
+    if not char.isalpha():
+        return None
+    if code < 0x250:
+        return "latin"
+    try:
+        return unicodedata.name(char).split()[0].lower()
+    except ValueError:
+        return None
+
+
+SCRIPT_LANGUAGES = {"cyrillic": "ru", "arabic": "ar", "hebrew": "he", "greek": "el", "thai": "th", "devanagari": "hi"}
+# ISO 639 "undetermined", for the scripts not listed above
+UNDETERMINED = "und"
+
+
+class LanguageDetector:
+    """
+    Guesses the language of a prompt locally from its Unicode scripts and word statistics, in microseconds.
+
+    CJK characters are counted one by one and other scripts word by word, the dominant script decides
+    between Chinese ("ch", as the model is asked to answer), Japanese, Korean and the alphabets.
+    Latin-script text is then scored on the function words of English and the common European languages.
+    Template variables, XML tags, URLs and inline code are ignored.
+    """
+
+    def __init__(self, min_units=None):
+        # Below this many characters/words the guess loses confidence
+        self.min_units = int(min_units or os.getenv("LANG_DETECT_MIN_UNITS", 6))
+
+    def detect(self, text):
+        """
+        :return: (language code, confidence between 0 and 1), ("", 0.0) if the text has no letters
+        """
+        text = IGNORED.sub(" ", text or "")
+        units = {}
+        for char in text:
+            name = script(char)
+            if name in ("han", "kana", "hangul"):
+                units[name] = units.get(name, 0) + 1
+        words = WORD.findall(text)
+        for word in words:
+            name = script(word[0])
+            if name not in (None, "han", "kana", "hangul"):
+                units[name] = units.get(name, 0) + 1
+        total = sum(units.values())
+        if not total:
+            return "", 0.0
+        cjk = units.get("han", 0) + units.get("kana", 0)
+        if cjk >= max(units.get(name, 0) for name in units):
+            # Japanese mixes kana into the Han characters, Chinese has none
+            lang = "ja" if units.get("kana", 0) >= 0.1 * cjk else "ch"
+            share = cjk / total
+        else:
+            name = max(units, key=units.get)
+            share = units[name] / total
+            if name == "latin":
+                lang, word_confidence = self.latin_language([word.lower() for word in words if script(word[0]) == "latin"])
+                share *= word_confidence
+            else:
+                lang = "ko" if name == "hangul" else SCRIPT_LANGUAGES.get(name, UNDETERMINED)
+        return lang, round(share * min(1.0, total / self.min_units), 3)
+
+    def latin_language(self, words):
+        """
+        :return: (language code, confidence) of lowercase Latin-script words
+        """
+        scores = {lang: sum(word in stopwords for word in words) for lang, stopwords in DISTINCT_STOPWORDS.items()}
+        accented = sum(bool(NON_ENGLISH_LATIN.search(word)) for word in words)
+        scores["en"] = max(0, scores["en"] - 2 * accented)
+        ranked = sorted(scores.items(), key=lambda item: item[1], reverse=True)
+        (best, best_score), (_, second_score) = ranked[0], ranked[1]
+        if best_score == 0:
+            return "en", 0.0
+        # The lead over the runner-up, discounted while only a couple of function words were seen
+        return best, (best_score - second_score) / best_score * min(1.0, (best_score + 1) / 3)
+
+
+_detector = None
+
+
+def get_language_detector():
+    global _detector
+    if _detector is None:
+        _detector = LanguageDetector()
+    return _detector
+
+
+def detect_language(text):
+    """
+    :return: (language code, confidence) of `text`, see LanguageDetector
+    """
+    return get_language_detector().detect(text)
@@ -1,11 +1,11 @@
-import json
 import os
 import re
 
-import boto3
-from botocore.config import Config
 from dotenv import load_dotenv
 
+from gateway import cacheable_content, gateway
+from tracing import traced
+
 load_dotenv()
 
 
@@ -21,53 +21,45 @@ class MetaPrompt:
         with open(prompt_guide_path, "r") as f:
             self.metaprompt = f.read()
 
-        region_name = os.getenv("REGION_NAME")
-        session = boto3.Session()
-        retry_config = Config(
-            region_name=region_name,
-            retries={
-                "max_attempts": 5,
-                "mode": "standard",
-            },
-        )
-        service_name = "bedrock-runtime"
-        self.bedrock_client = session.client(
-            service_name=service_name, config=retry_config
-        )
-
+    @traced("metaprompt.generate")
     def __call__(self, task, variables):
+        return self._metaprompt_result(gateway.invoke(*self._metaprompt_request(task, variables), deterministic=True, stage="metaprompt"))
+
+    @traced("metaprompt.generate")
+    async def acall(self, task, variables):
+        return self._metaprompt_result(await gateway.ainvoke(*self._metaprompt_request(task, variables), deterministic=True, stage="metaprompt"))
+
+    def _metaprompt_request(self, task, variables):
         variables = variables.split("\n")
         variables = [variable for variable in variables if len(variable)]
 
         variable_string = ""
         for variable in variables:
             variable_string += "\n{$" + variable.upper() + "}"
-        prompt = self.metaprompt.replace("{{TASK}}", task)
+        # Everything before the task is the same for every request and can be cached
+        prefix, suffix = self.metaprompt.rsplit("<Task>", 1)
         assistant_partial = "<Inputs>"
         if variable_string:
             assistant_partial += (
                 variable_string + "\n</Inputs>\n<Instructions Structure>"
             )
+        modelId = "anthropic.claude-3-haiku-20240307-v1:0"  # anthropic.claude-3-sonnet-20240229-v1:0 "anthropic.claude-3-haiku-20240307-v1:0"
         messages = [
-            {"role": "user", "content": prompt},
+            {
+                "role": "user",
+                "content": cacheable_content(modelId, prefix.strip(), "<Task>" + suffix.replace("{{TASK}}", task)),
+            },
             {"role": "assistant", "content": assistant_partial},
         ]
-        body = json.dumps(
-            {
-                "messages": messages,
-                "max_tokens": 4096,
-                "temperature": 0.0,
-                "anthropic_version": "bedrock-2023-05-31",
-            }
-        )
-        modelId = "anthropic.claude-3-haiku-20240307-v1:0"  # anthropic.claude-3-sonnet-20240229-v1:0 "anthropic.claude-3-haiku-20240307-v1:0"
-        accept = "application/json"
-        contentType = "application/json"
-
-        response = self.bedrock_client.invoke_model(
-            body=body, modelId=modelId, accept=accept, contentType=contentType
-        )
-        response_body = json.loads(response.get("body").read())
+        body = {
+            "messages": messages,
+            "max_tokens": 4096,
+            "temperature": 0.0,
+            "anthropic_version": "bedrock-2023-05-31",
+        }
+        return modelId, body
+
+    def _metaprompt_result(self, response_body):
         message = response_body["content"][0]["text"]
 
         def pretty_print(message):
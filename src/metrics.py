@@ -0,0 +1,326 @@
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from dotenv import load_dotenv
+
+from tracing import KIND_CLIENT, start_span
+
+load_dotenv()
+
+logger = logging.getLogger("llm.metrics")
+
+# USD per 1000 input and output tokens, LLM_PRICES overrides or extends them.
+# Prompt cache writes cost 25% more than input tokens, cache reads 90% less.
+DEFAULT_PRICES = {
+    "anthropic.claude-3-haiku-20240307-v1:0": {"input": 0.00025, "output": 0.00125},
+    "anthropic.claude-3-sonnet-20240229-v1:0": {"input": 0.003, "output": 0.015},
+    "anthropic.claude-3-5-sonnet-20240620-v1:0": {"input": 0.003, "output": 0.015},
+    "gpt-4o": {"input": 0.005, "output": 0.015},
+}
+CACHE_WRITE_PRICE = 1.25
+CACHE_READ_PRICE = 0.1
+LATENCY_BUCKETS = (0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 20.0, 30.0, 60.0, 120.0)
+
+
+def metrics_enabled():
+    return os.getenv("LLM_METRICS", "1") != "0"
+
+
+def model_price(model_id):
+    prices = {**DEFAULT_PRICES, **json.loads(os.getenv("LLM_PRICES") or "{}")}
+    return prices.get(model_id)
+
+
+class CallMetrics:
+    """
+    The measurements of one model call, filled in by the gateway while the call runs.
+
+    `source` is "upstream" when the call reached the model, "cache" when it was answered from the
+    response cache and "coalesced" when it shared the result of an identical call in flight.
+    Tokens are only known for upstream calls, the others cost nothing.
+    """
+
+    def __init__(self, backend, model_id, operation, stage=None):
+        self.backend = backend
+        self.model_id = model_id
+        self.operation = operation
+        self.stage = stage or "unknown"
+        self.source = "coalesced"
+        self.started_at = time.time()
+        self.start = time.perf_counter()
+        self.latency = None
+        self.time_to_first_token = None
+        self.input_tokens = None
+        self.output_tokens = None
+        self.cache_read_tokens = None
+        self.cache_write_tokens = None
+        self.retries = 0
+        self.error = None
+
+    def first_token(self):
+        if self.time_to_first_token is None:
+            self.time_to_first_token = time.perf_counter() - self.start
+
+    def upstream(self, input_tokens=None, output_tokens=None, retries=0):
+        """
+        Record the usage of the request that reached the model
+        """
+        self.source = "upstream"
+        self.retries += retries
+        if input_tokens is not None:
+            self.input_tokens = input_tokens
+        if output_tokens is not None:
+            self.output_tokens = output_tokens
+
+    def prompt_cache(self, read_tokens=None, write_tokens=None):
+        """
+        Record the prompt tokens read from and written to the provider's prompt cache,
+        on top of the uncached `input_tokens`
+        """
+        if read_tokens is not None:
+            self.cache_read_tokens = read_tokens
+        if write_tokens is not None:
+            self.cache_write_tokens = write_tokens
+
+    def retry(self, kind=None):
+        self.retries += 1
+
+    @property
+    def cost(self):
+        price = model_price(self.model_id)
+        if price is None or self.input_tokens is None:
+            return None
+        input_cost = price["input"] * (
+            self.input_tokens
+            + (self.cache_write_tokens or 0) * CACHE_WRITE_PRICE
+            + (self.cache_read_tokens or 0) * CACHE_READ_PRICE
+        )
+        return (input_cost + (self.output_tokens or 0) * price["output"]) / 1000
+
+    def span_attributes(self):
+        """
+        The call as OpenTelemetry GenAI span attributes
+        """
+        return {
+            "gen_ai.system": "aws.bedrock" if self.backend == "bedrock" else self.backend,
+            "gen_ai.operation.name": self.operation,
+            "gen_ai.request.model": self.model_id,
+            "gen_ai.usage.input_tokens": self.input_tokens,
+            "gen_ai.usage.output_tokens": self.output_tokens,
+            "gen_ai.usage.cache_read_input_tokens": self.cache_read_tokens,
+            "gen_ai.usage.cache_creation_input_tokens": self.cache_write_tokens,
+            "llm.stage": self.stage,
+            "llm.source": self.source,
+            "llm.retries": self.retries,
+            "llm.time_to_first_token": self.time_to_first_token,
+            "llm.cost": self.cost,
+        }
+
+    def to_dict(self):
+        return {
+            "timestamp": self.started_at,
+            "backend": self.backend,
+            "model_id": self.model_id,
+            "operation": self.operation,
+            "stage": self.stage,
+            "source": self.source,
+            "latency": self.latency,
+            "time_to_first_token": self.time_to_first_token,
+            "input_tokens": self.input_tokens,
+            "output_tokens": self.output_tokens,
+            "cache_read_tokens": self.cache_read_tokens,
+            "cache_write_tokens": self.cache_write_tokens,
+            "retries": self.retries,
+            "cost": self.cost,
+            "error": self.error,
+        }
+
+
+class Histogram:
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        for idx, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[idx] += 1
+
+
+class MetricsRegistry:
+    """
+    Aggregates the CallMetrics of the process per model id and stage,
+    rendered in the Prometheus text format by `render`
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.calls = {}
+        self.totals = {}
+        self.latency = {}
+        self.time_to_first_token = {}
+
+    def observe(self, call):
+        labels = (call.backend, call.model_id, call.stage)
+        with self._lock:
+            key = labels + (call.source, "error" if call.error else "ok")
+            self.calls[key] = self.calls.get(key, 0) + 1
+            totals = self.totals.setdefault(labels, {
+                "input_tokens": 0, "output_tokens": 0, "cache_read_tokens": 0, "cache_write_tokens": 0,
+                "retries": 0, "cost": 0.0,
+            })
+            totals["input_tokens"] += call.input_tokens or 0
+            totals["output_tokens"] += call.output_tokens or 0
+            totals["cache_read_tokens"] += call.cache_read_tokens or 0
+            totals["cache_write_tokens"] += call.cache_write_tokens or 0
+            totals["retries"] += call.retries
+            totals["cost"] += call.cost or 0.0
+            if call.source == "upstream":
+                self.latency.setdefault(labels, Histogram()).observe(call.latency)
+                if call.time_to_first_token is not None:
+                    self.time_to_first_token.setdefault(labels, Histogram()).observe(call.time_to_first_token)
+
+    def stats(self):
+        """
+        :return: One dict per model id and stage, the most expensive in latency first.
+                 `prompt_cache_hit_rate` is the share of the prompt tokens read from the prompt cache.
+        """
+        with self._lock:
+            rows = []
+            for labels, totals in self.totals.items():
+                latency = self.latency.get(labels)
+                prompt_tokens = totals["input_tokens"] + totals["cache_read_tokens"] + totals["cache_write_tokens"]
+                calls = sum(count for key, count in self.calls.items() if key[:3] == labels)
+                rows.append({
+                    "backend": labels[0],
+                    "model_id": labels[1],
+                    "stage": labels[2],
+                    "calls": calls,
+                    "upstream_calls": latency.count if latency else 0,
+                    "latency_seconds": latency.sum if latency else 0.0,
+                    **totals,
+                    "prompt_cache_hit_rate": totals["cache_read_tokens"] / prompt_tokens if prompt_tokens else 0.0,
+                })
+        return sorted(rows, key=lambda row: row["latency_seconds"], reverse=True)
+
+    def render(self):
+        def label_text(names, values):
+            return ",".join('{}="{}"'.format(name, str(value).replace("\\", "\\\\").replace('"', '\\"'))
+                            for name, value in zip(names, values))
+
+        labels = ("backend", "model_id", "stage")
+        lines = []
+        with self._lock:
+            lines += ["# HELP llm_calls_total Model calls by source (upstream, cache, coalesced) and status",
+                      "# TYPE llm_calls_total counter"]
+            for key, count in sorted(self.calls.items()):
+                lines.append(f"llm_calls_total{{{label_text(labels + ('source', 'status'), key)}}} {count}")
+            for name, field, help_text in (
+                ("llm_input_tokens_total", "input_tokens", "Input tokens sent to the model"),
+                ("llm_output_tokens_total", "output_tokens", "Output tokens generated by the model"),
+                ("llm_prompt_cache_read_tokens_total", "cache_read_tokens", "Input tokens read from the prompt cache"),
+                ("llm_prompt_cache_write_tokens_total", "cache_write_tokens", "Input tokens written to the prompt cache"),
+                ("llm_retries_total", "retries", "Retried throttled or transient errors"),
+                ("llm_cost_usd_total", "cost", "Estimated cost in USD"),
+            ):
+                lines += [f"# HELP {name} {help_text}", f"# TYPE {name} counter"]
+                for key, totals in sorted(self.totals.items()):
+                    lines.append(f"{name}{{{label_text(labels, key)}}} {totals[field]}")
+            for name, histograms, help_text in (
+                ("llm_latency_seconds", self.latency, "Latency of upstream model calls"),
+                ("llm_time_to_first_token_seconds", self.time_to_first_token, "Time to the first token of streamed calls"),
+            ):
+                lines += [f"# HELP {name} {help_text}", f"# TYPE {name} histogram"]
+                for key, histogram in sorted(histograms.items()):
+                    for bound, count in zip(histogram.buckets, histogram.counts):
+                        lines.append(f'{name}_bucket{{{label_text(labels, key)},le="{bound}"}} {count}')
+                    lines.append(f'{name}_bucket{{{label_text(labels, key)},le="+Inf"}} {histogram.count}')
+                    lines.append(f"{name}_sum{{{label_text(labels, key)}}} {histogram.sum}")
+                    lines.append(f"{name}_count{{{label_text(labels, key)}}} {histogram.count}")
+        return "\n".join(lines) + "\n"
+
+    def reset(self):
+        with self._lock:
+            self.calls.clear()
+            self.totals.clear()
+            self.latency.clear()
+            self.time_to_first_token.clear()
+
+
+registry = MetricsRegistry()
+
+if os.getenv("LLM_METRICS_LOG"):
+    _handler = logging.FileHandler(os.getenv("LLM_METRICS_LOG"), encoding="utf-8")
+    _handler.setFormatter(logging.Formatter("%(message)s"))
+    logger.addHandler(_handler)
+    logger.setLevel(logging.INFO)
+
+
+@contextmanager
+def track(backend, model_id, operation, stage=None):
+    """
+    Measure a model call: yields its CallMetrics, then adds it to the registry, logs it as one JSON line
+    and exports it as a client span of the current trace
+    """
+    call = CallMetrics(backend, model_id, operation, stage)
+    current = start_span(call.stage, KIND_CLIENT)
+    try:
+        yield call
+    except GeneratorExit:
+        # The caller stopped reading a stream early
+        raise
+    except BaseException as e:
+        call.error = type(e).__name__
+        current.record_exception(e)
+        raise
+    finally:
+        call.latency = time.perf_counter() - call.start
+        current.set_attributes(call.span_attributes())
+        current.end()
+        if metrics_enabled():
+            registry.observe(call)
+            logger.info(json.dumps(call.to_dict(), ensure_ascii=False))
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        payload = registry.render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        pass
+
+
+_server = None
+
+
+def start_metrics_server(port=None):
+    """
+    Serve the metrics at http://<host>:<port>/metrics from a background thread
+    :param port: Defaults to LLM_METRICS_PORT, nothing is served if it is 0
+    :return: The server, or None if it is disabled
+    """
+    global _server
+    port = int(port if port is not None else os.getenv("LLM_METRICS_PORT", 0))
+    if not port or not metrics_enabled():
+        return None
+    if _server is None:
+        _server = ThreadingHTTPServer((os.getenv("LLM_METRICS_HOST", "0.0.0.0"), port), MetricsHandler)
+        threading.Thread(target=_server.serve_forever, name="llm-metrics", daemon=True).start()
+    return _server
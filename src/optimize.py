@@ -1,12 +1,12 @@
-import json
-import os
+import asyncio
 import re
 
-import boto3
-from botocore.config import Config
-from openai import OpenAI
 from dotenv import load_dotenv
 
+from clients import get_openai_client
+from gateway import bedrock_body, gateway, response_text
+from tracing import traced
+
 load_dotenv()
 
 default_system = "You are a helpful and knowledgeable assistant who is able to provide detailed and accurate information on a wide range of topics. You are also able to provide clear and concise answers to questions and are always willing to go the extra mile to help others."
@@ -66,25 +66,28 @@ Finally, provide the revised prompt within the following XML tags:
 </revised_prompt>
 """.strip()
 
-openai_api_key = os.getenv("OPENAI_API_KEY")
-openai_base_url = os.getenv("OPENAI_BASE_URL")
-
 class Alignment:
-    def __init__(self):
-        self.bedrock_client = boto3.client(
-            service_name="bedrock-runtime", region_name=os.getenv("REGION_NAME")
-        )
-        try:
-            self.openai_client = OpenAI(
-                base_url=openai_base_url,
-                # This is the default and can be omitted
-                api_key=openai_api_key,
-            )
-            # self.openai_client = OpenAI()
-        except:
-            self.openai_client = None
-
-    def generate_bedrock_response(self, prompt, model_id):
+    @property
+    def openai_client(self):
+        return get_openai_client()
+
+    def bedrock_request(self, prompt):
+        message = {
+            "role": "user",
+            "content": [
+                # {"type": "image", "source": {"type": "base64", "media_type": "image/jpeg", "data": content_image}},
+                {"type": "text", "text": prompt}
+            ],
+        }
+        return bedrock_body([message], system=bedrock_default_system, max_tokens=4000)
+
+    def openai_messages(self, prompt):
+        return [
+            {"role": "system", "content": openai_default_system},
+            {"role": "user", "content": prompt},
+        ]
+
+    def generate_bedrock_response(self, prompt, model_id, stage="alignment.bedrock"):
         """
         This function generates a test dataset by invoking a model with a given prompt.
 
@@ -94,69 +97,31 @@ class Alignment:
         Returns:
         matches (list): A list of questions generated by the model, each wrapped in <case></case> XML tags.
         """
-        message = {
-            "role": "user",
-            "content": [
-                # {"type": "image", "source": {"type": "base64", "media_type": "image/jpeg", "data": content_image}},
-                {"type": "text", "text": prompt}
-            ],
-        }
-        messages = [message]
-        body = json.dumps(
-            {
-                "anthropic_version": "bedrock-2023-05-31",
-                "max_tokens": 4000,
-                "messages": messages,
-                "system": bedrock_default_system,
-            }
-        )
-        response = self.bedrock_client.invoke_model(body=body, modelId=model_id)
-        response_body = json.loads(response.get("body").read())
-        return response_body["content"][0]["text"]
+        return response_text(gateway.invoke(model_id, self.bedrock_request(prompt), stage=stage))
+
+    async def agenerate_bedrock_response(self, prompt, model_id, stage="alignment.bedrock"):
+        return response_text(await gateway.ainvoke(model_id, self.bedrock_request(prompt), stage=stage))
 
     def generate_openai_response(self, prompt, model_id):
-        completion = self.openai_client.chat.completions.create(
-            model=model_id,
-            messages=[
-                {"role": "system", "content": openai_default_system},
-                {"role": "user", "content": prompt},
-            ],
-        )
-        return completion.choices[0].message.content
+        return gateway.chat(model_id, self.openai_messages(prompt), stage="alignment.openai")
+
+    async def agenerate_openai_response(self, prompt, model_id):
+        return await gateway.achat(model_id, self.openai_messages(prompt), stage="alignment.openai")
 
     def stream_bedrock_response(self, prompt, model_id, output_component):
-        message = {"role": "user", "content": [{"type": "text", "text": prompt}]}
-        messages = [message]
-        body = json.dumps(
-            {
-                "anthropic_version": "bedrock-2023-05-31",
-                "max_tokens": 4000,
-                "messages": messages,
-                "system": bedrock_default_system,
-            }
+        body = bedrock_body(
+            [{"role": "user", "content": [{"type": "text", "text": prompt}]}],
+            system=bedrock_default_system,
+            max_tokens=4000,
         )
-        response = self.bedrock_client.invoke_model_with_response_stream(
-            modelId=model_id, body=body
-        )
-
-        stream = response.get("body")
-        if stream:
-            for event in stream:
-                chunk = event.get("chunk")
-                if chunk:
-                    output = json.loads(chunk.get("bytes").decode())
-                    output_component.update(output)
+        for output in gateway.invoke_stream(model_id, body, stage="alignment.bedrock"):
+            output_component.update(output)
 
     def stream_openai_response(self, prompt, model_id, output_component):
-        stream = self.openai_client.chat.completions.create(
-            model=model_id,
-            messages=[{"role": "user", "content": prompt}],
-            stream=True,
-        )
-        for chunk in stream:
-            if chunk.choices[0].delta.content is not None:
-                output_component.update(chunk.choices[0].delta.content, append=True)
+        for content in gateway.chat_stream(model_id, [{"role": "user", "content": prompt}], stage="alignment.openai"):
+            output_component.update(content, append=True)
 
+    @traced("alignment.invoke_prompt")
     def invoke_prompt(
         self,
         original_prompt_replace,
@@ -182,11 +147,43 @@ class Alignment:
         )
         return openai_result, aws_result
 
+    @traced("alignment.invoke_prompt")
+    async def ainvoke_prompt(
+        self,
+        original_prompt_replace,
+        revised_prompt_replace,
+        original_prompt,
+        revised_prompt,
+        openai_model_id,
+        aws_model_id,
+    ):
+        if len(original_prompt_replace) == 0:
+            original_prompt_replace = original_prompt
+        if len(revised_prompt_replace) == 0:
+            revised_prompt_replace = revised_prompt
+        if self.openai_client is None:
+            openai_result = "OpenAIError: The api_key client option must be set either by passing api_key to the client or by setting the OPENAI_API_KEY environment variable"
+            aws_result = "OpenAIError: The api_key client option must be set either by passing api_key to the client or by setting the OPENAI_API_KEY environment variable"
+            return openai_result, aws_result
+        # Both models are called at once, the slower one sets the latency
+        return await asyncio.gather(
+            self.agenerate_openai_response(original_prompt_replace, openai_model_id),
+            self.agenerate_bedrock_response(revised_prompt_replace, aws_model_id),
+        )
+
     def evaluate_response(self, openai_output, aws_output, eval_model_id):
         revised_prompt = evaluate_response_prompt_template.format(
             _OpenAI=openai_output, _Bedrock=aws_output
         )
-        aws_result = self.generate_bedrock_response(revised_prompt, eval_model_id)
+        return self.parse_feedback(self.generate_bedrock_response(revised_prompt, eval_model_id, "alignment.evaluate"))
+
+    async def aevaluate_response(self, openai_output, aws_output, eval_model_id):
+        revised_prompt = evaluate_response_prompt_template.format(
+            _OpenAI=openai_output, _Bedrock=aws_output
+        )
+        return self.parse_feedback(await self.agenerate_bedrock_response(revised_prompt, eval_model_id, "alignment.evaluate"))
+
+    def parse_feedback(self, aws_result):
         pattern = r"<auto_feedback>(.*?)</auto_feedback>"
         feedback = re.findall(pattern, aws_result, re.DOTALL)[0]
 
@@ -209,6 +206,16 @@ class Alignment:
     def generate_revised_prompt(
         self, feedback, prompt, openai_response, aws_response, eval_model_id
     ):
+        revised_prompt = self.revise_request(feedback, prompt, openai_response, aws_response)
+        return self.parse_revised_prompt(self.generate_bedrock_response(revised_prompt, eval_model_id, "alignment.revise"))
+
+    async def agenerate_revised_prompt(
+        self, feedback, prompt, openai_response, aws_response, eval_model_id
+    ):
+        revised_prompt = self.revise_request(feedback, prompt, openai_response, aws_response)
+        return self.parse_revised_prompt(await self.agenerate_bedrock_response(revised_prompt, eval_model_id, "alignment.revise"))
+
+    def revise_request(self, feedback, prompt, openai_response, aws_response):
         pattern = r"<recommendation>(.*?)</recommendation>"
         matches = re.findall(pattern, feedback, re.DOTALL)
         if len(matches):
@@ -219,7 +226,9 @@ class Alignment:
             _OpenAI=openai_response,
             _Bedrock=aws_response,
         )
-        aws_result = self.generate_bedrock_response(revised_prompt, eval_model_id)
+        return revised_prompt
+
+    def parse_revised_prompt(self, aws_result):
         pattern = r"<revised_prompt>(.*?)</revised_prompt>"
         matches = re.findall(pattern, aws_result, re.DOTALL)
         # remove all the \n and []
@@ -0,0 +1,178 @@
+import math
+import multiprocessing
+import os
+import signal
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+# The compiled user namespace and the per-output time limit of a process pool worker
+_worker_namespace = None
+_worker_timeout = None
+
+
+def compile_postprocess(code):
+    """
+    Compile the user's postprocess code into its own namespace
+    :param code: Python source defining `postprocess(llm_output)` and/or `postprocess_batch(llm_outputs)`
+    :return: The namespace the code was executed in
+    """
+    namespace = {"__name__": "postprocess"}
+    exec(compile(code, "<postprocess>", "exec"), namespace)
+    if not callable(namespace.get("postprocess")) and not callable(namespace.get("postprocess_batch")):
+        raise ValueError("The postprocess code must define postprocess(llm_output) or postprocess_batch(llm_outputs)")
+    return namespace
+
+
+def timeout_error(seconds):
+    return f"TimeoutError: postprocess took longer than {seconds}s"
+
+
+@contextmanager
+def time_limit(seconds):
+    """
+    Raise TimeoutError in the block after `seconds`. Only enforced in the main thread of a process,
+    which is where pool workers run their tasks.
+    """
+    if not seconds or not hasattr(signal, "setitimer") or threading.current_thread() is not threading.main_thread():
+        yield
+        return
+
+    def on_alarm(signum, frame):
+        raise TimeoutError(f"postprocess took longer than {seconds}s")
+
+    previous = signal.signal(signal.SIGALRM, on_alarm)
+    signal.setitimer(signal.ITIMER_REAL, seconds)
+    try:
+        yield
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        signal.signal(signal.SIGALRM, previous)
+
+
+def _init_worker(code, timeout):
+    global _worker_namespace, _worker_timeout
+    _worker_namespace = compile_postprocess(code)
+    _worker_timeout = timeout
+
+
+def _run_batch(namespace, outputs, timeout=None):
+    """
+    :param timeout: Seconds allowed per output, None for no limit
+    :return: A list of (result, error message) tuples aligned with the outputs
+    """
+    postprocess_batch = namespace.get("postprocess_batch")
+    if callable(postprocess_batch):
+        try:
+            with time_limit(timeout and timeout * len(outputs)):
+                results = list(postprocess_batch(outputs))
+            if len(results) == len(outputs):
+                return [(result, None) for result in results]
+        except TimeoutError:
+            return [(None, timeout_error(timeout))] * len(outputs)
+        except Exception:
+            pass
+    # Fall back to one call per output, so a failing output only affects itself
+    postprocess = namespace.get("postprocess")
+    if not callable(postprocess):
+        postprocess = lambda output: postprocess_batch([output])[0]  # noqa: E731
+    results = []
+    for output in outputs:
+        try:
+            with time_limit(timeout):
+                results.append((postprocess(output), None))
+        except Exception as e:
+            results.append((None, f"{type(e).__name__}: {e}"))
+    return results
+
+
+def _worker_run_batch(outputs):
+    return _run_batch(_worker_namespace, outputs, _worker_timeout)
+
+
+class Postprocessor:
+    """
+    Runs the user's postprocess code, compiled once per run in an isolated namespace.
+
+    With `processes` > 0 the code runs in a process pool, so CPU-heavy parsing does not hold
+    the GIL while the LLM requests are in flight, and each output is bounded by `timeout` seconds.
+    A worker stuck past its limit is killed with the whole pool, which is started again for the next batch.
+    If the code defines `postprocess_batch(llm_outputs)`, whole chunks are processed in one call.
+    """
+
+    def __init__(self, code, processes=None, timeout=None):
+        if processes is None:
+            processes = int(os.getenv("CALIBRATION_POSTPROCESS_PROCESSES", 0))
+        if timeout is None:
+            timeout = float(os.getenv("CALIBRATION_POSTPROCESS_TIMEOUT", 10))
+        self.code = code
+        self.namespace = compile_postprocess(code)
+        self.processes = processes
+        self.timeout = timeout
+        self.pool = self._start_pool() if processes > 0 else None
+        self._lock = threading.Lock()
+        # Runs the batches handed to `submit` off the caller's thread, one at a time
+        self._dispatcher = ThreadPoolExecutor(max_workers=1, thread_name_prefix="postprocess")
+
+    def _start_pool(self):
+        return multiprocessing.Pool(self.processes, initializer=_init_worker, initargs=(self.code, self.timeout))
+
+    def batch(self, outputs):
+        """
+        Postprocess several LLM outputs
+        :return: A list of (result, error message) tuples aligned with the outputs, one of each pair is None
+        """
+        if not outputs:
+            return []
+        if self.pool is None:
+            return _run_batch(self.namespace, outputs)
+        # The outputs are spread over the workers. A batch has the pool to itself, so a pool
+        # killed because of a stuck worker takes no other caller's outputs with it.
+        size = math.ceil(len(outputs) / self.processes)
+        with self._lock:
+            start = time.monotonic()
+            pending = [
+                (outputs[idx:idx + size], self.pool.apply_async(_worker_run_batch, (outputs[idx:idx + size],)))
+                for idx in range(0, len(outputs), size)
+            ]
+            results = []
+            stuck = False
+            for part, async_result in pending:
+                # The workers enforce the limit per output, this only catches code the alarm can't interrupt.
+                # A failed postprocess_batch call may be followed by one call per output, hence twice the limit.
+                deadline = start + 2 * self.timeout * len(part) + 1.0
+                try:
+                    results += async_result.get(max(0.0, deadline - time.monotonic()))
+                except multiprocessing.TimeoutError:
+                    stuck = True
+                    results += [(None, timeout_error(self.timeout))] * len(part)
+                except Exception as e:
+                    results += [(None, f"{type(e).__name__}: {e}")] * len(part)
+            if stuck:
+                self.pool.terminate()
+                self.pool = self._start_pool()
+        return results
+
+    def submit(self, outputs):
+        """
+        Postprocess several LLM outputs in the background
+        :return: A Future of the result of `batch`
+        """
+        return self._dispatcher.submit(self.batch, outputs)
+
+    def __call__(self, output):
+        """
+        Postprocess a single LLM output, raising if the user's code fails
+        """
+        result, error = self.batch([output])[0]
+        if error is not None:
+            raise ValueError(error)
+        return result
+
+    def close(self):
+        self._dispatcher.shutdown(wait=True)
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool.join()
+            self.pool = None
@@ -0,0 +1,289 @@
+import asyncio
+import collections
+import json
+import os
+import random
+import threading
+import time
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+THROTTLING_CODES = {"ThrottlingException", "TooManyRequestsException", "ServiceQuotaExceededException"}
+TRANSIENT_CODES = {"ServiceUnavailableException", "ModelNotReadyException", "InternalServerException"}
+TRANSIENT_ERRORS = {"EndpointConnectionError", "ConnectTimeoutError", "ReadTimeoutError", "APIConnectionError", "APITimeoutError"}
+
+
+def rate_limit_enabled():
+    return os.getenv("LLM_RATE_LIMIT", "1") != "0"
+
+
+def error_kind(error):
+    """
+    Classify an exception raised by a Bedrock or OpenAI call
+    :return: "throttled", "transient" or None
+    """
+    response = getattr(error, "response", None)
+    if isinstance(response, dict):
+        code = response.get("Error", {}).get("Code")
+        if code in THROTTLING_CODES:
+            return "throttled"
+        if code in TRANSIENT_CODES:
+            return "transient"
+    status_code = getattr(error, "status_code", None)
+    if status_code == 429:
+        return "throttled"
+    if isinstance(status_code, int) and status_code >= 500:
+        return "transient"
+    if type(error).__name__ in TRANSIENT_ERRORS:
+        return "transient"
+    return None
+
+
+def estimate_tokens(messages, system=None):
+    """
+    A rough token count of a prompt, about 4 characters per token. A request is charged this much
+    against the tokens/min quota up front, the output tokens once the response tells how many were used.
+    """
+    text = json.dumps(messages, ensure_ascii=False) + (json.dumps(system, ensure_ascii=False) if system else "")
+    return len(text) // 4
+
+
+class TokenBucket:
+    """
+    A token bucket that hands out reservations: a caller takes its cost right away, even into debt,
+    and is told how long to wait until the debt is paid. Waiters are served in arrival order
+    without polling, and no capacity is lost to callers that wake up at the same time.
+    """
+
+    def __init__(self, per_minute, burst=10.0):
+        self.per_minute = per_minute
+        self.burst = burst
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+
+    @property
+    def rate(self):
+        return self.per_minute / 60.0
+
+    @property
+    def capacity(self):
+        # Allow a burst of `burst` seconds worth of capacity, and at least one request
+        return max(self.rate * self.burst, 1.0)
+
+    def refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def reserve(self, cost, now):
+        """
+        :return: The seconds to wait before the reservation can be used
+        """
+        self.refill(now)
+        self.tokens -= cost
+        return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+
+class ModelRateLimiter:
+    """
+    Requests/min and tokens/min limiter of one model id, shared by every thread and event loop of the process.
+
+    The rate starts at the configured quota. Each throttling error cuts it multiplicatively,
+    each success raises it additively (AIMD), so the process settles just under the quota
+    Bedrock actually grants instead of retrying into it.
+    Without a configured quota calls are not delayed until the first throttling error, which seeds
+    the requests/min rate from the throughput of the last minute. AIMD takes over from there.
+    """
+
+    def __init__(self, model_id, rpm, tpm):
+        self.model_id = model_id
+        self.rpm = rpm
+        self.tpm = tpm
+        self.increase = float(os.getenv("LLM_RATE_LIMIT_INCREASE", 0.01))
+        self.decrease = float(os.getenv("LLM_RATE_LIMIT_DECREASE", 0.5))
+        self.min_fraction = float(os.getenv("LLM_RATE_LIMIT_MIN_FRACTION", 0.05))
+        self.max_retries = int(os.getenv("LLM_RATE_LIMIT_RETRIES", 8))
+        self.burst = float(os.getenv("LLM_RATE_LIMIT_BURST", 10))
+        self.fraction = 1.0
+        self.requests = TokenBucket(rpm, self.burst) if rpm > 0 else None
+        self.tokens = TokenBucket(tpm, self.burst) if tpm > 0 else None
+        self.throttled = 0
+        # Success times of the last minute, kept while there is no quota to pace with
+        self._successes = collections.deque()
+        self._decreased_at = 0.0
+        self._lock = threading.Lock()
+
+    def _apply_fraction(self):
+        if self.requests is not None:
+            self.requests.per_minute = self.rpm * self.fraction
+        if self.tokens is not None:
+            self.tokens.per_minute = self.tpm * self.fraction
+
+    def reserve(self, tokens):
+        """
+        Reserve capacity for one request
+        :return: The seconds to wait before sending it
+        """
+        now = time.monotonic()
+        with self._lock:
+            wait = 0.0
+            if self.requests is not None:
+                wait = max(wait, self.requests.reserve(1, now))
+            if self.tokens is not None:
+                wait = max(wait, self.tokens.reserve(tokens, now))
+            return wait
+
+    def on_success(self, estimated_tokens, used_tokens=None):
+        now = time.monotonic()
+        with self._lock:
+            if self.requests is None and self.tokens is None:
+                self._successes.append(now)
+                while now - self._successes[0] > 60.0:
+                    self._successes.popleft()
+            if self.tokens is not None and used_tokens is not None:
+                # Settle the reservation with the real usage
+                self.tokens.tokens += estimated_tokens - used_tokens
+            if self.fraction < 1.0:
+                self.fraction = min(1.0, self.fraction + self.increase)
+                self._apply_fraction()
+
+    def charge(self, tokens):
+        """
+        Charge tokens used after the request was sent, e.g. the output of a stream
+        """
+        with self._lock:
+            if self.tokens is not None:
+                self.tokens.tokens -= tokens
+
+    def on_throttled(self):
+        """
+        :return: Whether the buckets now pace the retry, False if the caller has to back off itself
+        """
+        now = time.monotonic()
+        with self._lock:
+            self.throttled += 1
+            if self.requests is None and self.tokens is None and not self._seed(now):
+                return False
+            # Requests already in flight get throttled too, only cut once per second
+            if now - self._decreased_at >= 1.0:
+                self._decreased_at = now
+                self.fraction = max(self.min_fraction, self.fraction * self.decrease)
+                self._apply_fraction()
+                for bucket in (self.requests, self.tokens):
+                    if bucket is not None:
+                        bucket.refill(now)
+                        bucket.tokens = min(bucket.tokens, 0.0)
+            return True
+
+    def _seed(self, now):
+        """
+        Start pacing a model without a configured quota at the requests/min it sustained over the last minute
+        :return: Whether there was any throughput to seed the rate from
+        """
+        while self._successes and now - self._successes[0] > 60.0:
+            self._successes.popleft()
+        if not self._successes:
+            return False
+        self.rpm = len(self._successes) * 60.0 / max(now - self._successes[0], 1.0)
+        self.requests = TokenBucket(self.rpm, self.burst)
+        self._successes.clear()
+        return True
+
+    def backoff(self, attempt):
+        return min(20.0, 0.5 * 2 ** attempt) * random.uniform(0.5, 1.0)
+
+    def call(self, fn, estimated_tokens, usage=None, on_retry=None):
+        """
+        Run `fn` once capacity is available, retrying throttled and transient errors
+        :param usage: Maps the result of `fn` to the tokens it used, None if unknown
+        :param on_retry: Called with the error kind before each retry
+        """
+        attempt = 0
+        while True:
+            wait = self.reserve(estimated_tokens)
+            if wait > 0:
+                time.sleep(wait)
+            try:
+                result = fn()
+            except Exception as e:
+                kind = error_kind(e)
+                if kind is None or attempt >= self.max_retries:
+                    raise
+                if on_retry is not None:
+                    on_retry(kind)
+                if kind != "throttled" or not self.on_throttled():
+                    time.sleep(self.backoff(attempt))
+                attempt += 1
+                continue
+            self.on_success(estimated_tokens, usage(result) if usage else None)
+            return result
+
+    async def acall(self, fn, estimated_tokens, usage=None, on_retry=None):
+        """
+        Async version of `call`, `fn` returns an awaitable
+        """
+        attempt = 0
+        while True:
+            wait = self.reserve(estimated_tokens)
+            if wait > 0:
+                await asyncio.sleep(wait)
+            try:
+                result = await fn()
+            except Exception as e:
+                kind = error_kind(e)
+                if kind is None or attempt >= self.max_retries:
+                    raise
+                if on_retry is not None:
+                    on_retry(kind)
+                if kind != "throttled" or not self.on_throttled():
+                    await asyncio.sleep(self.backoff(attempt))
+                attempt += 1
+                continue
+            self.on_success(estimated_tokens, usage(result) if usage else None)
+            return result
+
+    def stats(self):
+        with self._lock:
+            return {
+                "model_id": self.model_id,
+                "rpm": self.rpm * self.fraction,
+                "tpm": self.tpm * self.fraction,
+                "fraction": self.fraction,
+                "throttled": self.throttled,
+            }
+
+
+_lock = threading.Lock()
+_limiters = {}
+
+
+def model_limits(model_id):
+    """
+    The requests/min and tokens/min quota of a model. LLM_RATE_LIMITS overrides the defaults per model id,
+    as JSON: {"<model id>": {"rpm": 1000, "tpm": 2000000}}. 0, the default, means unlimited.
+    """
+    limits = json.loads(os.getenv("LLM_RATE_LIMITS") or "{}").get(model_id, {})
+    return (
+        float(limits.get("rpm", os.getenv("LLM_RATE_LIMIT_RPM", 0))),
+        float(limits.get("tpm", os.getenv("LLM_RATE_LIMIT_TPM", 0))),
+    )
+
+
+def get_rate_limiter(model_id):
+    """
+    Return the process-wide limiter of a model id, or None if rate limiting is disabled
+    """
+    if not rate_limit_enabled():
+        return None
+    limiter = _limiters.get(model_id)
+    if limiter is None:
+        with _lock:
+            if model_id not in _limiters:
+                _limiters[model_id] = ModelRateLimiter(model_id, *model_limits(model_id))
+            limiter = _limiters[model_id]
+    return limiter
+
+
+def rate_limit_stats():
+    return [limiter.stats() for limiter in list(_limiters.values())]
@@ -1,25 +1,16 @@
+import asyncio
 import json
+import random
 
-import boto3
-from botocore.config import Config
-
-region_name = "us-west-2"
-session = boto3.Session()
-retry_config = Config(
-    region_name=region_name,
-    retries={
-        "max_attempts": 5,
-        "mode": "standard",
-    },
-)
-service_name = "bedrock-runtime"
-bedrock_client = session.client(service_name=service_name, config=retry_config)
+from gateway import gateway
+from tracing import traced
 
 
 class Rater:
     def __init__(self):
         pass
 
+    @traced("rater.rate_candidates")
     def __call__(self, initial_prompt, candidates, demo_data):
         for candidate in candidates:
             if "output" in candidate:
@@ -34,31 +25,52 @@ class Rater:
         rate = self.rater(initial_prompt, candidates)
         return rate
 
+    @traced("rater.rate_candidates")
+    async def acall(self, initial_prompt, candidates, demo_data):
+        pending = [candidate for candidate in candidates if "output" not in candidate]
+        for candidate in pending:
+            candidate_prompt = candidate["prompt"]
+            for k, v in demo_data.items():
+                candidate_prompt = candidate_prompt.replace(k, v)
+            candidate["input"] = candidate_prompt
+        outputs = await asyncio.gather(*[self.aget_output(candidate["input"]) for candidate in pending])
+        for candidate, output in zip(pending, outputs):
+            candidate["output"] = output
+        for k, v in demo_data.items():
+            initial_prompt = initial_prompt.replace(k, v)
+        return await self.arater(initial_prompt, candidates)
+
     def get_output(self, prompt):
+        return self._get_output_result(gateway.invoke(*self._get_output_request(prompt), stage="rater.get_output"))
+
+    async def aget_output(self, prompt):
+        return self._get_output_result(await gateway.ainvoke(*self._get_output_request(prompt), stage="rater.get_output"))
+
+    def _get_output_request(self, prompt):
         messages = [{"role": "user", "content": prompt}]
-        body = json.dumps(
-            {
-                "messages": messages,
-                "max_tokens": 4096,
-                "temperature": 0.8,
-                "top_k": 50,
-                "top_p": 1,
-                "stop_sequences": ["\n\nHuman:"],
-                "anthropic_version": "bedrock-2023-05-31",
-            }
-        )
+        body = {
+            "messages": messages,
+            "max_tokens": 4096,
+            "temperature": 0.8,
+            "top_k": 50,
+            "top_p": 1,
+            "stop_sequences": ["\n\nHuman:"],
+            "anthropic_version": "bedrock-2023-05-31",
+        }
         modelId = "anthropic.claude-3-haiku-20240307-v1:0"  # anthropic.claude-3-sonnet-20240229-v1:0 "anthropic.claude-3-haiku-20240307-v1:0"
-        accept = "application/json"
-        contentType = "application/json"
+        return modelId, body
 
-        response = bedrock_client.invoke_model(
-            body=body, modelId=modelId, accept=accept, contentType=contentType
-        )
-        response_body = json.loads(response.get("body").read())
+    def _get_output_result(self, response_body):
         result = response_body["content"][0]["text"]
         return result
 
     def rater(self, initial_prompt, candidates):
+        return self._rater_result(gateway.invoke(*self._rater_request(initial_prompt, candidates), stage="rater.rate"), candidates)
+
+    async def arater(self, initial_prompt, candidates):
+        return self._rater_result(await gateway.ainvoke(*self._rater_request(initial_prompt, candidates), stage="rater.rate"), candidates)
+
+    def _rater_request(self, initial_prompt, candidates):
         rater_example = json.dumps({"Preferred": "Response 1"})
         Response_prompt = []
         for candidate_idx, candidate in enumerate(candidates):
@@ -96,25 +108,19 @@ Output example: {rater_example}
             },
             {"role": "assistant", "content": "{"},
         ]
-        body = json.dumps(
-            {
-                "messages": messages,
-                "max_tokens": 4096,
-                "temperature": 0.8,
-                "top_k": 50,
-                "top_p": 1,
-                "stop_sequences": ["\n\nHuman:"],
-                "anthropic_version": "bedrock-2023-05-31",
-            }
-        )
+        body = {
+            "messages": messages,
+            "max_tokens": 4096,
+            "temperature": 0.8,
+            "top_k": 50,
+            "top_p": 1,
+            "stop_sequences": ["\n\nHuman:"],
+            "anthropic_version": "bedrock-2023-05-31",
+        }
         modelId = "anthropic.claude-3-sonnet-20240229-v1:0"  # anthropic.claude-3-sonnet-20240229-v1:0 "anthropic.claude-3-haiku-20240307-v1:0"
-        accept = "application/json"
-        contentType = "application/json"
+        return modelId, body
 
-        response = bedrock_client.invoke_model(
-            body=body, modelId=modelId, accept=accept, contentType=contentType
-        )
-        response_body = json.loads(response.get("body").read())
+    def _rater_result(self, response_body, candidates):
         result_json = "{" + response_body["content"][0]["text"]
         try:
             result = None
@@ -124,7 +130,7 @@ Output example: {rater_example}
                     result = idx
                     break
         except:
-            result = random.ranint(0, len(candidates) - 1)
+            result = random.randint(0, len(candidates) - 1)
         if result is None:
-            result = random.ranint(0, len(candidates) - 1)
+            result = random.randint(0, len(candidates) - 1)
         return result
@@ -0,0 +1,619 @@
+"""
+Record/replay stand-ins for Bedrock and OpenAI-compatible endpoints, selected with LLM_BACKEND:
+
+- live (default): the real services
+- record: the real services, and every response is appended to LLM_RECORDINGS
+- replay: nothing leaves the machine. Requests are answered from LLM_RECORDINGS, then from the
+  regex rules in LLM_SIM_FIXTURES, then with a synthetic reply. Latency, throttling and
+  streaming chunk timing are simulated from the LLM_SIM_* settings.
+
+The stand-ins expose the subset of the boto3 / aiobotocore / openai client APIs the project uses,
+so every pipeline runs unchanged against them.
+"""
+import asyncio
+import hashlib
+import io
+import json
+import os
+import random
+import re
+import threading
+import time
+from collections import deque
+from types import SimpleNamespace
+
+from dotenv import load_dotenv
+
+from ratelimit import estimate_tokens
+
+load_dotenv()
+
+
+def llm_backend():
+    return os.getenv("LLM_BACKEND", "live")
+
+
+class SimulatedThrottlingError(Exception):
+    """
+    Raised like a Bedrock ThrottlingException (botocore `response`) or an OpenAI 429 (`status_code`)
+    """
+
+    def __init__(self, operation):
+        super().__init__(f"An error occurred (ThrottlingException) when calling the {operation} operation: Too many requests")
+        self.response = {"Error": {"Code": "ThrottlingException", "Message": "Too many requests"}}
+        self.status_code = 429
+
+
+class MissingRecordingError(KeyError):
+    pass
+
+
+def request_key(backend, model_id, request):
+    payload = json.dumps([backend, model_id, request], sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def request_text(messages, system=None):
+    """
+    The plain text of a conversation, for matching fixture rules
+    """
+    parts = [system] if isinstance(system, str) else [block.get("text", "") for block in system or []]
+    for message in messages:
+        content = message.get("content")
+        if isinstance(content, str):
+            parts.append(content)
+        else:
+            parts.extend(block.get("text", "") for block in content or [] if isinstance(block, dict))
+    return "\n".join(part for part in parts if part)
+
+
+def cached_prefix(messages, system=None):
+    """
+    The blocks of a request up to its last prompt cache checkpoint (a block with `cache_control`),
+    None if it has no checkpoint
+    """
+    blocks = [{"text": system}] if isinstance(system, str) else list(system or [])
+    for message in messages:
+        content = message.get("content")
+        blocks.extend([{"text": content}] if isinstance(content, str) else content or [])
+    prefix = None
+    for idx, block in enumerate(blocks):
+        if isinstance(block, dict) and block.get("cache_control"):
+            prefix = blocks[:idx + 1]
+    return prefix
+
+
+def output_tokens(text):
+    return max(1, len(text) // 4)
+
+
+class Recordings:
+    """
+    The recorded responses, as JSON lines of {"key", "backend", "model_id", "response"}.
+    A response is {"text", "stop_reason", "stop_sequence", "input_tokens", "output_tokens"}.
+    """
+
+    def __init__(self, path=None):
+        if path is None:
+            path = os.getenv("LLM_RECORDINGS", "temp/llm_recordings.jsonl")
+        self.path = path
+        self._lock = threading.Lock()
+        self._responses = {}
+        if os.path.exists(path):
+            with open(path, encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue
+                    self._responses[record["key"]] = record["response"]
+
+    def get(self, key):
+        return self._responses.get(key)
+
+    def add(self, key, backend, model_id, response):
+        with self._lock:
+            self._responses[key] = response
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            with open(self.path, "a", encoding="utf-8") as f:
+                record = {"key": key, "backend": backend, "model_id": model_id, "response": response}
+                f.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+
+class Simulator:
+    """
+    Produces the simulated responses and their timing, shared by every stand-in client of the process
+    """
+
+    def __init__(self):
+        self.recordings = Recordings()
+        self.latency = float(os.getenv("LLM_SIM_LATENCY_MS", 200)) / 1000
+        self.token_latency = float(os.getenv("LLM_SIM_MS_PER_TOKEN", 2)) / 1000
+        self.jitter = float(os.getenv("LLM_SIM_JITTER", 0.1))
+        self.throttle_rate = float(os.getenv("LLM_SIM_THROTTLE_RATE", 0))
+        self.rpm = float(os.getenv("LLM_SIM_RPM", 0))
+        self.chunk_tokens = max(1, int(os.getenv("LLM_SIM_CHUNK_TOKENS", 4)))
+        self.missing = os.getenv("LLM_SIM_MISSING", "synthesize")
+        self.prompt_cache_ttl = float(os.getenv("LLM_SIM_PROMPT_CACHE_TTL", 300))
+        self.rules = []
+        fixtures = os.getenv("LLM_SIM_FIXTURES")
+        if fixtures:
+            with open(fixtures, encoding="utf-8") as f:
+                for rule in json.load(f):
+                    self.rules.append((re.compile(rule["match"], re.DOTALL), re.compile(rule.get("model", "")), rule["response"]))
+        self.calls = 0
+        self.throttled = 0
+        self.input_tokens = 0
+        self.output_tokens = 0
+        self.cache_read_tokens = 0
+        self.cache_write_tokens = 0
+        self._prompt_cache = {}
+        self._random = random.Random(int(os.getenv("LLM_SIM_SEED", 0)))
+        self._window = deque()
+        self._lock = threading.Lock()
+
+    def admit(self, operation):
+        """
+        Count a request against the simulated quota, raising like the service when it is throttled
+        """
+        now = time.monotonic()
+        with self._lock:
+            self.calls += 1
+            while self._window and self._window[0] <= now - 60:
+                self._window.popleft()
+            throttled = (self.rpm > 0 and len(self._window) >= self.rpm) or self._random.random() < self.throttle_rate
+            if throttled:
+                self.throttled += 1
+            else:
+                self._window.append(now)
+        if throttled:
+            raise SimulatedThrottlingError(operation)
+
+    def delays(self):
+        """
+        :return: (seconds to the first token, seconds per streamed chunk)
+        """
+        with self._lock:
+            scale = 1 + self._random.uniform(-self.jitter, self.jitter)
+        return self.latency * scale, self.token_latency * self.chunk_tokens * scale
+
+    def total_delay(self, response):
+        first, per_chunk = self.delays()
+        return first + per_chunk * (response["output_tokens"] / self.chunk_tokens)
+
+    def respond(self, backend, model_id, request, messages, system=None, max_tokens=None, stop_sequences=None):
+        key = request_key(backend, model_id, request)
+        response = self.recordings.get(key)
+        if response is not None:
+            with self._lock:
+                self.input_tokens += response["input_tokens"]
+                self.output_tokens += response["output_tokens"]
+            return response
+        text = None
+        conversation = request_text(messages, system)
+        for pattern, model_pattern, reply in self.rules:
+            if model_pattern.search(model_id) and pattern.search(conversation):
+                text = reply
+                break
+        if text is None:
+            if self.missing == "error":
+                raise MissingRecordingError(f"No recorded response for {model_id} request {key}")
+            text = f"Simulated response {key[:8]}."
+        stop_reason, stop_sequence = "end_turn", None
+        for sequence in stop_sequences or []:
+            position = text.find(sequence)
+            if position != -1:
+                text, stop_reason, stop_sequence = text[:position], "stop_sequence", sequence
+                break
+        if max_tokens and output_tokens(text) > max_tokens:
+            text, stop_reason, stop_sequence = text[: max_tokens * 4], "max_tokens", None
+        response = {
+            "text": text,
+            "stop_reason": stop_reason,
+            "stop_sequence": stop_sequence,
+            "input_tokens": estimate_tokens(messages, system=system),
+            "output_tokens": output_tokens(text),
+        }
+        prefix = cached_prefix(messages, system)
+        if prefix is not None:
+            self.prompt_cache(model_id, prefix, response)
+        with self._lock:
+            self.input_tokens += response["input_tokens"]
+            self.output_tokens += response["output_tokens"]
+        return response
+
+    def prompt_cache(self, model_id, prefix, response):
+        """
+        Split the input tokens of a response like Bedrock prompt caching: the prefix is read from the cache
+        if the same prefix was sent within the cache TTL, otherwise it is written to the cache
+        """
+        tokens = min(estimate_tokens(prefix), response["input_tokens"])
+        key = request_key("prompt_cache", model_id, prefix)
+        now = time.monotonic()
+        with self._lock:
+            hit = self._prompt_cache.get(key, 0) > now
+            self._prompt_cache[key] = now + self.prompt_cache_ttl
+            if hit:
+                self.cache_read_tokens += tokens
+            else:
+                self.cache_write_tokens += tokens
+        response["input_tokens"] -= tokens
+        response["cache_read_input_tokens"] = tokens if hit else 0
+        response["cache_creation_input_tokens"] = 0 if hit else tokens
+
+    def chunks(self, text):
+        size = self.chunk_tokens * 4
+        return [text[i:i + size] for i in range(0, len(text), size)] or [""]
+
+    def stats(self):
+        with self._lock:
+            return {
+                "calls": self.calls,
+                "throttled": self.throttled,
+                "input_tokens": self.input_tokens,
+                "output_tokens": self.output_tokens,
+                "cache_read_tokens": self.cache_read_tokens,
+                "cache_write_tokens": self.cache_write_tokens,
+            }
+
+    def reset(self):
+        with self._lock:
+            self.calls = 0
+            self.throttled = 0
+            self.input_tokens = 0
+            self.output_tokens = 0
+            self.cache_read_tokens = 0
+            self.cache_write_tokens = 0
+            self._prompt_cache.clear()
+            self._window.clear()
+
+
+_simulator = None
+_simulator_lock = threading.Lock()
+
+
+def get_simulator():
+    global _simulator
+    if _simulator is None:
+        with _simulator_lock:
+            if _simulator is None:
+                _simulator = Simulator()
+    return _simulator
+
+
+def bedrock_request(body):
+    return json.loads(body) if isinstance(body, (str, bytes)) else body
+
+
+def bedrock_usage(response):
+    usage = {"input_tokens": response["input_tokens"], "output_tokens": response["output_tokens"]}
+    for field in ("cache_read_input_tokens", "cache_creation_input_tokens"):
+        if field in response:
+            usage[field] = response[field]
+    return usage
+
+
+def bedrock_response_body(model_id, response):
+    return {
+        "id": "msg_simulated",
+        "type": "message",
+        "role": "assistant",
+        "model": model_id,
+        "content": [{"type": "text", "text": response["text"]}],
+        "stop_reason": response["stop_reason"],
+        "stop_sequence": response["stop_sequence"],
+        "usage": bedrock_usage(response),
+    }
+
+
+def stream_event(payload):
+    return {"chunk": {"bytes": json.dumps(payload).encode()}}
+
+
+def bedrock_stream_payloads(model_id, response, text_chunks):
+    """
+    The Anthropic streaming events of a response
+    """
+    message = bedrock_response_body(model_id, response)
+    message.update(content=[], stop_reason=None, stop_sequence=None)
+    message["usage"] = {**bedrock_usage(response), "output_tokens": 0}
+    yield {"type": "message_start", "message": message}
+    yield {"type": "content_block_start", "index": 0, "content_block": {"type": "text", "text": ""}}
+    for index, text in enumerate(text_chunks):
+        yield {"type": "content_block_delta", "index": 0, "delta": {"type": "text_delta", "text": text}, "_first": index == 0}
+    yield {"type": "content_block_stop", "index": 0}
+    yield {
+        "type": "message_delta",
+        "delta": {"stop_reason": response["stop_reason"], "stop_sequence": response["stop_sequence"]},
+        "usage": {"output_tokens": response["output_tokens"]},
+    }
+    yield {"type": "message_stop"}
+
+
+def bedrock_respond(model_id, body):
+    request = bedrock_request(body)
+    return get_simulator().respond(
+        "bedrock",
+        model_id,
+        request,
+        request.get("messages", []),
+        system=request.get("system"),
+        max_tokens=request.get("max_tokens"),
+        stop_sequences=request.get("stop_sequences"),
+    )
+
+
+class SimulatedBedrockClient:
+    """
+    Stand-in for a boto3 bedrock-runtime client
+    """
+
+    def invoke_model(self, body, modelId, **kwargs):
+        simulator = get_simulator()
+        simulator.admit("InvokeModel")
+        response = bedrock_respond(modelId, body)
+        time.sleep(simulator.total_delay(response))
+        payload = json.dumps(bedrock_response_body(modelId, response)).encode()
+        return {"body": io.BytesIO(payload), "contentType": "application/json"}
+
+    def invoke_model_with_response_stream(self, body, modelId, **kwargs):
+        simulator = get_simulator()
+        simulator.admit("InvokeModelWithResponseStream")
+        response = bedrock_respond(modelId, body)
+        first, per_chunk = simulator.delays()
+
+        def events():
+            time.sleep(first)
+            for payload in bedrock_stream_payloads(modelId, response, simulator.chunks(response["text"])):
+                # Every chunk after the first takes the time to generate its tokens
+                if payload.pop("_first", True) is False:
+                    time.sleep(per_chunk)
+                yield stream_event(payload)
+
+        return {"body": events(), "contentType": "application/json"}
+
+
+class _AsyncBody:
+    def __init__(self, payload):
+        self.payload = payload
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        return False
+
+    async def read(self):
+        return self.payload
+
+
+class AsyncSimulatedBedrockClient:
+    """
+    Stand-in for an aiobotocore bedrock-runtime client
+    """
+
+    async def invoke_model(self, body, modelId, **kwargs):
+        simulator = get_simulator()
+        simulator.admit("InvokeModel")
+        response = bedrock_respond(modelId, body)
+        await asyncio.sleep(simulator.total_delay(response))
+        return {"body": _AsyncBody(json.dumps(bedrock_response_body(modelId, response)).encode())}
+
+    async def invoke_model_with_response_stream(self, body, modelId, **kwargs):
+        simulator = get_simulator()
+        simulator.admit("InvokeModelWithResponseStream")
+        response = bedrock_respond(modelId, body)
+        first, per_chunk = simulator.delays()
+
+        async def events():
+            await asyncio.sleep(first)
+            for payload in bedrock_stream_payloads(modelId, response, simulator.chunks(response["text"])):
+                if payload.pop("_first", True) is False:
+                    await asyncio.sleep(per_chunk)
+                yield stream_event(payload)
+
+        return {"body": events()}
+
+
+def openai_respond(model, messages, params):
+    system = "\n".join(message["content"] for message in messages if message.get("role") == "system")
+    conversation = [message for message in messages if message.get("role") != "system"]
+    stop = params.get("stop")
+    return get_simulator().respond(
+        "openai",
+        model,
+        {"messages": messages, **params},
+        conversation,
+        system=system or None,
+        max_tokens=params.get("max_tokens"),
+        stop_sequences=[stop] if isinstance(stop, str) else stop,
+    )
+
+
+def openai_completion(model, response):
+    finish_reason = "length" if response["stop_reason"] == "max_tokens" else "stop"
+    return SimpleNamespace(
+        id="chatcmpl-simulated",
+        model=model,
+        choices=[SimpleNamespace(
+            index=0,
+            message=SimpleNamespace(role="assistant", content=response["text"]),
+            finish_reason=finish_reason,
+        )],
+        usage=SimpleNamespace(
+            prompt_tokens=response["input_tokens"],
+            completion_tokens=response["output_tokens"],
+            total_tokens=response["input_tokens"] + response["output_tokens"],
+        ),
+    )
+
+
+def openai_chunk(model, content, finish_reason=None):
+    return SimpleNamespace(
+        id="chatcmpl-simulated",
+        model=model,
+        choices=[SimpleNamespace(index=0, delta=SimpleNamespace(content=content), finish_reason=finish_reason)],
+    )
+
+
+class _SimulatedCompletions:
+    def create(self, model, messages, stream=False, **params):
+        simulator = get_simulator()
+        simulator.admit("ChatCompletions")
+        response = openai_respond(model, messages, params)
+        if not stream:
+            time.sleep(simulator.total_delay(response))
+            return openai_completion(model, response)
+        first, per_chunk = simulator.delays()
+
+        def chunks():
+            time.sleep(first)
+            for index, text in enumerate(simulator.chunks(response["text"])):
+                if index:
+                    time.sleep(per_chunk)
+                yield openai_chunk(model, text)
+            yield openai_chunk(model, None, "stop")
+
+        return chunks()
+
+
+class _AsyncSimulatedCompletions:
+    async def create(self, model, messages, stream=False, **params):
+        simulator = get_simulator()
+        simulator.admit("ChatCompletions")
+        response = openai_respond(model, messages, params)
+        if not stream:
+            await asyncio.sleep(simulator.total_delay(response))
+            return openai_completion(model, response)
+        first, per_chunk = simulator.delays()
+
+        async def chunks():
+            await asyncio.sleep(first)
+            for index, text in enumerate(simulator.chunks(response["text"])):
+                if index:
+                    await asyncio.sleep(per_chunk)
+                yield openai_chunk(model, text)
+            yield openai_chunk(model, None, "stop")
+
+        return chunks()
+
+
+class SimulatedOpenAI:
+    """
+    Stand-in for an openai.OpenAI client
+    """
+
+    def __init__(self):
+        self.chat = SimpleNamespace(completions=_SimulatedCompletions())
+
+
+class AsyncSimulatedOpenAI:
+    """
+    Stand-in for an openai.AsyncOpenAI client
+    """
+
+    def __init__(self):
+        self.chat = SimpleNamespace(completions=_AsyncSimulatedCompletions())
+
+    async def close(self):
+        pass
+
+
+class RecordingBedrockClient:
+    """
+    Wraps a live bedrock-runtime client and records every response it returns
+    """
+
+    def __init__(self, client):
+        self.client = client
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
+
+    def invoke_model(self, body, modelId, **kwargs):
+        result = self.client.invoke_model(body=body, modelId=modelId, **kwargs)
+        payload = result["body"].read()
+        response_body = json.loads(payload)
+        content = response_body.get("content") or []
+        usage = response_body.get("usage", {})
+        get_simulator().recordings.add(request_key("bedrock", modelId, bedrock_request(body)), "bedrock", modelId, {
+            "text": content[0]["text"] if content else "",
+            "stop_reason": response_body.get("stop_reason"),
+            "stop_sequence": response_body.get("stop_sequence"),
+            "input_tokens": usage.get("input_tokens", 0),
+            "output_tokens": usage.get("output_tokens", 0),
+        })
+        return {**result, "body": io.BytesIO(payload)}
+
+    def invoke_model_with_response_stream(self, body, modelId, **kwargs):
+        result = self.client.invoke_model_with_response_stream(body=body, modelId=modelId, **kwargs)
+
+        def events():
+            response = {"text": "", "stop_reason": None, "stop_sequence": None, "input_tokens": 0, "output_tokens": 0}
+            for event in result["body"]:
+                chunk = event.get("chunk")
+                if chunk:
+                    payload = json.loads(chunk.get("bytes").decode())
+                    if payload.get("type") == "message_start":
+                        response["input_tokens"] = payload["message"].get("usage", {}).get("input_tokens", 0)
+                    elif payload.get("type") == "content_block_delta":
+                        response["text"] += payload.get("delta", {}).get("text", "")
+                    elif payload.get("type") == "message_delta":
+                        response["stop_reason"] = payload["delta"].get("stop_reason")
+                        response["stop_sequence"] = payload["delta"].get("stop_sequence")
+                        response["output_tokens"] = payload.get("usage", {}).get("output_tokens", 0)
+                yield event
+            get_simulator().recordings.add(request_key("bedrock", modelId, bedrock_request(body)), "bedrock", modelId, response)
+
+        return {**result, "body": events()}
+
+
+class _RecordingCompletions:
+    def __init__(self, completions):
+        self.completions = completions
+
+    def create(self, model, messages, stream=False, **params):
+        key = request_key("openai", model, {"messages": messages, **params})
+        if stream:
+            result = self.completions.create(model=model, messages=messages, stream=True, **params)
+
+            def chunks():
+                text = ""
+                for chunk in result:
+                    if chunk.choices and chunk.choices[0].delta.content:
+                        text += chunk.choices[0].delta.content
+                    yield chunk
+                get_simulator().recordings.add(key, "openai", model, {
+                    "text": text,
+                    "stop_reason": "end_turn",
+                    "stop_sequence": None,
+                    "input_tokens": estimate_tokens(messages),
+                    "output_tokens": output_tokens(text),
+                })
+
+            return chunks()
+        completion = self.completions.create(model=model, messages=messages, **params)
+        usage = completion.usage
+        get_simulator().recordings.add(key, "openai", model, {
+            "text": completion.choices[0].message.content or "",
+            "stop_reason": "max_tokens" if completion.choices[0].finish_reason == "length" else "end_turn",
+            "stop_sequence": None,
+            "input_tokens": usage.prompt_tokens if usage else 0,
+            "output_tokens": usage.completion_tokens if usage else 0,
+        })
+        return completion
+
+
+class RecordingOpenAI:
+    """
+    Wraps a live openai.OpenAI client and records every chat completion it returns
+    """
+
+    def __init__(self, client):
+        self.client = client
+        self.chat = SimpleNamespace(completions=_RecordingCompletions(client.chat.completions))
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
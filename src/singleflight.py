@@ -0,0 +1,104 @@
+import asyncio
+import hashlib
+import json
+import threading
+from concurrent.futures import Future
+
+
+class LeaderCancelled(Exception):
+    """
+    The call a waiter was sharing was cancelled by its caller, the waiter has to make its own
+    """
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent identical calls: the first caller of a key runs the call,
+    callers arriving while it is in flight wait for it and get the same result (or exception).
+
+    Works across threads and event loops: each in-flight call is a concurrent.futures.Future,
+    which threads block on and coroutines await through asyncio.wrap_future.
+    Results are shared, so callers must not mutate them.
+    """
+
+    def __init__(self):
+        self.calls = 0
+        self.coalesced = 0
+        self._lock = threading.Lock()
+        self._in_flight = {}
+
+    @staticmethod
+    def make_key(*parts):
+        payload = json.dumps(parts, sort_keys=True, ensure_ascii=False, default=str)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def _join(self, key):
+        """
+        :return: (future, True if the caller has to run the call)
+        """
+        with self._lock:
+            self.calls += 1
+            future = self._in_flight.get(key)
+            if future is not None:
+                self.coalesced += 1
+                return future, False
+            future = Future()
+            self._in_flight[key] = future
+            return future, True
+
+    def _leave(self, key, future):
+        with self._lock:
+            if self._in_flight.get(key) is future:
+                del self._in_flight[key]
+
+    def do(self, key, fn):
+        """
+        Run `fn`, or wait for the identical call already in flight
+        """
+        while True:
+            future, leader = self._join(key)
+            if not leader:
+                try:
+                    return future.result()
+                except LeaderCancelled:
+                    continue
+            try:
+                result = fn()
+            except BaseException as e:
+                future.set_exception(e)
+                raise
+            else:
+                future.set_result(result)
+                return result
+            finally:
+                self._leave(key, future)
+
+    async def ado(self, key, fn):
+        """
+        Async version of `do`, `fn` returns an awaitable
+        """
+        while True:
+            future, leader = self._join(key)
+            if not leader:
+                try:
+                    # Shielded so a waiter being cancelled does not cancel the shared call
+                    return await asyncio.shield(asyncio.wrap_future(future))
+                except LeaderCancelled:
+                    continue
+            try:
+                result = await fn()
+            except asyncio.CancelledError:
+                future.set_exception(LeaderCancelled())
+                raise
+            except BaseException as e:
+                future.set_exception(e)
+                raise
+            else:
+                future.set_result(result)
+                return result
+            finally:
+                self._leave(key, future)
+
+    def stats(self):
+        with self._lock:
+            return {"calls": self.calls, "coalesced": self.coalesced, "in_flight": len(self._in_flight)}
@@ -0,0 +1,58 @@
+import json
+import os
+
+import pytest
+
+SRC_DIR = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# The modules read their prompt files relative to src, and nothing may leave the machine
+os.chdir(SRC_DIR)
+os.environ.update({
+    "LLM_BACKEND": "replay",
+    "LLM_SIM_LATENCY_MS": "0",
+    "LLM_SIM_MS_PER_TOKEN": "0",
+    "LLM_SIM_JITTER": "0",
+    "LLM_SIM_THROTTLE_RATE": "0",
+    "LLM_SIM_RPM": "0",
+    "LLM_RATE_LIMIT_RPM": "0",
+    "LLM_RATE_LIMIT_TPM": "0",
+    "LLM_METRICS_PORT": "0",
+    "CALIBRATION_CACHE": "0",
+    "CALIBRATION_CONCURRENCY": "4",
+})
+
+import gateway  # noqa: E402
+import ratelimit  # noqa: E402
+import simulator  # noqa: E402
+
+
+@pytest.fixture(autouse=True)
+def offline(tmp_path, monkeypatch):
+    """
+    Keep every file a test writes under its tmp_path, and start each test with a fresh simulator,
+    response cache and set of rate limiters
+    """
+    monkeypatch.setenv("LLM_RECORDINGS", str(tmp_path / "recordings.jsonl"))
+    monkeypatch.setenv("LLM_RESPONSE_CACHE_PATH", str(tmp_path / "response_cache.sqlite"))
+    monkeypatch.setenv("CALIBRATION_CACHE_PATH", str(tmp_path / "prediction_cache.sqlite"))
+    monkeypatch.setenv("CALIBRATION_CHECKPOINT_DIR", str(tmp_path / "runs"))
+    monkeypatch.setattr(simulator, "_simulator", None)
+    monkeypatch.setattr(gateway.gateway, "_cache", None)
+    monkeypatch.setattr(ratelimit, "_limiters", {})
+    return tmp_path
+
+
+@pytest.fixture
+def sim_rules(tmp_path, monkeypatch):
+    """
+    Answer the simulated requests with fixture rules, a list of (regex, response) tried in order
+    :return: A function taking the rules and returning the simulator that uses them
+    """
+    def use(rules):
+        path = tmp_path / "fixtures.json"
+        path.write_text(json.dumps([{"match": match, "response": response} for match, response in rules]), encoding="utf-8")
+        monkeypatch.setenv("LLM_SIM_FIXTURES", str(path))
+        monkeypatch.setattr(simulator, "_simulator", None)
+        return simulator.get_simulator()
+
+    return use
@@ -0,0 +1,105 @@
+import asyncio
+import time
+
+import pytest
+
+import app
+
+ORIGINAL_PROMPT = "Summarize the document in <doc>{document}</doc> for a busy reader."
+RULES = [
+    (r"evaluate which of the \w+ instructions", '"Preferred": "Instruction 2"}'),
+    (r"Your task is to rewrite the initial instruction", "Summarize the document in three sentences."),
+]
+
+
+@pytest.fixture
+def textboxes(monkeypatch):
+    # Render the textboxes as plain tuples, so the updates can be compared
+    monkeypatch.setattr(app, "candidate_textbox", lambda i, value="", best=None, numbered=True: (value, best))
+    monkeypatch.setattr(app, "rewrite_candidates", 3)
+
+
+def collect(level):
+    async def run():
+        return [update async for update in app.generate_prompt(ORIGINAL_PROMPT, level)]
+
+    return asyncio.run(run())
+
+
+def test_candidates_are_rendered_as_they_finish(textboxes, monkeypatch):
+    delays = iter([0.2, 0.0, 0.1])
+    judged = []
+
+    async def acall(prompt):
+        delay = next(delays)
+        await asyncio.sleep(delay)
+        return f"rewrite after {delay}"
+
+    async def ajudge(candidates):
+        judged.append(candidates)
+        return 0
+
+    monkeypatch.setattr(app.rewrite, "acall", acall)
+    monkeypatch.setattr(app.rewrite, "ajudge", ajudge)
+    updates = collect("Multiple-time Generation")
+    assert updates == [
+        [("", None), ("", None), ("", None)],
+        [("", None), ("rewrite after 0.0", None), ("", None)],
+        [("", None), ("rewrite after 0.0", None), ("rewrite after 0.1", None)],
+        [("rewrite after 0.2", None), ("rewrite after 0.0", None), ("rewrite after 0.1", None)],
+        [("rewrite after 0.2", 0), ("rewrite after 0.0", 0), ("rewrite after 0.1", 0)],
+    ]
+    # The judge sees the candidates in their textbox order, not in arrival order
+    assert judged == [["rewrite after 0.2", "rewrite after 0.0", "rewrite after 0.1"]]
+
+
+def test_a_failed_rewrite_raises_and_cancels_the_others(textboxes, monkeypatch):
+    cancelled = []
+
+    async def acall(prompt):
+        if not cancelled:
+            cancelled.append(False)
+            raise ValueError("rewrite failed")
+        try:
+            await asyncio.sleep(5)
+        except asyncio.CancelledError:
+            cancelled.append(True)
+            raise
+
+    monkeypatch.setattr(app.rewrite, "acall", acall)
+
+    async def run():
+        with pytest.raises(ValueError, match="rewrite failed"):
+            async for _ in app.generate_prompt(ORIGINAL_PROMPT, "Multiple-time Generation"):
+                pass
+        await asyncio.sleep(0)
+        return list(cancelled)
+
+    start = time.monotonic()
+    assert asyncio.run(run()) == [False, True, True]
+    assert time.monotonic() - start < 2
+
+
+def test_rewrites_run_concurrently(sim_rules, monkeypatch):
+    monkeypatch.setenv("LLM_SIM_LATENCY_MS", "200")
+    monkeypatch.setenv("LANG_DETECT_MODE", "local")
+    simulator = sim_rules(RULES)
+    received = []
+    start = time.monotonic()
+    candidates, best = asyncio.run(app.generate_candidates(ORIGINAL_PROMPT, 5, lambda i, result: received.append(i)))
+    elapsed = time.monotonic() - start
+    assert candidates == ["Summarize the document in three sentences."] * 5
+    assert best == 1
+    assert sorted(received) == [0, 1, 2, 3, 4]
+    # Five rewrites and a judge, one after the other they would take at least 1.2s
+    assert simulator.calls == 6
+    assert elapsed < 1.0
+
+
+def test_one_time_generation_skips_the_judge(textboxes, sim_rules, monkeypatch):
+    monkeypatch.setenv("LANG_DETECT_MODE", "local")
+    monkeypatch.setattr(app.gr, "Textbox", lambda **kwargs: kwargs)
+    simulator = sim_rules(RULES)
+    updates = collect("One-time Generation")
+    assert updates == [[("Summarize the document in three sentences.", None), {"visible": False}, {"visible": False}]]
+    assert simulator.calls == 1
@@ -0,0 +1,63 @@
+import os
+import zipfile
+
+import pandas as pd
+
+import artifacts
+from artifacts import ArtifactWriter, read_artifact
+
+
+def scored(idx, predict, error=None):
+    return pd.DataFrame({
+        "text": [f"review {idx}"],
+        "label": ["positive"],
+        "predict": [predict],
+        "error": [error],
+        "score": [float(predict == "positive")],
+    }, index=[idx])
+
+
+def test_mixed_type_chunks_share_one_schema(tmp_path):
+    writer = ArtifactWriter(str(tmp_path / "predict"))
+    writer.write_predictions("pass_0", pd.DataFrame({"label": [1, 2], "predict": [1, 2], "error": [None, None]}))
+    writer.write_predictions("pass_0", pd.DataFrame({"label": ["positive", 3], "predict": [None, "negative"],
+                                                     "error": ["ValueError: x", None]}))
+    writer.finish()
+    assert writer.errors == []
+    artifact = read_artifact(writer.directory, "pass_0")
+    assert artifact["label"].tolist() == ["1", "2", "positive", "3"]
+    assert artifact["predict"][:2].tolist() == ["1", "2"]
+    assert pd.isna(artifact["predict"][2])
+    assert artifact["predict"][3] == "negative"
+    assert artifact["error"][2] == "ValueError: x"
+
+
+def test_predictions_are_written_next_to_the_inputs_once(tmp_path):
+    writer = ArtifactWriter(str(tmp_path / "predict"))
+    for name in ("pass_0", "pass_1"):
+        writer.write_predictions(name, scored(0, "positive"))
+        writer.write_predictions(name, scored(1, None, "TimeoutError: slow"))
+    zip_path = writer.finish()
+
+    inputs = read_artifact(writer.directory, "inputs")
+    assert inputs.columns.tolist() == ["text", "label"]
+    assert inputs["text"].tolist() == ["review 0", "review 1"]
+    predictions = read_artifact(writer.directory, "pass_1")
+    assert predictions.columns.tolist() == ["text", "label", "predict", "error", "score"]
+    assert predictions["predict"][0] == "positive"
+    assert predictions["error"][1] == "TimeoutError: slow"
+    assert predictions["score"].tolist() == [1.0, 0.0]
+    with zipfile.ZipFile(zip_path) as archive:
+        assert archive.namelist() == sorted(os.listdir(writer.directory))
+        assert len(archive.namelist()) == 3
+
+
+def test_csv_without_pyarrow(tmp_path, monkeypatch):
+    monkeypatch.setattr(artifacts, "pq", None)
+    writer = ArtifactWriter(str(tmp_path / "predict"))
+    writer.write_predictions("pass_0", scored(0, "positive"))
+    writer.write_predictions("pass_0", scored(1, "negative"))
+    writer.finish()
+    assert sorted(os.listdir(writer.directory)) == ["inputs.csv.gz", "pass_0.csv.gz"]
+    predictions = read_artifact(writer.directory, "pass_0")
+    assert predictions["predict"].tolist() == ["positive", "negative"]
@@ -0,0 +1,94 @@
+import time
+
+from cache import MemoryCache, PredictionCache, ResponseCache
+from calibration import CalibrationPrompt
+from gateway import bedrock_body, gateway
+from simulator import get_simulator
+
+MODEL_ID = "anthropic.claude-3-haiku-20240307-v1:0"
+
+
+def test_prediction_cache_hit_and_miss(tmp_path):
+    cache = PredictionCache(str(tmp_path / "cache.sqlite"), max_bytes=1024)
+    key = cache.make_key(MODEL_ID, "prompt", {"max_tokens": 10})
+    assert cache.get(key) is None
+    cache.set(key, "answer")
+    assert cache.get(key) == "answer"
+    assert cache.get(cache.make_key(MODEL_ID, "prompt", {"max_tokens": 20})) is None
+    assert cache.stats()["hits"] == 1
+    assert cache.stats()["misses"] == 2
+
+
+def test_prediction_cache_persists(tmp_path):
+    path = str(tmp_path / "cache.sqlite")
+    PredictionCache(path, max_bytes=1024).set("key", "answer")
+    assert PredictionCache(path, max_bytes=1024).get("key") == "answer"
+
+
+def test_prediction_cache_ttl(tmp_path, monkeypatch):
+    cache = PredictionCache(str(tmp_path / "cache.sqlite"), max_bytes=1024, ttl=60)
+    cache.set("key", "answer")
+    now = time.time()
+    monkeypatch.setattr(time, "time", lambda: now + 30)
+    assert cache.get("key") == "answer"
+    monkeypatch.setattr(time, "time", lambda: now + 90)
+    assert cache.get("key") is None
+    assert cache.stats()["expirations"] == 1
+    assert cache.stats()["entries"] == 0
+
+
+def test_prediction_cache_evicts_least_recently_used(tmp_path):
+    cache = PredictionCache(str(tmp_path / "cache.sqlite"), max_bytes=10)
+    cache.set("a", "aaaa")
+    time.sleep(0.01)
+    cache.set("b", "bbbb")
+    time.sleep(0.01)
+    cache.get("a")
+    cache.set("c", "cccc")
+    assert cache.get("a") == "aaaa"
+    assert cache.get("b") is None
+    assert cache.get("c") == "cccc"
+    assert cache.stats()["bytes"] <= 10
+
+
+def test_calibration_predictions_are_cached(tmp_path):
+    calibration = CalibrationPrompt(cache=PredictionCache(str(tmp_path / "cache.sqlite")))
+    first = calibration.invoke_model("Classify: great", use_cache=True)
+    assert calibration.invoke_model("Classify: great", use_cache=True) == first
+    assert get_simulator().calls == 1
+    # Calls that may not be answered from the cache always reach the model
+    calibration.invoke_model("Classify: great")
+    assert get_simulator().calls == 2
+
+
+def test_memory_cache_ttl_and_size():
+    cache = MemoryCache(max_bytes=8, ttl=60)
+    cache.set("old", "value", created_at=time.time() - 120)
+    assert cache.get("old") is None
+    cache.set("a", "aaaa")
+    cache.set("b", "bbbb")
+    cache.set("c", "cccc")
+    assert cache.get("a") is None
+    assert cache.stats()["evictions"] == 1
+    assert cache.stats()["bytes"] == 8
+
+
+def test_response_cache_promotes_disk_hits(tmp_path):
+    path = str(tmp_path / "responses.sqlite")
+    ResponseCache(path, memory_bytes=1024, disk_bytes=1024, ttl=0).set("key", "answer")
+    cache = ResponseCache(path, memory_bytes=1024, disk_bytes=1024, ttl=0)
+    assert cache.get("key") == "answer"
+    assert cache.get("key") == "answer"
+    stats = cache.stats()
+    assert stats["disk"]["hits"] == 1
+    assert stats["memory"]["hits"] == 1
+
+
+def test_gateway_caches_deterministic_calls():
+    body = bedrock_body([{"role": "user", "content": "What is 2 + 2?"}], max_tokens=20)
+    first = gateway.invoke(MODEL_ID, body, deterministic=True)
+    second = gateway.invoke(MODEL_ID, body, deterministic=True)
+    assert first == second
+    assert get_simulator().calls == 1
+    gateway.invoke(MODEL_ID, body)
+    assert get_simulator().calls == 2
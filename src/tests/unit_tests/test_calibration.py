@@ -0,0 +1,344 @@
+import time
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from calibration import CalibrationHistory, CalibrationPrompt, EvaluationMetrics
+from postprocess import Postprocessor
+from simulator import get_simulator
+
+POSTPROCESS = """
+def postprocess(llm_output):
+    return llm_output.strip()
+"""
+
+
+@pytest.fixture
+def sentiment(sim_rules):
+    sim_rules([
+        (r"^Careful: ", "positive"),
+        (r"^Careless: ", "negative"),
+        (r"^Coin flip: .*[02468]$", "positive"),
+        (r"^Coin flip: ", "negative"),
+    ])
+    return pd.DataFrame({"text": [f"great product {idx}" for idx in range(400)], "label": "positive"})
+
+
+@pytest.fixture
+def postprocessor():
+    postprocessor = Postprocessor(POSTPROCESS)
+    yield postprocessor
+    postprocessor.close()
+
+
+def test_iter_dataset_reads_every_source_in_chunks(sentiment, tmp_path):
+    calibration = CalibrationPrompt(chunksize=150)
+    path = tmp_path / "dataset.csv"
+    sentiment.to_csv(path, index=None)
+    for dataset in (sentiment, str(path), path.read_bytes()):
+        chunks = list(calibration.iter_dataset(dataset))
+        assert [len(chunk) for chunk in chunks] == [150, 150, 100]
+        assert pd.concat(chunks)["text"].tolist() == sentiment["text"].tolist()
+
+
+def test_evaluate_scores_the_whole_dataset(sentiment, postprocessor):
+    calibration = CalibrationPrompt(chunksize=64)
+    result = calibration.evaluate("Coin flip: {text}", sentiment, postprocessor)
+    assert result["score"] == pytest.approx(0.5)
+    assert result["labels"] == ["positive"]
+    assert result["num_rows"] == len(sentiment)
+
+
+def test_sampled_fractions_are_nested(sentiment):
+    calibration = CalibrationPrompt(chunksize=100)
+    small = pd.concat(calibration.iter_dataset(sentiment, 0.2))
+    large = pd.concat(calibration.iter_dataset(sentiment, 0.5))
+    rest = pd.concat(calibration.iter_dataset(sentiment, 0.5, start_fraction=0.2))
+    assert 0 < len(small) < len(large) < len(sentiment)
+    assert set(small.index) <= set(large.index)
+    assert sorted(small.index.tolist() + rest.index.tolist()) == sorted(large.index.tolist())
+
+
+def test_sampled_chunks_are_copies(sentiment):
+    calibration = CalibrationPrompt(chunksize=100)
+    for chunk in calibration.iter_dataset(sentiment, 0.5):
+        chunk["predict"] = "positive"
+    assert "predict" not in sentiment
+
+
+def test_successive_halving_spends_little_on_bad_candidates(sentiment, postprocessor):
+    calibration = CalibrationPrompt()
+    candidates = ["Careless: {text}", "Coin flip: {text}", "Careful: {text}"]
+    best, evaluation = calibration.successive_halving(candidates, sentiment, postprocessor)
+    assert best == "Careful: {text}"
+    assert evaluation["score"] == 1.0
+    assert evaluation["num_rows"] == len(sentiment)
+    assert get_simulator().calls < 2 * len(sentiment)
+
+
+def scored(labels, predictions, start=0):
+    chunk = pd.DataFrame({"text": [f"row {idx}" for idx in range(start, start + len(labels))],
+                          "label": labels, "predict": predictions},
+                         index=range(start, start + len(labels)))
+    chunk["score"] = chunk["label"] == chunk["predict"]
+    return chunk
+
+
+def test_metrics_over_chunks():
+    metrics = EvaluationMetrics(num_errors_per_label=1)
+    metrics.update(scored(["a", "a", "b"], ["a", "b", "b"]))
+    metrics.update(scored(["b", "a", "c"], ["a", "b", "c"], start=3))
+    summary = metrics.summary()
+    assert summary["score"] == pytest.approx(3 / 6)
+    assert summary["num_rows"] == 6
+    assert summary["labels"] == ["a", "b", "c"]
+    np.testing.assert_array_equal(summary["confusion_matrix"], [[1, 2, 0], [1, 1, 0], [0, 0, 1]])
+    # At most one sampled error per label
+    assert sorted(summary["errors"]["label"]) == ["a", "b"]
+    assert list(summary["errors"].columns) == ["text", "label", "predict", "score"]
+
+
+def test_metrics_without_errors():
+    metrics = EvaluationMetrics(num_errors_per_label=3)
+    metrics.update(scored(["a", "b"], ["a", "b"]))
+    summary = metrics.summary()
+    assert summary["score"] == 1.0
+    assert summary["errors"].empty
+    assert EvaluationMetrics(3).summary()["score"] == 0.0
+
+
+def test_confusion_ignores_missing_and_unknown_predictions():
+    metrics = EvaluationMetrics(num_errors_per_label=3)
+    metrics.update(scored(["a", "b", "a"], ["a", None, "maybe"]))
+    metrics.update(scored([1, 2], [1, 1], start=3))
+    summary = metrics.summary()
+    assert summary["labels"] == ["a", "b", 1, 2]
+    np.testing.assert_array_equal(summary["confusion_matrix"], [[1, 0, 0, 0], [0, 0, 0, 0], [0, 0, 1, 0], [0, 0, 1, 0]])
+
+
+def test_metrics_match_a_full_pass():
+    rng = np.random.default_rng(0)
+    labels = np.array(["x", "y", "z"])
+    dataset = scored(labels[rng.integers(0, 3, 5000)].tolist(), labels[rng.integers(0, 3, 5000)].tolist())
+    metrics = EvaluationMetrics(num_errors_per_label=4)
+    for start in range(0, len(dataset), 300):
+        metrics.update(dataset.iloc[start:start + 300])
+    summary = metrics.summary()
+    expected = pd.crosstab(dataset["label"], dataset["predict"]).reindex(index=summary["labels"], columns=summary["labels"])
+    np.testing.assert_array_equal(summary["confusion_matrix"], expected.to_numpy())
+    assert summary["score"] == pytest.approx(dataset["score"].mean())
+    errors = summary["errors"]
+    assert errors.groupby("label").size().tolist() == [4, 4, 4]
+    assert not errors["score"].any()
+    pd.testing.assert_frame_equal(errors, dataset.loc[errors.index])
+
+
+def test_score_interval():
+    calibration = CalibrationPrompt()
+    assert calibration.score_interval(0, 0) == (0.0, 1.0)
+    lower, upper = calibration.score_interval(80, 100)
+    assert lower < 0.8 < upper
+    narrow_lower, narrow_upper = calibration.score_interval(800, 1000)
+    assert lower < narrow_lower and narrow_upper < upper
+
+
+@pytest.mark.parametrize("prompt, decision", [
+    ("Careful: {text}", "better"),
+    ("Careless: {text}", "worse"),
+])
+def test_sequential_decision_stops_early(sentiment, postprocessor, prompt, decision):
+    result = CalibrationPrompt().evaluate_sequential(prompt, sentiment, postprocessor, baseline_score=0.5)
+    assert result["decision"] == decision
+    assert 0 < result["num_rows"] < len(sentiment)
+
+
+def test_sequential_undecided_reads_the_whole_dataset(sentiment, postprocessor):
+    result = CalibrationPrompt().evaluate_sequential("Coin flip: {text}", sentiment, postprocessor, baseline_score=0.5)
+    assert result["decision"] == "undecided"
+    assert result["num_rows"] == len(sentiment)
+    assert result["score"] == pytest.approx(0.5)
+
+
+@pytest.mark.parametrize("min_fraction", ["0", "-1", "5"])
+def test_sequential_min_fraction_is_clamped(sentiment, postprocessor, monkeypatch, min_fraction):
+    monkeypatch.setenv("CALIBRATION_SEQUENTIAL_MIN_FRACTION", min_fraction)
+    calibration = CalibrationPrompt()
+    assert 0 < calibration.sequential_min_fraction <= 1
+    result = calibration.evaluate_sequential("Coin flip: {text}", sentiment, postprocessor, baseline_score=0.5)
+    assert result["num_rows"] == len(sentiment)
+
+
+def test_step_drops_candidates_that_are_clearly_worse(sentiment, sim_rules, postprocessor, monkeypatch):
+    monkeypatch.setenv("CALIBRATION_SEQUENTIAL_TEST", "1")
+    sim_rules([
+        (r"provide a high quality analysis", "<analysis>Half of the rows are wrong.</analysis>"),
+        (r"<instruction_guide>", "<new_prompt>Careless: {text}</new_prompt>"),
+        (r"^Coin flip: .*[02468]$", "positive"),
+        (r"^Coin flip: ", "negative"),
+        (r"^Careless: ", "negative"),
+    ])
+    calibration = CalibrationPrompt()
+    evaluation = calibration.evaluate("Coin flip: {text}", sentiment, postprocessor)
+    result = calibration.step("Classify", "Coin flip: {text}", sentiment, postprocessor, CalibrationHistory(), evaluation)
+    # The incumbent is kept and the rejected candidate was never scored on the full dataset
+    assert result["cur_prompt"] == "Coin flip: {text}"
+    assert get_simulator().calls < 2 * len(sentiment)
+
+
+def history_of(scores):
+    history = CalibrationHistory()
+    for score in scores:
+        history.append("prompt", {"score": score, "errors": pd.DataFrame(), "labels": [], "confusion_matrix": []}, "analysis")
+    return history
+
+
+def test_stop_reason_on_flat_scores():
+    calibration = CalibrationPrompt()
+    assert calibration.stop_reason(history_of([0.8, 0.8, 0.8]), 0.8, time.time()).startswith("No improvement")
+    assert calibration.stop_reason(history_of([0.8]), 0.8, time.time()) is None
+
+
+def test_stop_reason_needs_more_than_min_delta(monkeypatch):
+    monkeypatch.setenv("CALIBRATION_MIN_DELTA", "0.05")
+    calibration = CalibrationPrompt()
+    assert calibration.stop_reason(history_of([0.7, 0.72, 0.74]), 0.75, time.time()).startswith("No improvement")
+    assert calibration.stop_reason(history_of([0.7, 0.72, 0.74]), 0.78, time.time()) is None
+
+
+def test_stop_reason_on_target_and_time_budget(monkeypatch):
+    monkeypatch.setenv("CALIBRATION_TARGET_SCORE", "0.9")
+    monkeypatch.setenv("CALIBRATION_TIME_BUDGET", "60")
+    calibration = CalibrationPrompt()
+    assert calibration.stop_reason(history_of([0.5]), 0.95, time.time()).startswith("Reached the target score")
+    assert calibration.stop_reason(history_of([0.5]), 0.6, time.time() - 120).startswith("Exceeded the time budget")
+    assert calibration.stop_reason(history_of([0.5]), 0.6, time.time()) is None
+
+
+def test_patience_zero_never_stops_on_a_plateau(monkeypatch):
+    monkeypatch.setenv("CALIBRATION_PATIENCE", "0")
+    assert CalibrationPrompt().stop_reason(history_of([0.5, 0.5, 0.5]), 0.5, time.time()) is None
+
+
+BATCH_RULES = [
+    (r"Apply the instruction separately", '<output id="1"> positive </output>\n<output id="2">negative</output>'),
+    (r"^Label: ", "neutral"),
+]
+
+
+def test_batch_reply_is_parsed_per_item(sim_rules, postprocessor):
+    sim_rules(BATCH_RULES)
+    calibration = CalibrationPrompt()
+    items = [(f"Label: {text}", {"text": text}) for text in ("great", "awful")]
+    assert calibration.predict_batch("Label: {text}", items, postprocessor) == [("positive", None), ("negative", None)]
+    assert get_simulator().calls == 1
+
+
+def test_unanswered_batch_items_fall_back_to_single_calls(sim_rules, postprocessor):
+    sim_rules(BATCH_RULES)
+    calibration = CalibrationPrompt()
+    items = [(f"Label: {text}", {"text": text}) for text in ("great", "awful", "fine")]
+    results = calibration.predict_batch("Label: {text}", items, postprocessor)
+    assert results == [("positive", None), ("negative", None), ("neutral", None)]
+    assert get_simulator().calls == 2
+
+
+def test_unparseable_batch_reply_falls_back_for_every_item(sim_rules, postprocessor):
+    sim_rules([(r"Apply the instruction separately", "Sorry, I can't help with that."), (r"^Label: ", "neutral")])
+    calibration = CalibrationPrompt()
+    items = [(f"Label: {text}", {"text": text}) for text in ("great", "awful")]
+    assert calibration.predict_batch("Label: {text}", items, postprocessor) == [("neutral", None)] * 2
+    assert get_simulator().calls == 3
+
+
+def test_get_output_packs_rows_into_batches(sim_rules, monkeypatch):
+    monkeypatch.setenv("CALIBRATION_BATCH_SIZE", "2")
+    sim_rules(BATCH_RULES)
+    dataset = pd.DataFrame({"text": ["great", "awful", "great", "fine", "meh"]})
+    predictions = CalibrationPrompt().get_output("Label: {text}", dataset, POSTPROCESS, return_df=True)
+    # Duplicate rows are sent once: "great", "awful" | "fine", "meh"
+    assert predictions["predict"].tolist() == ["positive", "negative", "positive", "positive", "negative"]
+    assert predictions["error"].isna().all()
+    assert get_simulator().calls == 2
+
+
+@pytest.fixture
+def constrained(monkeypatch):
+    monkeypatch.setenv("CALIBRATION_LABEL_CONSTRAINED", "1")
+    return CalibrationPrompt()
+
+
+def test_label_constraints_are_off_by_default(sentiment):
+    assert CalibrationPrompt().label_constraints(sentiment) is None
+
+
+def test_label_constraints_from_every_source(constrained, tmp_path):
+    dataset = pd.DataFrame({"text": ["a", "b", "c"], "label": ["yes", "no", "yes"]})
+    path = tmp_path / "dataset.csv"
+    dataset.to_csv(path, index=None)
+    for source in (dataset, str(path), path.read_bytes()):
+        constraints = constrained.label_constraints(source)
+        assert constraints["labels"] == {"yes": "yes", "no": "no"}
+        # Labels are never stop sequences on their own, they would match inside longer words
+        assert constraints["settings"] == {"max_tokens": 13}
+
+
+def test_label_constraints_need_a_label_column(constrained):
+    assert constrained.label_constraints(pd.DataFrame({"text": ["a"]})) is None
+    assert constrained.label_constraints(b"text\na\n") is None
+
+
+def test_prefill_tag_is_closed_by_a_stop_sequence(monkeypatch, sim_rules, postprocessor):
+    monkeypatch.setenv("CALIBRATION_LABEL_CONSTRAINED", "1")
+    monkeypatch.setenv("CALIBRATION_LABEL_PREFILL", "<label>")
+    sim_rules([(r"^Answer: ", "no</label> because the text says so")])
+    calibration = CalibrationPrompt()
+    constraints = calibration.label_constraints(pd.DataFrame({"label": ["yes", "no"]}))
+    assert constraints["settings"] == {"max_tokens": 13, "prefill": "<label>", "stop_sequences": ["</label>"]}
+    assert calibration.predict_row("Answer: x", postprocessor, constraints) == ("no", None)
+
+
+def test_output_that_is_not_a_label_is_retried_and_reported(constrained, sim_rules, postprocessor):
+    sim_rules([(r"^Answer: ", "not sure")])
+    constraints = constrained.label_constraints(pd.DataFrame({"label": ["yes", "no"]}))
+    result, error = constrained.predict_row("Answer: x", postprocessor, constraints)
+    # "not sure" must not be cut down to the label "no"
+    assert result == "not sure"
+    assert error == "Output does not map to any label: 'not sure'"
+    assert get_simulator().calls == 2
+
+
+def test_get_output_maps_labels_like_evaluate(constrained, sim_rules, postprocessor):
+    sim_rules([(r"^Rate: .*good", " 1 "), (r"^Rate: ", "0")])
+    dataset = pd.DataFrame({"text": ["good", "bad", "so good"], "label": [1, 0, 0]})
+    predictions = constrained.get_output("Rate: {text}", dataset, POSTPROCESS, return_df=True)
+    assert predictions["predict"].tolist() == [1, 0, 1]
+    evaluation = constrained.evaluate("Rate: {text}", dataset, postprocessor, constraints=constrained.label_constraints(dataset))
+    assert evaluation["score"] == pytest.approx(2 / 3)
+    assert evaluation["errors"]["predict"].tolist() == [1]
+
+
+def evaluation_of(chunk):
+    metrics = EvaluationMetrics(num_errors_per_label=10)
+    metrics.update(chunk)
+    return metrics.summary()
+
+
+def test_history_keeps_error_rows_once(tmp_path):
+    history = CalibrationHistory()
+    history.append("prompt 0", evaluation_of(scored(["a", "a", "b"], ["b", "b", "b"])), "analysis 0")
+    history.append("prompt 1", evaluation_of(scored(["a", "a", "b"], ["a", "b", "b"])), "analysis 1")
+    history.append("prompt 2", evaluation_of(scored(["a", "a", "b"], ["a", "a", "b"])), "analysis 2")
+    assert len(history) == 3
+    assert len(history.base) == 2
+    assert [entry["score"] for entry in history] == pytest.approx([1 / 3, 2 / 3, 1.0])
+    assert history[0]["errors"]["predict"].tolist() == ["b", "b"]
+    assert history[1]["errors"].index.tolist() == [1]
+    assert history[-1]["errors"].empty
+    assert history[1]["confusion_matrix"].dtype == np.int32
+
+    path = tmp_path / "history.pkl"
+    history.save(path)
+    loaded = CalibrationHistory.load(path)
+    assert [entry["prompt"] for entry in loaded] == ["prompt 0", "prompt 1", "prompt 2"]
+    pd.testing.assert_frame_equal(loaded[0]["errors"], history[0]["errors"])
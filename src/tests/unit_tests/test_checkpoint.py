@@ -0,0 +1,109 @@
+import os
+
+import pandas as pd
+import pytest
+
+from calibration import CalibrationPrompt
+from checkpoint import RunCheckpoint
+from simulator import MissingRecordingError
+
+ANALYSIS = "<analysis>The prompt answers positive for every review.</analysis>"
+SUGGESTION = "<new_prompt>Sentiment of {text}</new_prompt>"
+RULES = [
+    (r"provide a high quality analysis", ANALYSIS),
+    (r"<instruction_guide>", SUGGESTION),
+    (r"^Review: ", "positive"),
+    (r"^Sentiment of good", "positive"),
+    (r"^Sentiment of bad", "negative"),
+]
+POSTPROCESS = """
+def postprocess(llm_output):
+    return llm_output.strip()
+"""
+
+
+def test_call_is_replayed_by_a_new_instance(tmp_path):
+    checkpoint = RunCheckpoint("run", directory=str(tmp_path))
+    key = checkpoint.make_key("analysis", 0, "prompt")
+    assert checkpoint.call(key, lambda: "first") == "first"
+    assert checkpoint.call(key, lambda: "second") == "first"
+    resumed = RunCheckpoint("run", directory=str(tmp_path))
+    assert resumed.call(key, lambda: "second") == "first"
+    assert resumed.call(checkpoint.make_key("analysis", 1, "prompt"), lambda: "second") == "second"
+
+
+def test_partial_last_line_is_ignored(tmp_path):
+    checkpoint = RunCheckpoint("run", directory=str(tmp_path))
+    checkpoint.call("done", lambda: "value")
+    with open(os.path.join(checkpoint.path, "calls.jsonl"), "a", encoding="utf-8") as f:
+        f.write('{"key": "interrupted", "val')
+    resumed = RunCheckpoint("run", directory=str(tmp_path))
+    assert resumed.call("done", lambda: "other") == "value"
+    assert resumed.call("interrupted", lambda: "again") == "again"
+
+
+def test_chunks_and_state_round_trip(tmp_path):
+    checkpoint = RunCheckpoint("run", directory=str(tmp_path))
+    assert checkpoint.load_chunk("chunk") is None
+    assert checkpoint.load_state() is None
+    predictions = pd.DataFrame({"predict": ["a", None], "error": [None, "ValueError: x"]}, index=[3, 7])
+    checkpoint.save_chunk("chunk", predictions)
+    checkpoint.save_state({"epoch": 1, "prompt": "p"})
+    resumed = RunCheckpoint("run", directory=str(tmp_path))
+    pd.testing.assert_frame_equal(resumed.load_chunk("chunk"), predictions)
+    assert resumed.load_state() == {"epoch": 1, "prompt": "p"}
+
+
+def test_run_id_stays_inside_the_directory(tmp_path):
+    checkpoint = RunCheckpoint("../../outside", directory=str(tmp_path))
+    assert checkpoint.run_id == "outside"
+    assert os.path.dirname(checkpoint.path) == str(tmp_path)
+    assert RunCheckpoint(directory=str(tmp_path)).run_id
+
+
+def dataset():
+    return pd.DataFrame({
+        "text": [f"{'good' if idx % 2 else 'bad'} review {idx}" for idx in range(20)],
+        "label": ["positive" if idx % 2 else "negative" for idx in range(20)],
+    })
+
+
+def test_optimize_resumes_without_calling_the_model_again(sim_rules, monkeypatch):
+    monkeypatch.setenv("CALIBRATION_PATIENCE", "0")
+    simulator = sim_rules(RULES)
+    calibration = CalibrationPrompt()
+    prompt, reason, _ = calibration.optimize("Classify the sentiment", "Review: {text}", dataset(), POSTPROCESS,
+                                             step_num=1, run_id="resume")
+    assert prompt == "Sentiment of {text}"
+    assert "Finished all 1 epochs" in reason
+    calls = simulator.calls
+    assert calls > 0
+
+    checkpoint = RunCheckpoint("resume")
+    state = checkpoint.load_state()
+    assert state["epoch"] == 1
+    assert state["score"] == 1.0
+    assert state["history"][0]["score"] == 0.5
+
+    # A later run with the same ID continues from the saved epoch, replaying every chunk and call
+    resumed_prompt, resumed_reason, _ = calibration.optimize("ignored", "ignored", None, POSTPROCESS, step_num=1, run_id="resume")
+    assert resumed_prompt == prompt
+    assert "after 1 epochs" in resumed_reason
+    assert simulator.calls == calls
+
+
+def test_interrupted_epoch_replays_its_completed_calls(sim_rules, monkeypatch):
+    monkeypatch.setenv("CALIBRATION_PATIENCE", "0")
+    monkeypatch.setenv("LLM_SIM_MISSING", "error")
+    # Without a suggestion rule the epoch fails after its predictions and analysis were recorded
+    sim_rules(RULES[:1] + RULES[2:])
+    calibration = CalibrationPrompt()
+    with pytest.raises(MissingRecordingError):
+        calibration.optimize("Classify the sentiment", "Review: {text}", dataset(), POSTPROCESS, step_num=1, run_id="interrupted")
+
+    monkeypatch.setenv("LLM_SIM_MISSING", "synthesize")
+    simulator = sim_rules(RULES)
+    prompt, _, _ = calibration.optimize(None, None, None, None, step_num=1, run_id="interrupted")
+    assert prompt == "Sentiment of {text}"
+    # Only the suggestion and the predictions of the new prompt are sent
+    assert simulator.calls == 1 + len(dataset())
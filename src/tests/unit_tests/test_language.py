@@ -0,0 +1,66 @@
+import asyncio
+
+import pytest
+
+from language import UNDETERMINED, LanguageDetector
+from translate import GuideBased
+
+DETECT_LANG = r"Please determine what language"
+
+
+@pytest.mark.parametrize("text, lang", [
+    ("Summarize the text below and list the key points for the reader.", "en"),
+    ("请总结下面的文章，并列出要点。", "ch"),
+    ("以下の文章を要約してください。", "ja"),
+    ("다음 글을 요약하고 핵심을 정리해 주세요.", "ko"),
+    ("Résumez le texte suivant pour les lecteurs et donnez les points clés de la discussion.", "fr"),
+    ("Resume el texto siguiente para los lectores y explica los puntos más importantes de la discusión.", "es"),
+    ("Fasse den folgenden Text zusammen und nenne die wichtigsten Punkte, die für den Leser relevant sind.", "de"),
+    ("Кратко перескажи следующий текст в трёх предложениях", "ru"),
+    ("ሰላም ለዓለም ይሁን እንደምን አደርክ ሰላም ነው", UNDETERMINED),
+])
+def test_detects_confidently(text, lang):
+    assert LanguageDetector().detect(text) == (lang, 1.0)
+
+
+def test_text_without_letters():
+    detector = LanguageDetector()
+    assert detector.detect("") == ("", 0.0)
+    assert detector.detect(None) == ("", 0.0)
+    assert detector.detect("1234 !!") == ("", 0.0)
+
+
+def test_template_variables_tags_and_urls_are_ignored():
+    lang, confidence = LanguageDetector().detect("请总结 {{document}} <document>{text}</document> https://example.com/some/path")
+    assert lang == "ch"
+    # Only the three Chinese characters count, below the minimum amount of evidence
+    assert confidence == pytest.approx(0.5)
+
+
+def test_short_text_is_not_confident():
+    lang, confidence = LanguageDetector().detect("Hi there")
+    assert lang == "en"
+    assert confidence < 0.8
+
+
+def test_guide_based_asks_the_model_only_when_unsure(sim_rules):
+    simulator = sim_rules([(DETECT_LANG, '"lang": "ch"}')])
+    rewrite = GuideBased()
+    assert rewrite.detect_lang("请总结下面的文章，并列出要点。") == "ch"
+    assert rewrite.detect_lang("Summarize the text below and list the key points for the reader.") == "en"
+    assert simulator.calls == 0
+    assert rewrite.detect_lang("Hi there") == "ch"
+    assert asyncio.run(rewrite.adetect_lang("Hi there")) == "ch"
+    # The same question is answered from the response cache the second time
+    assert simulator.calls == 1
+
+
+def test_detect_mode(sim_rules, monkeypatch):
+    simulator = sim_rules([(DETECT_LANG, '"lang": "ch"}')])
+    rewrite = GuideBased()
+    monkeypatch.setenv("LANG_DETECT_MODE", "local")
+    assert rewrite.detect_lang("Hi there") == "en"
+    assert simulator.calls == 0
+    monkeypatch.setenv("LANG_DETECT_MODE", "llm")
+    assert rewrite.detect_lang("Summarize the text below and list the key points for the reader.") == "ch"
+    assert simulator.calls == 1
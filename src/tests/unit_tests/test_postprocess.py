@@ -0,0 +1,138 @@
+import signal
+import time
+from concurrent.futures import Future
+
+import pytest
+
+from calibration import CalibrationPrompt
+from postprocess import Postprocessor, compile_postprocess
+
+needs_alarm = pytest.mark.skipif(not hasattr(signal, "setitimer"), reason="the time limit needs SIGALRM")
+
+STRIP = """
+def postprocess(llm_output):
+    return llm_output.strip()
+"""
+
+FAILING = """
+def postprocess(llm_output):
+    if llm_output == "bad":
+        raise ValueError("cannot parse")
+    return llm_output.upper()
+"""
+
+SLOW = """
+import time
+
+def postprocess(llm_output):
+    if llm_output == "slow":
+        time.sleep(30)
+    return llm_output
+"""
+
+STUCK = """
+import signal
+import time
+
+def postprocess(llm_output):
+    if llm_output == "stuck":
+        signal.pthread_sigmask(signal.SIG_BLOCK, [signal.SIGALRM])
+        time.sleep(30)
+    return llm_output
+"""
+
+
+def test_compile_requires_a_postprocess_function():
+    with pytest.raises(ValueError):
+        compile_postprocess("x = 1")
+
+
+def test_batch_in_process():
+    postprocessor = Postprocessor(STRIP, processes=0)
+    try:
+        assert postprocessor.batch([" a ", "b\n"]) == [("a", None), ("b", None)]
+        assert postprocessor(" c ") == "c"
+        assert postprocessor.submit([" d "]).result() == [("d", None)]
+    finally:
+        postprocessor.close()
+
+
+def test_a_failing_output_only_affects_itself():
+    postprocessor = Postprocessor(FAILING, processes=0)
+    try:
+        results = postprocessor.batch(["ok", "bad", "fine"])
+        assert results[0] == ("OK", None)
+        assert results[1] == (None, "ValueError: cannot parse")
+        assert results[2] == ("FINE", None)
+        with pytest.raises(ValueError):
+            postprocessor("bad")
+    finally:
+        postprocessor.close()
+
+
+def test_failing_batch_falls_back_to_single_outputs():
+    code = """
+def postprocess_batch(llm_outputs):
+    if "bad" in llm_outputs:
+        raise ValueError("cannot parse")
+    return [output * 2 for output in llm_outputs]
+"""
+    postprocessor = Postprocessor(code, processes=0)
+    try:
+        assert postprocessor.batch(["a", "b"]) == [("aa", None), ("bb", None)]
+        results = postprocessor.batch(["a", "bad"])
+        assert results[0] == ("aa", None)
+        assert results[1] == (None, "ValueError: cannot parse")
+    finally:
+        postprocessor.close()
+
+
+def test_batch_in_pool():
+    postprocessor = Postprocessor(FAILING, processes=2, timeout=5)
+    try:
+        outputs = ["a", "bad", "c", "d", "e"]
+        results = postprocessor.batch(outputs)
+        assert results == [("A", None), (None, "ValueError: cannot parse"), ("C", None), ("D", None), ("E", None)]
+    finally:
+        postprocessor.close()
+
+
+@needs_alarm
+def test_slow_output_times_out():
+    postprocessor = Postprocessor(SLOW, processes=2, timeout=0.5)
+    try:
+        start = time.monotonic()
+        results = postprocessor.batch(["a", "slow"])
+        assert time.monotonic() - start < 5
+        assert results[0] == ("a", None)
+        assert results[1] == (None, "TimeoutError: postprocess took longer than 0.5s")
+    finally:
+        postprocessor.close()
+
+
+@needs_alarm
+def test_stuck_worker_restarts_the_pool():
+    postprocessor = Postprocessor(STUCK, processes=1, timeout=0.5)
+    try:
+        pool = postprocessor.pool
+        start = time.monotonic()
+        assert postprocessor.batch(["stuck"]) == [(None, "TimeoutError: postprocess took longer than 0.5s")]
+        assert time.monotonic() - start < 5
+        assert postprocessor.pool is not pool
+        assert postprocessor.batch(["next"]) == [("next", None)]
+    finally:
+        postprocessor.close()
+    assert postprocessor.pool is None
+
+
+def test_outputs_are_postprocessed_as_the_calls_finish():
+    calibration = CalibrationPrompt(max_workers=2)
+    futures = [Future() for _ in range(5)]
+    for idx in (3, 0, 4, 1, 2):
+        futures[idx].set_result((None, "ThrottlingException: slow down") if idx == 1 else (f" {idx} ", None))
+    postprocessor = Postprocessor(STRIP, processes=0)
+    try:
+        results = calibration.postprocess_as_completed(postprocessor, futures)
+    finally:
+        postprocessor.close()
+    assert results == [("0", None), (None, "ThrottlingException: slow down"), ("2", None), ("3", None), ("4", None)]
@@ -0,0 +1,175 @@
+import time
+
+import pytest
+
+import ratelimit
+from gateway import bedrock_body, gateway
+from ratelimit import ModelRateLimiter, TokenBucket, error_kind, get_rate_limiter
+from simulator import SimulatedThrottlingError, get_simulator
+
+MODEL_ID = "anthropic.claude-3-haiku-20240307-v1:0"
+
+
+def test_token_bucket_allows_a_burst_then_paces():
+    bucket = TokenBucket(60, burst=5)
+    assert bucket.capacity == 5
+    now = bucket.updated_at
+    assert [bucket.reserve(1, now) for _ in range(5)] == [0.0] * 5
+    assert bucket.reserve(1, now) == pytest.approx(1.0)
+    assert bucket.reserve(1, now) == pytest.approx(2.0)
+
+
+def test_token_bucket_refills_up_to_capacity():
+    bucket = TokenBucket(60, burst=5)
+    now = bucket.updated_at
+    bucket.reserve(5, now)
+    bucket.refill(now + 2)
+    assert bucket.tokens == pytest.approx(2)
+    bucket.refill(now + 60)
+    assert bucket.tokens == pytest.approx(5)
+
+
+def test_token_bucket_capacity_is_at_least_one_request():
+    assert TokenBucket(6, burst=1).capacity == 1.0
+
+
+def test_throttling_cuts_the_rate_and_success_restores_it():
+    limiter = ModelRateLimiter(MODEL_ID, rpm=600, tpm=60000)
+    assert limiter.on_throttled()
+    assert limiter.fraction == pytest.approx(0.5)
+    assert limiter.requests.per_minute == pytest.approx(300)
+    assert limiter.tokens.per_minute == pytest.approx(30000)
+    # Errors of the requests already in flight do not cut it again within a second
+    assert limiter.on_throttled()
+    assert limiter.fraction == pytest.approx(0.5)
+    for _ in range(10):
+        limiter.on_success(100)
+    assert limiter.fraction == pytest.approx(0.6)
+    assert limiter.requests.per_minute == pytest.approx(360)
+
+
+def test_throttling_never_cuts_below_the_min_fraction(monkeypatch):
+    limiter = ModelRateLimiter(MODEL_ID, rpm=600, tpm=0)
+    for _ in range(10):
+        limiter._decreased_at = 0.0
+        limiter.on_throttled()
+    assert limiter.fraction == pytest.approx(limiter.min_fraction)
+
+
+def test_no_quota_never_delays_before_throttling():
+    limiter = ModelRateLimiter(MODEL_ID, rpm=0, tpm=0)
+    assert all(limiter.reserve(10000) == 0.0 for _ in range(100))
+    # Nothing succeeded yet, so there is no rate to pace the retry with
+    assert not limiter.on_throttled()
+    assert limiter.requests is None
+    assert limiter.fraction == 1.0
+
+
+def test_first_throttle_seeds_the_rate_from_the_throughput(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(time, "monotonic", lambda: now[0])
+    limiter = ModelRateLimiter(MODEL_ID, rpm=0, tpm=0)
+    # 30 successes in the last 10 seconds, older ones fall out of the window
+    limiter.on_success(100)
+    now[0] += 61.0
+    for _ in range(30):
+        limiter.on_success(100)
+        now[0] += 1 / 3
+    assert limiter.on_throttled()
+    assert limiter.rpm == pytest.approx(180)
+    assert limiter.fraction == pytest.approx(0.5)
+    assert limiter.requests.per_minute == pytest.approx(90)
+    assert limiter.tokens is None
+    assert limiter.reserve(1) > 0
+    for _ in range(10):
+        limiter.on_success(100)
+    assert limiter.requests.per_minute == pytest.approx(108)
+
+
+def test_success_settles_the_token_reservation():
+    limiter = ModelRateLimiter(MODEL_ID, rpm=0, tpm=600)
+    start = limiter.tokens.tokens
+    limiter.reserve(100)
+    limiter.on_success(100, used_tokens=40)
+    assert limiter.tokens.tokens == pytest.approx(start - 40, abs=1)
+    limiter.charge(20)
+    assert limiter.tokens.tokens == pytest.approx(start - 60, abs=1)
+
+
+def test_error_kind():
+    assert error_kind(SimulatedThrottlingError("InvokeModel")) == "throttled"
+    error = Exception()
+    error.response = {"Error": {"Code": "ServiceUnavailableException"}}
+    assert error_kind(error) == "transient"
+    assert error_kind(ValueError("bad request")) is None
+
+
+def test_call_retries_throttled_errors(monkeypatch):
+    monkeypatch.setattr(time, "sleep", lambda seconds: None)
+    limiter = ModelRateLimiter(MODEL_ID, rpm=0, tpm=0)
+    attempts = []
+    retries = []
+
+    def fn():
+        attempts.append(1)
+        if len(attempts) < 3:
+            raise SimulatedThrottlingError("InvokeModel")
+        return "ok"
+
+    assert limiter.call(fn, 10, on_retry=retries.append) == "ok"
+    assert retries == ["throttled", "throttled"]
+    assert limiter.throttled == 2
+
+
+def test_call_gives_up_after_max_retries(monkeypatch):
+    monkeypatch.setattr(time, "sleep", lambda seconds: None)
+    monkeypatch.setenv("LLM_RATE_LIMIT_RETRIES", "2")
+    limiter = ModelRateLimiter(MODEL_ID, rpm=0, tpm=0)
+
+    def fn():
+        raise SimulatedThrottlingError("InvokeModel")
+
+    with pytest.raises(SimulatedThrottlingError):
+        limiter.call(fn, 10)
+    assert limiter.throttled == 2
+
+
+def test_limits_per_model(monkeypatch):
+    monkeypatch.setenv("LLM_RATE_LIMITS", '{"model-a": {"rpm": 100, "tpm": 1000}}')
+    assert ratelimit.model_limits("model-a") == (100.0, 1000.0)
+    assert ratelimit.model_limits("model-b") == (0.0, 0.0)
+    assert get_rate_limiter("model-a") is get_rate_limiter("model-a")
+    monkeypatch.setenv("LLM_RATE_LIMIT", "0")
+    assert get_rate_limiter("model-a") is None
+
+
+def test_gateway_retries_simulated_throttling(monkeypatch):
+    monkeypatch.setenv("LLM_SIM_THROTTLE_RATE", "0.3")
+    monkeypatch.setenv("LLM_SIM_SEED", "1")
+    monkeypatch.setenv("LLM_RATE_LIMIT_RPM", "6000")
+    monkeypatch.setattr(ModelRateLimiter, "backoff", lambda self, attempt: 0.0)
+    body = bedrock_body([{"role": "user", "content": "Hello"}], max_tokens=20)
+    for _ in range(10):
+        gateway.invoke(MODEL_ID, body)
+    simulator = get_simulator()
+    assert simulator.throttled > 0
+    assert simulator.calls == 10 + simulator.throttled
+    assert get_rate_limiter(MODEL_ID).fraction < 1.0
+
+
+def test_gateway_paces_throttling_without_a_quota(monkeypatch):
+    monkeypatch.setenv("LLM_SIM_RPM", "5")
+    monkeypatch.setattr(ModelRateLimiter, "backoff", lambda self, attempt: 0.0)
+    body = bedrock_body([{"role": "user", "content": "Hello"}], max_tokens=20)
+    for _ in range(5):
+        gateway.invoke(MODEL_ID, body)
+    limiter = get_rate_limiter(MODEL_ID)
+    assert limiter.requests is None
+    sleeps = []
+    monkeypatch.setattr(time, "sleep", sleeps.append)
+    with pytest.raises(SimulatedThrottlingError):
+        gateway.invoke(MODEL_ID, body)
+    # The simulated quota never refills here, but every retry was paced by the seeded rate
+    assert limiter.requests is not None
+    assert limiter.fraction < 1.0
+    assert len(sleeps) == limiter.max_retries and all(seconds > 0 for seconds in sleeps)
@@ -0,0 +1,96 @@
+import json
+
+import pytest
+
+from gateway import bedrock_body, gateway, response_text
+from ratelimit import error_kind
+from simulator import (
+    MissingRecordingError,
+    RecordingBedrockClient,
+    SimulatedBedrockClient,
+    SimulatedThrottlingError,
+    get_simulator,
+)
+
+MODEL_ID = "anthropic.claude-3-haiku-20240307-v1:0"
+
+
+def invoke(client, content, **params):
+    result = client.invoke_model(body=json.dumps(bedrock_body([{"role": "user", "content": content}], **params)), modelId=MODEL_ID)
+    return json.loads(result["body"].read())
+
+
+def stream_text(client, content):
+    result = client.invoke_model_with_response_stream(body=json.dumps(bedrock_body([{"role": "user", "content": content}])), modelId=MODEL_ID)
+    text = ""
+    for event in result["body"]:
+        payload = json.loads(event["chunk"]["bytes"].decode())
+        if payload["type"] == "content_block_delta":
+            text += payload["delta"]["text"]
+    return text
+
+
+def test_fixture_rules_answer_matching_requests(sim_rules):
+    sim_rules([(r"capital of France", "Paris"), (r"capital", "I don't know")])
+    client = SimulatedBedrockClient()
+    assert response_text(invoke(client, "What is the capital of France?")) == "Paris"
+    assert response_text(invoke(client, "What is the capital of Peru?")) == "I don't know"
+    synthetic = response_text(invoke(client, "Hello"))
+    assert synthetic.startswith("Simulated response")
+    assert synthetic == response_text(invoke(client, "Hello"))
+
+
+def test_stop_sequences_and_max_tokens(sim_rules):
+    sim_rules([(r"count", "one two three </answer> four"), (r"long", "word " * 100)])
+    client = SimulatedBedrockClient()
+    body = invoke(client, "count", stop_sequences=["</answer>"])
+    assert body["content"][0]["text"] == "one two three "
+    assert (body["stop_reason"], body["stop_sequence"]) == ("stop_sequence", "</answer>")
+    body = invoke(client, "long", max_tokens=10)
+    assert body["stop_reason"] == "max_tokens"
+    assert len(body["content"][0]["text"]) == 40
+
+
+def test_stream_yields_the_same_text(sim_rules):
+    sim_rules([(r"story", "Once upon a time there was a simulated model.")])
+    assert stream_text(SimulatedBedrockClient(), "Tell a story") == "Once upon a time there was a simulated model."
+
+
+def test_recordings_are_replayed_before_rules(sim_rules):
+    sim_rules([(r"weather", "Sunny")])
+    recorder = RecordingBedrockClient(SimulatedBedrockClient())
+    assert response_text(invoke(recorder, "How is the weather?")) == "Sunny"
+    # A new simulator reads the recordings back, they win over the rules
+    sim_rules([(r"weather", "Rainy")])
+    client = SimulatedBedrockClient()
+    assert response_text(invoke(client, "How is the weather?")) == "Sunny"
+    assert response_text(invoke(client, "Is the weather nice?")) == "Rainy"
+
+
+def test_missing_recordings_can_raise(sim_rules, monkeypatch):
+    monkeypatch.setenv("LLM_SIM_MISSING", "error")
+    sim_rules([(r"^known", "yes")])
+    client = SimulatedBedrockClient()
+    assert response_text(invoke(client, "known question")) == "yes"
+    with pytest.raises(MissingRecordingError):
+        invoke(client, "unknown question")
+
+
+def test_simulated_quota_throttles_like_bedrock(monkeypatch):
+    monkeypatch.setenv("LLM_SIM_RPM", "2")
+    client = SimulatedBedrockClient()
+    invoke(client, "first")
+    invoke(client, "second")
+    with pytest.raises(SimulatedThrottlingError) as error:
+        invoke(client, "third")
+    assert error_kind(error.value) == "throttled"
+    assert get_simulator().stats()["throttled"] == 1
+
+
+def test_gateway_runs_against_the_simulator(sim_rules):
+    sim_rules([(r"ping", "pong")])
+    body = bedrock_body([{"role": "user", "content": "ping"}], max_tokens=20)
+    assert response_text(gateway.invoke(MODEL_ID, body)) == "pong"
+    stats = get_simulator().stats()
+    assert stats["calls"] == 1
+    assert stats["input_tokens"] > 0
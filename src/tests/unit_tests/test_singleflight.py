@@ -0,0 +1,110 @@
+import asyncio
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from gateway import bedrock_body, gateway
+from simulator import get_simulator
+from singleflight import SingleFlight
+
+MODEL_ID = "anthropic.claude-3-haiku-20240307-v1:0"
+
+
+def test_concurrent_calls_share_one_result():
+    flight = SingleFlight()
+    calls = []
+    release = threading.Event()
+
+    def fn():
+        calls.append(1)
+        release.wait(5)
+        return {"text": "shared"}
+
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        futures = [executor.submit(flight.do, "key", fn) for _ in range(4)]
+        while flight.stats()["calls"] < 4:
+            time.sleep(0.01)
+        release.set()
+        results = [future.result() for future in futures]
+    assert len(calls) == 1
+    assert all(result is results[0] for result in results)
+    assert flight.stats() == {"calls": 4, "coalesced": 3, "in_flight": 0}
+
+
+def test_waiters_get_the_leader_exception():
+    flight = SingleFlight()
+    release = threading.Event()
+
+    def fn():
+        release.wait(5)
+        raise ValueError("upstream failed")
+
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        futures = [executor.submit(flight.do, "key", fn) for _ in range(2)]
+        while flight.stats()["calls"] < 2:
+            time.sleep(0.01)
+        release.set()
+        for future in futures:
+            with pytest.raises(ValueError, match="upstream failed"):
+                future.result()
+
+
+def test_sequential_calls_are_not_coalesced():
+    flight = SingleFlight()
+    assert flight.do("key", lambda: 1) == 1
+    assert flight.do("key", lambda: 2) == 2
+    assert flight.stats()["coalesced"] == 0
+
+
+def test_async_calls_share_one_result():
+    flight = SingleFlight()
+    calls = []
+
+    async def fn():
+        calls.append(1)
+        await asyncio.sleep(0.05)
+        return "shared"
+
+    async def run():
+        return await asyncio.gather(*(flight.ado("key", fn) for _ in range(3)))
+
+    assert asyncio.run(run()) == ["shared"] * 3
+    assert len(calls) == 1
+
+
+def test_cancelled_leader_hands_over_the_call():
+    flight = SingleFlight()
+    calls = []
+
+    async def fn():
+        calls.append(1)
+        await asyncio.sleep(0.05)
+        return len(calls)
+
+    async def run():
+        leader = asyncio.ensure_future(flight.ado("key", fn))
+        await asyncio.sleep(0)
+        waiter = asyncio.ensure_future(flight.ado("key", fn))
+        await asyncio.sleep(0)
+        leader.cancel()
+        return await waiter
+
+    assert asyncio.run(run()) == 2
+
+
+def test_gateway_coalesces_only_deterministic_calls(monkeypatch):
+    monkeypatch.setenv("LLM_SIM_LATENCY_MS", "100")
+    monkeypatch.setattr(gateway, "use_cache", False)
+    body = bedrock_body([{"role": "user", "content": "Name a colour."}], max_tokens=20, temperature=0.8)
+
+    def fan_out(**kwargs):
+        get_simulator().reset()
+        with ThreadPoolExecutor(max_workers=3) as executor:
+            list(executor.map(lambda _: gateway.invoke(MODEL_ID, body, **kwargs), range(3)))
+        return get_simulator().calls
+
+    assert fan_out() == 3
+    assert fan_out(deterministic=True) == 1
+    assert fan_out(coalesce=True) == 1
@@ -0,0 +1,255 @@
+import atexit
+import contextvars
+import functools
+import inspect
+import json
+import os
+import secrets
+import threading
+import time
+import urllib.request
+from contextlib import contextmanager
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# OTLP span kinds and status codes
+KIND_INTERNAL = 1
+KIND_CLIENT = 3
+STATUS_OK = 1
+STATUS_ERROR = 2
+
+_current_span = contextvars.ContextVar("current_span", default=None)
+
+
+def tracing_enabled():
+    return bool(tracer.path or tracer.endpoint)
+
+
+def otlp_value(value):
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+def otlp_attributes(attributes):
+    return [{"key": key, "value": otlp_value(value)} for key, value in attributes.items() if value is not None]
+
+
+class Span:
+    """
+    One timed operation of a trace, exported in the OTLP/JSON format
+    """
+
+    def __init__(self, name, parent=None, kind=KIND_INTERNAL, attributes=None):
+        self.name = name
+        self.trace_id = parent.trace_id if parent is not None else secrets.token_hex(16)
+        self.span_id = secrets.token_hex(8)
+        self.parent_id = parent.span_id if parent is not None else None
+        self.kind = kind
+        self.attributes = dict(attributes or {})
+        self.events = []
+        self.status = STATUS_OK
+        self.status_message = None
+        self.start_ns = time.time_ns()
+        self.end_ns = None
+
+    def set_attribute(self, key, value):
+        self.attributes[key] = value
+
+    def set_attributes(self, attributes):
+        self.attributes.update(attributes)
+
+    def record_exception(self, error):
+        self.status = STATUS_ERROR
+        self.status_message = f"{type(error).__name__}: {error}"
+        self.events.append({
+            "timeUnixNano": str(time.time_ns()),
+            "name": "exception",
+            "attributes": otlp_attributes({"exception.type": type(error).__name__, "exception.message": str(error)}),
+        })
+
+    def end(self):
+        if self.end_ns is None:
+            self.end_ns = time.time_ns()
+            tracer.on_end(self)
+
+    def to_otlp(self):
+        span = {
+            "traceId": self.trace_id,
+            "spanId": self.span_id,
+            "name": self.name,
+            "kind": self.kind,
+            "startTimeUnixNano": str(self.start_ns),
+            "endTimeUnixNano": str(self.end_ns),
+            "attributes": otlp_attributes(self.attributes),
+            "events": self.events,
+            "status": {"code": self.status},
+        }
+        if self.parent_id:
+            span["parentSpanId"] = self.parent_id
+        if self.status_message:
+            span["status"]["message"] = self.status_message
+        return span
+
+
+class NoopSpan:
+    def set_attribute(self, key, value):
+        pass
+
+    def set_attributes(self, attributes):
+        pass
+
+    def record_exception(self, error):
+        pass
+
+    def end(self):
+        pass
+
+
+NOOP_SPAN = NoopSpan()
+
+
+class Tracer:
+    """
+    Collects finished spans and exports them in batches, as OTLP/JSON lines appended to LLM_TRACE_FILE
+    (the format the OpenTelemetry collector's otlpjsonfile receiver reads) and/or posted to the
+    OTLP/HTTP collector at LLM_TRACE_ENDPOINT, e.g. http://localhost:4318/v1/traces.
+    A batch is exported whenever a root span ends or LLM_TRACE_BATCH spans are pending.
+    """
+
+    def __init__(self):
+        self.path = os.getenv("LLM_TRACE_FILE")
+        self.endpoint = os.getenv("LLM_TRACE_ENDPOINT")
+        self.service_name = os.getenv("LLM_TRACE_SERVICE", "claude-prompt-generator")
+        self.batch_size = int(os.getenv("LLM_TRACE_BATCH", 256))
+        self.errors = 0
+        self._pending = []
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+
+    def on_end(self, span):
+        with self._lock:
+            self._pending.append(span)
+            if span.parent_id is not None and len(self._pending) < self.batch_size:
+                return
+            spans, self._pending = self._pending, []
+        self.export(spans)
+
+    def flush(self):
+        with self._lock:
+            spans, self._pending = self._pending, []
+        if spans:
+            self.export(spans)
+
+    def payload(self, spans):
+        return {
+            "resourceSpans": [{
+                "resource": {"attributes": otlp_attributes({"service.name": self.service_name})},
+                "scopeSpans": [{"scope": {"name": "tracing"}, "spans": [span.to_otlp() for span in spans]}],
+            }]
+        }
+
+    def export(self, spans):
+        payload = json.dumps(self.payload(spans), ensure_ascii=False)
+        if self.path:
+            try:
+                directory = os.path.dirname(self.path)
+                if directory:
+                    os.makedirs(directory, exist_ok=True)
+                with self._write_lock, open(self.path, "a", encoding="utf-8") as f:
+                    f.write(payload + "\n")
+            except OSError:
+                self.errors += 1
+        if self.endpoint:
+            # Posted from a background thread, tracing must not slow down the request it traces
+            threading.Thread(target=self.post, args=(payload,), daemon=True).start()
+
+    def post(self, payload):
+        request = urllib.request.Request(
+            self.endpoint, data=payload.encode("utf-8"), headers={"Content-Type": "application/json"}, method="POST"
+        )
+        try:
+            urllib.request.urlopen(request, timeout=10).close()
+        except OSError:
+            self.errors += 1
+
+
+tracer = Tracer()
+atexit.register(tracer.flush)
+
+
+def current_span():
+    return _current_span.get()
+
+
+def start_span(name, kind=KIND_INTERNAL, attributes=None):
+    """
+    Start a child of the current span without making it current, the caller has to `end` it.
+    For leaf operations such as a model call, which may be a generator consumed from other contexts.
+    """
+    if not tracing_enabled():
+        return NOOP_SPAN
+    return Span(name, current_span(), kind, attributes)
+
+
+@contextmanager
+def span(name, **attributes):
+    """
+    Run the block in a new span, the child of the current one, and make it the current span
+    """
+    if not tracing_enabled():
+        yield NOOP_SPAN
+        return
+    current = Span(name, current_span(), attributes=attributes)
+    token = _current_span.set(current)
+    try:
+        yield current
+    except Exception as e:
+        current.record_exception(e)
+        raise
+    finally:
+        _current_span.reset(token)
+        current.end()
+
+
+def traced(name):
+    """
+    Decorate a function or a coroutine function to run it in a span named `name`
+    """
+    def decorator(fn):
+        if inspect.iscoroutinefunction(fn):
+            @functools.wraps(fn)
+            async def async_wrapper(*args, **kwargs):
+                with span(name):
+                    return await fn(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def propagate(fn):
+    """
+    Wrap `fn` to run under the current span when it is called from another thread, e.g. by an executor.
+    asyncio tasks and asyncio.to_thread already carry the current span.
+    """
+    parent = current_span()
+
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        token = _current_span.set(parent)
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            _current_span.reset(token)
+    return wrapper
@@ -1,10 +1,13 @@
 import json
 import os
+import re
 
-import boto3
-from botocore.config import Config
 from dotenv import load_dotenv
 
+from gateway import cacheable_content, gateway
+from language import detect_language
+from tracing import traced
+
 load_dotenv()
 
 # Get the directory where the current script is located
@@ -17,34 +20,34 @@ prompt_guide_path = os.path.join(current_script_path, "PromptGuide.md")
 with open(prompt_guide_path, "r") as f:
     PromptGuide = f.read()
 
-region_name = os.getenv("REGION_NAME")
+NUMBER_WORDS = ["zero", "one", "two", "three", "four", "five", "six", "seven", "eight", "nine", "ten"]
 
 
-class GuideBased:
-    def __init__(self):
-        session = boto3.Session()
-        retry_config = Config(
-            region_name=region_name,
-            retries={
-                "max_attempts": 5,
-                "mode": "standard",
-            },
-        )
-        service_name = "bedrock-runtime"
-        self.bedrock_client = session.client(
-            service_name=service_name, config=retry_config
-        )
+def number_word(num):
+    return NUMBER_WORDS[num] if num < len(NUMBER_WORDS) else str(num)
+
 
+class GuideBased:
+    @traced("guide_based.generate")
     def __call__(self, initial_prompt):
         lang = self.detect_lang(initial_prompt)
-        if "ch" in lang:
+        # Several rewrites of the same prompt are sampled as candidates, never share one call
+        return self._rewrite_result(gateway.invoke(*self._rewrite_request(initial_prompt, lang), coalesce=False, stage="guide_based.rewrite"))
+
+    @traced("guide_based.generate")
+    async def acall(self, initial_prompt):
+        lang = await self.adetect_lang(initial_prompt)
+        return self._rewrite_result(await gateway.ainvoke(*self._rewrite_request(initial_prompt, lang), coalesce=False, stage="guide_based.rewrite"))
+
+    def _rewrite_request(self, initial_prompt, lang):
+        if lang == "ch":
             lang_prompt = "Please use Chinese for rewriting. The xml tag name is still in English."
-        elif "en" in lang:
+        elif lang == "en":
             lang_prompt = "Please use English for rewriting."
         else:
             lang_prompt = "Please use same language as the initial instruction for rewriting. The xml tag name is still in English."
 
-        prompt = """
+        prefix = """
 You are a instruction engineer. Your task is to rewrite the initial instruction in <initial_instruction></initial_instruction> xml tag based on the suggestions in the instruction guide in <instruction_guide></instruction_guide> xml tag.
 This instruction is then sent to claude to get the expected output.
 
@@ -57,12 +60,9 @@ This instruction is then sent to claude to get the expected output.
 
 Here are some important rules for rewrite:
 1. Something like `{{variable}}` is customizable text that will be replaced when sent to claude. It needs to be retained in the rewrite.
-2. {lang_prompt}
-3. Only output the rewrite instruction return them in <rerwited></rerwited>XML tags
-4. If examples are already included in the initial prompt, do not remove the examples after the rewrite.
-
-You are a instruction engineer. Your task is to rewrite the initial instruction in <initial_instruction></initial_instruction> xml tag based on the suggestions in the instruction guide in <instruction_guide></instruction_guide> xml tag.
-This instruction is then sent to claude to get the expected output.
+2. Only output the rewrite instruction return them in <rerwited></rerwited>XML tags
+3. If examples are already included in the initial prompt, do not remove the examples after the rewrite.
+4. Follow the language rule given after the initial instruction.
 
 Example:
 <initial_instruction>
@@ -105,40 +105,40 @@ If the question cannot be answered by the document, say "Cannot answer the quest
 {{question}}
 </question>
 </rerwited>
-
+""".strip()
+        suffix = """
 <initial_instruction>
 {initial}
 </initial_instruction>
+
+Language rule: {lang_prompt}
 """.strip()
 
+        modelId = "anthropic.claude-3-5-sonnet-20240620-v1:0"  # anthropic.claude-3-sonnet-20240229-v1:0 "anthropic.claude-3-haiku-20240307-v1:0"
         messages = [
             {
                 "role": "user",
-                "content": prompt.format(
-                    guide=PromptGuide, initial=initial_prompt, lang_prompt=lang_prompt
+                # The guide and the rules come first and are the same for every request, so they can be cached
+                "content": cacheable_content(
+                    modelId,
+                    prefix.format(guide=PromptGuide),
+                    suffix.format(initial=initial_prompt, lang_prompt=lang_prompt),
                 ),
             },
             {"role": "assistant", "content": "<rerwited>"},
         ]
-        body = json.dumps(
-            {
-                "messages": messages,
-                "max_tokens": 4096,
-                "temperature": 0.8,
-                "top_k": 50,
-                "top_p": 1,
-                "stop_sequences": ["</rerwited>"],
-                "anthropic_version": "bedrock-2023-05-31",
-            }
-        )
-        modelId = "anthropic.claude-3-5-sonnet-20240620-v1:0"  # anthropic.claude-3-sonnet-20240229-v1:0 "anthropic.claude-3-haiku-20240307-v1:0"
-        accept = "application/json"
-        contentType = "application/json"
-
-        response = self.bedrock_client.invoke_model(
-            body=body, modelId=modelId, accept=accept, contentType=contentType
-        )
-        response_body = json.loads(response.get("body").read())
+        body = {
+            "messages": messages,
+            "max_tokens": 4096,
+            "temperature": 0.8,
+            "top_k": 50,
+            "top_p": 1,
+            "stop_sequences": ["</rerwited>"],
+            "anthropic_version": "bedrock-2023-05-31",
+        }
+        return modelId, body
+
+    def _rewrite_result(self, response_body):
         result = response_body["content"][0]["text"].replace("</rewrite>", "").strip()
         if result.startswith("<instruction>"):
             result = result[13:]
@@ -148,6 +148,37 @@ If the question cannot be answered by the document, say "Cannot answer the quest
         return result
 
     def detect_lang(self, initial_prompt):
+        lang = self.local_lang(initial_prompt)
+        if lang is not None:
+            return lang
+        return self.llm_detect_lang(initial_prompt)
+
+    async def adetect_lang(self, initial_prompt):
+        lang = self.local_lang(initial_prompt)
+        if lang is not None:
+            return lang
+        return await self.allm_detect_lang(initial_prompt)
+
+    def local_lang(self, initial_prompt):
+        """
+        Detect the language locally, without a model round trip
+        :return: The language code, or None if the model has to be asked
+        """
+        mode = os.getenv("LANG_DETECT_MODE", "auto")
+        if mode == "llm":
+            return None
+        lang, confidence = detect_language(initial_prompt)
+        if mode == "local" or confidence >= float(os.getenv("LANG_DETECT_THRESHOLD", 0.8)):
+            return lang
+        return None
+
+    def llm_detect_lang(self, initial_prompt):
+        return self._detect_lang_result(gateway.invoke(*self._detect_lang_request(initial_prompt), deterministic=True, stage="guide_based.detect_lang"))
+
+    async def allm_detect_lang(self, initial_prompt):
+        return self._detect_lang_result(await gateway.ainvoke(*self._detect_lang_request(initial_prompt), deterministic=True, stage="guide_based.detect_lang"))
+
+    def _detect_lang_request(self, initial_prompt):
         lang_example = json.dumps({"lang": "ch"})
         prompt = """
 Please determine what language the document below is in? English (en) or Chinese (ch)?
@@ -168,90 +199,93 @@ Output example: {lang_example}
             },
             {"role": "assistant", "content": "{"},
         ]
-        body = json.dumps(
-            {
-                "messages": messages,
-                "max_tokens": 1000,
-                "temperature": 0.8,
-                "top_k": 50,
-                "top_p": 1,
-                "stop_sequences": ["\n\nHuman:"],
-                "anthropic_version": "bedrock-2023-05-31",
-            }
-        )
+        body = {
+            "messages": messages,
+            "max_tokens": 1000,
+            "temperature": 0.8,
+            "top_k": 50,
+            "top_p": 1,
+            "stop_sequences": ["\n\nHuman:"],
+            "anthropic_version": "bedrock-2023-05-31",
+        }
         modelId = "anthropic.claude-3-sonnet-20240229-v1:0"
-        accept = "application/json"
-        contentType = "application/json"
+        return modelId, body
 
-        response = self.bedrock_client.invoke_model(
-            body=body, modelId=modelId, accept=accept, contentType=contentType
-        )
-        response_body = json.loads(response.get("body").read())
+    def _detect_lang_result(self, response_body):
         try:
-            lang = json.loads("{" + response_body["content"][0]["text"])["lang"]
+            lang = str(json.loads("{" + response_body["content"][0]["text"])["lang"]).strip().lower()
         except:
             lang = ""
         return lang
 
     def judge(self, candidates):
+        """
+        :return: The index of the best of `candidates`, or None if the answer can't be parsed
+        """
+        if len(candidates) == 1:
+            return 0
+        return self._judge_result(gateway.invoke(*self._judge_request(candidates), deterministic=True, stage="guide_based.judge"), len(candidates))
+
+    async def ajudge(self, candidates):
+        if len(candidates) == 1:
+            return 0
+        return self._judge_result(await gateway.ainvoke(*self._judge_request(candidates), deterministic=True, stage="guide_based.judge"), len(candidates))
+
+    def _judge_request(self, candidates):
         Instruction_prompts = []
         for idx, candidate in enumerate(candidates):
             Instruction_prompts.append(
                 f"Instruction {idx+1}:\n<instruction>\n{candidate}\n</instruction>"
             )
         example = json.dumps({"Preferred": "Instruction 1"})
-        prompt = """
-You are a instruction engineer. Your task is to evaluate which of the three instructions given below is better based on guide in <guide> xml tag.
+        # The prefix does not depend on the number of candidates, so judges of any size share its prompt cache
+        prefix = """
+You are a instruction engineer. Your task is to evaluate which of the instructions given below is better based on guide in <guide> xml tag.
 
 Instruction guide:
 <guide>
 {guide}
 </guide>
-
-You are a instruction engineer. Your task is to evaluate which of the three instructions given below is better based on guide in <guide> xml tag.
+""".strip()
+        suffix = """
+You are a instruction engineer. Your task is to evaluate which of the {num} instructions given below is better based on guide in <guide> xml tag.
 
 {Instruction_prompts}
 
 Use JSON format when returning results. Please only output the result in json format, and do the json format check and return, don't include other extra text! An example of output is as follows:
 {example}
 """.strip()
+        modelId = "anthropic.claude-3-haiku-20240307-v1:0"  # anthropic.claude-3-sonnet-20240229-v1:0
         messages = [
             {
                 "role": "user",
-                "content": prompt.format(
-                    guide=PromptGuide,
-                    Instruction_prompts="\n\n".join(Instruction_prompts),
-                    example=example,
+                "content": cacheable_content(
+                    modelId,
+                    prefix.format(guide=PromptGuide),
+                    suffix.format(num=number_word(len(candidates)), Instruction_prompts="\n\n".join(Instruction_prompts), example=example),
                 ),
             },
             {"role": "assistant", "content": "{"},
         ]
-        body = json.dumps(
-            {
-                "messages": messages,
-                "max_tokens": 128,
-                "temperature": 0.1,
-                "top_k": 50,
-                "top_p": 1,
-                "stop_sequences": ["\n\nHuman:"],
-                "anthropic_version": "bedrock-2023-05-31",
-            }
-        )
-        modelId = "anthropic.claude-3-haiku-20240307-v1:0"  # anthropic.claude-3-sonnet-20240229-v1:0
-        accept = "application/json"
-        contentType = "application/json"
-
-        response = self.bedrock_client.invoke_model(
-            body=body, modelId=modelId, accept=accept, contentType=contentType
-        )
-        response_body = json.loads(response.get("body").read())
+        body = {
+            "messages": messages,
+            "max_tokens": 128,
+            "temperature": 0.1,
+            "top_k": 50,
+            "top_p": 1,
+            "stop_sequences": ["\n\nHuman:"],
+            "anthropic_version": "bedrock-2023-05-31",
+        }
+        return modelId, body
+
+    def _judge_result(self, response_body, num_candidates=3):
         final_result = None
         try:
             result = json.loads("{" + response_body["content"][0]["text"])
-            for idx in range(3):
-                if str(idx + 1) in result["Preferred"]:
-                    final_result = idx
-                    break
+            # "Instruction 12" must not be read as instruction 1
+            match = re.search(r"\d+", str(result["Preferred"]))
+            if match and 1 <= int(match.group()) <= num_candidates:
+                final_result = int(match.group()) - 1
         except:
             pass
         return final_result